@@ -20,11 +20,8 @@ st.markdown("""
 <style>
     .stMetric .css-1xarl3l { font-size: 1.1rem; }
     div[data-testid="stMetricValue"] { font-size: 1.4rem; }
-    .stTabs [data-baseweb="tab-list"] { gap: 8px; }
-    .stTabs [data-baseweb="tab"] {
-        padding: 8px 20px;
-        font-weight: 600;
-    }
+    div[data-testid="stRadio"] > div[role="radiogroup"] { gap: 8px; }
+    div[data-testid="stRadio"] label p { font-weight: 600; }
 </style>
 """, unsafe_allow_html=True)
 
@@ -33,30 +30,26 @@ from ui.tab_funnel import render_funnel_tab
 from ui.tab_segment import render_segment_tab
 from ui.tab_channel import render_channel_tab
 from ui.tab_model import render_model_tab
+from ui.state import keep_widget_state
 
 st.title("📊 Marketing Funnel Analyzer")
 st.caption("資料請求 → Qualified（面談済） → 成約（売上あり）のファネルを多角的に分析")
 
 # Session state init
-for key in ["df_raw", "df", "meta", "filters", "colmap"]:
+for key in ["df_raw", "df", "meta", "filters", "colmap", "cube", "filter_index", "row_selection", "dataset_id", "lead_index", "lead_scores"]:
     if key not in st.session_state:
         st.session_state[key] = None if key != "filters" else {}
 
-tabs = st.tabs([
-    "📥 Data",
-    "🔄 Funnel",
-    "🎯 Segment",
-    "📊 Channel/Campaign",
-    "🧪 Drivers(Model)",
-])
-
-with tabs[0]:
-    render_data_tab()
-with tabs[1]:
-    render_funnel_tab()
-with tabs[2]:
-    render_segment_tab()
-with tabs[3]:
-    render_channel_tab()
-with tabs[4]:
-    render_model_tab()
+# st.tabs は全タブを毎回実行するので、選択中のタブだけを描画する
+TABS = {
+    "📥 Data": render_data_tab,
+    "🔄 Funnel": render_funnel_tab,
+    "🎯 Segment": render_segment_tab,
+    "📊 Channel/Campaign": render_channel_tab,
+    "🧪 Drivers(Model)": render_model_tab,
+}
+
+keep_widget_state()
+active = st.radio("タブ", list(TABS.keys()), horizontal=True, key="active_tab", label_visibility="collapsed")
+st.divider()
+TABS[active]()
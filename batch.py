@@ -0,0 +1,170 @@
+"""ヘッドレスのバッチ実行（Streamlit / plotly を読み込まずに全タブの集計をファイルに書き出す）
+
+    python batch.py 入力.xlsx [入力2.xlsx ...] -o 出力ディレクトリ [--format parquet|csv|json]
+        [--jobs N] [--stages funnel,segment,channel,drivers] [--sheet シート名] [--compact]
+
+ファイル毎に Data タブと同じ取り込み・整備（列名が標準名と一致する列を自動マッピング）をして、
+各タブの集計を 出力ディレクトリ/ファイル名/タブ/表名.拡張子 に書く。全体KPI・meta・
+段階毎の所要秒数は 出力ディレクトリ/ファイル名/summary.json に出す。
+ファイルはプロセスプールで並列に処理する。
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from logic.cube import build_funnel_cube
+from logic.dataset_cache import dataset_key, load_cached, store_cached
+from logic.ingest import ingest_columns, read_preview, read_sheet, sheet_names
+from logic.preprocess import preprocess
+from logic.reports import REPORT_STAGES, run_report
+from logic.schema import ColumnMap
+
+OUTPUT_FORMATS = ["parquet", "csv", "json"]
+
+
+def _flat(table: pd.DataFrame) -> pd.DataFrame:
+    """書き出せる形（ピボットの行・列ラベルを列に戻し、列名は文字列）にする"""
+    if not isinstance(table.index, pd.RangeIndex):
+        table = table.reset_index()
+    table = table.copy()
+    table.columns = [str(c) for c in table.columns]
+    return table
+
+
+def write_table(table: pd.DataFrame, path: Path, fmt: str) -> Path:
+    path = path.with_suffix(f".{fmt}")
+    table = _flat(table)
+    if fmt == "parquet":
+        table.to_parquet(path, index=False)
+    elif fmt == "csv":
+        # Excel でそのまま開けるよう BOM 付き UTF-8
+        table.to_csv(path, index=False, encoding="utf-8-sig")
+    else:
+        table.to_json(path, orient="records", force_ascii=False, date_format="iso", indent=1)
+    return path
+
+
+def process_workbook(
+    path: str,
+    out_dir: str,
+    fmt: str = "parquet",
+    stages: Optional[List[str]] = None,
+    sheet: Optional[str] = None,
+    compact: bool = False,
+    use_cache: bool = True,
+    n_jobs: Optional[int] = -1,
+) -> Dict:
+    """1ファイル分の取り込み・整備・集計・書き出し（段階毎の所要秒数を返す）"""
+    stages = stages or REPORT_STAGES
+    timings: Dict[str, float] = {}
+    t = time.perf_counter()
+
+    def lap(name: str):
+        nonlocal t
+        now = time.perf_counter()
+        timings[name] = now - t
+        t = now
+
+    data = Path(path).read_bytes()
+    sheet = sheet or sheet_names(data)[0]
+    preview, _ = read_preview(data, sheet)
+    cols = list(preview.columns)
+    colmap = ColumnMap.default_from_df_columns(cols).mapping
+    key = dataset_key(data, sheet, colmap, compact=compact)
+    cached = load_cached(key) if use_cache else None
+    if cached is not None:
+        df, meta = cached
+        lap("load_cached")
+    else:
+        df_raw = read_sheet(data, sheet, usecols=ingest_columns(cols, colmap))
+        lap("read")
+        df, meta = preprocess(df_raw, colmap, compact=compact)
+        del df_raw
+        lap("preprocess")
+        if use_cache:
+            store_cached(key, df, meta)
+            lap("store_cached")
+
+    cube = build_funnel_cube(df)
+    lap("cube")
+
+    target = Path(out_dir) / Path(path).stem
+    written = 0
+    for stage in stages:
+        options = {"n_jobs": n_jobs} if stage == "drivers" else {}
+        tables = run_report(stage, df, meta, cube=cube, **options)
+        lap(stage)
+        (target / stage).mkdir(parents=True, exist_ok=True)
+        for name, table in tables.items():
+            write_table(table, target / stage / name, fmt)
+        written += len(tables)
+        lap(f"write_{stage}")
+
+    summary = {
+        "file": str(path),
+        "sheet": sheet,
+        "colmap": colmap,
+        "meta": meta,
+        "tables": written,
+        "timings": timings,
+    }
+    target.mkdir(parents=True, exist_ok=True)
+    (target / "summary.json").write_text(json.dumps(summary, ensure_ascii=False, indent=1, default=str), encoding="utf-8")
+    return summary
+
+
+def _print_timings(summary: Dict) -> None:
+    stages = "  ".join(f"{k} {v:.2f}s" for k, v in summary["timings"].items())
+    total = sum(summary["timings"].values())
+    print(f"[{Path(summary['file']).name}] {summary['meta'].get('rows', 0):,}行 {summary['tables']}表 計{total:.2f}s | {stages}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Marketing Funnel Analyzer のバッチ実行（全タブの集計をファイルに書き出す）")
+    parser.add_argument("inputs", nargs="+", help="入力の Excel ファイル（.xlsx / .xls）")
+    parser.add_argument("-o", "--out", default="reports", help="出力ディレクトリ（既定: reports）")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="parquet", help="表の出力形式（既定: parquet）")
+    parser.add_argument("--stages", default=",".join(REPORT_STAGES), help="実行するタブ（カンマ区切り）")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="並列に処理するファイル数（既定: CPU コア数）")
+    parser.add_argument("--sheet", default=None, help="読み込むシート名（既定: 先頭のシート）")
+    parser.add_argument("--compact", action="store_true", help="省メモリモードで整備する")
+    parser.add_argument("--no-cache", action="store_true", help="整備済みデータのディスクキャッシュを使わない")
+    args = parser.parse_args(argv)
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in REPORT_STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {unknown}（{', '.join(REPORT_STAGES)} から選ぶ）")
+
+    jobs = max(1, min(args.jobs, len(args.inputs)))
+    # ファイルを並列に回すときはモデル学習のスレッドを1つにして CPU を取り合わない
+    n_jobs = -1 if jobs == 1 else 1
+    options = dict(
+        out_dir=args.out, fmt=args.format, stages=stages, sheet=args.sheet,
+        compact=args.compact, use_cache=not args.no_cache, n_jobs=n_jobs,
+    )
+
+    t0 = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(process_workbook, path, **options): path for path in args.inputs}
+        for f in as_completed(futures):
+            try:
+                _print_timings(f.result())
+            except Exception as e:
+                failed += 1
+                print(f"[{Path(futures[f]).name}] 失敗: {type(e).__name__}: {e}", file=sys.stderr)
+    print(f"{len(args.inputs) - failed}/{len(args.inputs)} ファイル完了（{time.perf_counter() - t0:.1f}s、{jobs}並列）")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""コンバージョン日のパース速度ベンチマーク（混在フォーマット列）
+
+    python benchmarks/bench_dates.py [行数 ...]
+
+旧実装（pd.to_datetime(errors="coerce") → to_period("M").astype(str)）と
+logic.dates（parse_dates → month_codes）を比べ、所要時間と読めた行数を出す。
+最後に、タイムゾーン付き（JST の月初など）の値が現地時刻の月に入るかを確かめる。
+"""
+from __future__ import annotations
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from logic.dates import month_codes, parse_dates  # noqa: E402
+
+
+def _mixed_column(n: int, seed: int = 0) -> pd.Series:
+    """Excel 取り込みで実際に混ざる型・書式を混ぜた日付列"""
+    rng = np.random.default_rng(seed)
+    base = pd.Timestamp("2022-01-01")
+    days = rng.integers(0, 900, n)
+    secs = rng.integers(0, 86400, n)
+    ts = base + pd.to_timedelta(days, "D") + pd.to_timedelta(secs, "s")
+    kind = rng.choice(6, n, p=[0.35, 0.15, 0.2, 0.15, 0.1, 0.05])
+    values = np.empty(n, dtype=object)
+    for k, conv in enumerate([
+        lambda t: t.to_pydatetime(),
+        lambda t: (t - pd.Timestamp("1899-12-30")) / pd.Timedelta(days=1),
+        lambda t: t.strftime("%Y-%m-%d %H:%M:%S"),
+        lambda t: t.strftime("%Y/%m/%d"),
+        lambda t: f"{t.year}年{t.month}月{t.day}日",
+        lambda t: None,
+    ]):
+        idx = np.flatnonzero(kind == k)
+        values[idx] = [conv(ts[i]) for i in idx]
+    return pd.Series(values)
+
+
+def _old(s: pd.Series):
+    with warnings.catch_warnings():
+        # 書式推定に失敗した時の「要素毎に dateutil で読む」警告（それ自体が遅さの原因）
+        warnings.simplefilter("ignore", UserWarning)
+        d = pd.to_datetime(s, errors="coerce")
+    return d, d.dt.to_period("M").astype(str)
+
+
+def _new(s: pd.Series):
+    d = parse_dates(s)
+    return d, month_codes(d)
+
+
+def _bench(fn, s: pd.Series, repeat: int = 3):
+    best = float("inf")
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        try:
+            out = fn(s)
+        except (ValueError, TypeError) as e:
+            return float("nan"), None, type(e).__name__
+        best = min(best, time.perf_counter() - t0)
+    return best, out, ""
+
+
+def check_local_months():
+    """JST の月初の値（datetime 型・オフセット混在の文字列）が UTC に寄せられて前月に入らないこと"""
+    jst = [pd.Timestamp(f"2023-{m:02d}-01 00:30", tz="Asia/Tokyo") for m in range(1, 13)]
+    cases = {
+        "tz_datetime": pd.Series([t.to_pydatetime() for t in jst] + [pd.Timestamp("2023-06-15").to_pydatetime()], dtype=object),
+        "tz_mixed_str": pd.Series([t.isoformat() for t in jst] + ["2023-06-15T10:00:00+00:00", "2023/06/15"]),
+    }
+    for name, s in cases.items():
+        got = month_codes(parse_dates(s))
+        want = month_codes(pd.Series([t.tz_localize(None) for t in jst] + [pd.Timestamp("2023-06-15")] * (len(s) - 12)))
+        assert got.equals(want), f"{name}: {got.tolist()} != {want.tolist()}"
+    print("tz: 現地時刻の月のまま OK")
+
+
+def main(sizes):
+    print(f"{'case':<14}{'rows':>10}{'old_s':>10}{'new_s':>10}{'speedup':>9}{'old_ok':>10}{'new_ok':>10}")
+    for n in sizes:
+        cases = {
+            "mixed": _mixed_column(n),
+            "iso_str": pd.Series((pd.Timestamp("2022-01-01") + pd.to_timedelta(np.arange(n) % 900, "D")).strftime("%Y-%m-%d")),
+            "excel_serial": pd.Series(44562 + (np.arange(n) % 900).astype(float)),
+            "japanese": pd.Series([f"2023年{m}月{d}日" for m, d in zip(np.arange(n) % 12 + 1, np.arange(n) % 28 + 1)]),
+        }
+        for name, s in cases.items():
+            t_old, out_old, err = _bench(_old, s)
+            t_new, out_new, _ = _bench(_new, s)
+            ok_old = int(out_old[0].notna().sum()) if out_old is not None else err
+            ok_new = int(out_new[0].notna().sum())
+            speed = t_old / t_new if t_new and t_old == t_old else float("nan")
+            print(f"{name:<14}{n:>10,}{t_old:>10.3f}{t_new:>10.3f}{speed:>8.1f}x{ok_old!s:>10}{ok_new:>10,}")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 300_000])
+    check_local_months()
@@ -0,0 +1,203 @@
+"""logic の主要関数の行数スケーリングベンチマーク（合成データ・所要時間とピークメモリ・基準値との比較）
+
+    python benchmarks/bench_logic.py [--rows 10k,100k,1M] [--cases preprocess,group_funnel,...]
+        [--baseline benchmarks/baseline.json] [--save-baseline] [--tolerance 0.25] [--no-memory]
+
+行数毎に synthetic.synthetic_leads で合成データを作り、関数毎に
+- 所要時間: ベストオブ（1回が1秒未満なら最大3回）
+- ピークメモリ: tracemalloc を有効にした別の1回で、関数の実行中に増えた分の最大（numpy / pandas の
+  バッファを含む。C 拡張が独自に確保するメモリは含まない）
+を測る。--baseline のファイルに同じ 関数@行数 の結果があれば比べ、許容幅（--tolerance の比率、
+かつ --min-delta 秒 / --min-delta-mb MB 以上）を超えて遅い・大きいものに SLOWER / MEMORY を付け、
+1つでもあれば終了コード 1 を返す。--save-baseline で今回の結果を基準値ファイルに書き込む（既存の
+他の行数の結果は残す）。基準値はマシン毎に取り直すこと。
+
+1,000万行（--rows 10M）は合成データだけで約4GB、preprocess 中はその数倍使うので、16GB 以上の
+マシンで回す。モデル系（encode_features / run_driver_models）は --model-max-rows を超える行数では
+飛ばす。
+"""
+from __future__ import annotations
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from synthetic import synthetic_leads  # noqa: E402
+
+from logic.attribution import contrib_flag_table  # noqa: E402
+from logic.cube import build_funnel_cube  # noqa: E402
+from logic.metrics import funnel_kpis, group_funnel, pivot_segment  # noqa: E402
+from logic.modeling import encode_features, get_model_features, run_driver_models  # noqa: E402
+from logic.preprocess import preprocess  # noqa: E402
+from logic.schema import ColumnMap  # noqa: E402
+
+DEFAULT_ROWS = "10k,100k,1M"
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+# 関数名 → 計測する呼び出し（ctx は raw / colmap / df / meta / features）
+CASES: Dict[str, Callable[[Dict], object]] = {
+    "preprocess": lambda c: preprocess(c["raw"], c["colmap"]),
+    "preprocess_compact": lambda c: preprocess(c["raw"], c["colmap"], compact=True),
+    "build_funnel_cube": lambda c: build_funnel_cube(c["df"]),
+    "funnel_kpis": lambda c: funnel_kpis(c["df"]),
+    "group_funnel": lambda c: group_funnel(c["df"], "_utm_campaign"),
+    "group_funnel_2d": lambda c: group_funnel(c["df"], ["_utm_source", "_utm_content"]),
+    "pivot_segment": lambda c: pivot_segment(c["df"], "_age_band", "_asset_band", "won_rate"),
+    "contrib_flag_table": lambda c: contrib_flag_table(c["df"], c["meta"]["contrib_cols"]),
+    "encode_features": lambda c: encode_features(c["df"], c["features"]),
+    # 結果キャッシュを使わない（dataset_id なし）。1スレッドで回してマシン間の差を小さくする
+    "run_driver_models": lambda c: run_driver_models(c["df"], c["features"], n_estimators=50, n_jobs=1),
+}
+
+MODEL_CASES = {"encode_features", "run_driver_models"}
+
+
+def parse_rows(text: str) -> List[int]:
+    """"10k,100k,1M" → [10000, 100000, 1000000]"""
+    units = {"k": 1_000, "m": 1_000_000}
+    out = []
+    for part in text.split(","):
+        part = part.strip().lower().replace("_", "")
+        if part:
+            out.append(int(float(part[:-1]) * units[part[-1]]) if part[-1] in units else int(part))
+    return out
+
+
+def _time(fn: Callable[[], object], repeat: int = 3, quick: float = 1.0) -> float:
+    """ベストオブの秒数（1回目が quick 秒以上なら1回だけ）"""
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+        if best >= quick:
+            break
+    return best
+
+
+def _peak_mb(fn: Callable[[], object]) -> float:
+    """fn の実行中に増えたメモリの最大（MB）"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (peak - start) / 1e6
+
+
+def load_baseline(path: Path) -> Dict[str, Dict]:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8")).get("results", {})
+
+
+def save_baseline(path: Path, results: Dict[str, Dict]) -> None:
+    merged = {**load_baseline(path), **results}
+    payload = {
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()},
+        "saved_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": dict(sorted(merged.items())),
+    }
+    path.write_text(json.dumps(payload, ensure_ascii=False, indent=1), encoding="utf-8")
+
+
+def compare(
+    result: Dict,
+    base: Optional[Dict],
+    tolerance: float,
+    min_delta: float,
+    min_delta_mb: float,
+) -> List[str]:
+    """基準値より許容幅を超えて悪くなった項目（SLOWER / MEMORY）"""
+    if base is None:
+        return []
+    flags = []
+    if result["seconds"] > base["seconds"] * (1 + tolerance) and result["seconds"] - base["seconds"] > min_delta:
+        flags.append("SLOWER")
+    peak, base_peak = result.get("peak_mb"), base.get("peak_mb")
+    if peak is not None and base_peak is not None:
+        if peak > base_peak * (1 + tolerance) and peak - base_peak > min_delta_mb:
+            flags.append("MEMORY")
+    return flags
+
+
+def _context(n: int, seed: int) -> Dict:
+    raw = synthetic_leads(n, seed=seed)
+    colmap = ColumnMap.default_from_df_columns(list(raw.columns)).mapping
+    df, meta = preprocess(raw, colmap)
+    return {"raw": raw, "colmap": colmap, "df": df, "meta": meta, "features": get_model_features(df)}
+
+
+def _fmt(v: Optional[float], spec: str) -> str:
+    return "-" if v is None else format(v, spec)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="logic の主要関数のスケーリングベンチマーク（合成データ）")
+    parser.add_argument("--rows", default=DEFAULT_ROWS, help=f"行数（カンマ区切り。k / M 可。既定: {DEFAULT_ROWS}）")
+    parser.add_argument("--cases", default=",".join(CASES), help="計測する関数（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=0, help="合成データのシード")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="基準値の JSON")
+    parser.add_argument("--save-baseline", action="store_true", help="今回の結果を基準値として保存する")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="基準値から許容する悪化の比率（既定: 0.25）")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="これ未満の秒数の差は無視する（既定: 0.05）")
+    parser.add_argument("--min-delta-mb", type=float, default=1.0, help="これ未満の MB の差は無視する（既定: 1）")
+    parser.add_argument("--model-max-rows", default="1M", help="モデル系を計測する最大行数（既定: 1M）")
+    parser.add_argument("--no-memory", action="store_true", help="ピークメモリを測らない（計測が約半分の時間で済む）")
+    args = parser.parse_args(argv)
+
+    cases = [c.strip() for c in args.cases.split(",") if c.strip()]
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {unknown}（{', '.join(CASES)} から選ぶ）")
+    model_max_rows = parse_rows(args.model_max_rows)[0]
+    baseline = load_baseline(args.baseline)
+
+    results: Dict[str, Dict] = {}
+    regressions = 0
+    print(f"{'case':<22}{'rows':>12}{'seconds':>10}{'peak_MB':>10}{'base_s':>10}{'base_MB':>10}{'ratio':>8}  flags")
+    for n in parse_rows(args.rows):
+        t0 = time.perf_counter()
+        ctx = _context(n, args.seed)
+        print(f"-- {n:,} 行（合成データ＋整備 {time.perf_counter() - t0:.1f}s）")
+        for name in cases:
+            if name in MODEL_CASES and n > model_max_rows:
+                continue
+            fn = CASES[name]
+            result = {"seconds": _time(lambda: fn(ctx))}
+            result["peak_mb"] = None if args.no_memory else _peak_mb(lambda: fn(ctx))
+            key = f"{name}@{n}"
+            results[key] = result
+            base = baseline.get(key)
+            flags = compare(result, base, args.tolerance, args.min_delta, args.min_delta_mb)
+            regressions += bool(flags)
+            ratio = result["seconds"] / base["seconds"] if base and base["seconds"] else None
+            print(
+                f"{name:<22}{n:>12,}{result['seconds']:>10.3f}{_fmt(result['peak_mb'], '.1f'):>10}"
+                f"{_fmt(base and base['seconds'], '.3f'):>10}{_fmt(base and base.get('peak_mb'), '.1f'):>10}"
+                f"{_fmt(ratio, '.2f'):>8}  {' '.join(flags)}"
+            )
+        del ctx
+        gc.collect()
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"基準値を保存しました: {args.baseline}（{len(results)} 件）")
+    if regressions:
+        print(f"{regressions} 件が基準値より悪化しています（許容幅 {args.tolerance:.0%}）")
+    return 1 if regressions and not args.save_baseline else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
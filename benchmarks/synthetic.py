@@ -0,0 +1,110 @@
+"""ベンチマーク用の合成リードデータ（シード固定。Excel エクスポートと同じ列名・値の形）
+
+    from synthetic import synthetic_leads
+    raw = synthetic_leads(1_000_000, seed=0)
+
+列は logic.schema の STD_COLS と貢献フラグ（CONTRIB_COL_CANDIDATES）。UTM の水準数は実データ程度
+（source 8 / medium 5 / campaign 300 / content 2000、キャンペーン・コンテンツは裾の長い分布）で、
+Qualified 率・成約率は年代・資産・流入元・担当者で変わる（全体で Qualified 約3割、その2割前後が成約）。
+文字列列は少数の文字列オブジェクトを共有する object 列なので、1,000万行でも行数×列数×8バイト程度で作れる。
+"""
+from __future__ import annotations
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from logic.schema import AGE_ORDER, ASSET_ORDER, CONTRIB_COL_CANDIDATES, STD_COLS  # noqa: E402
+
+# 水準数（utm_* はリード獲得の実績に近い数）
+CARDINALITY = {
+    "utm_source": 8,
+    "utm_medium": 5,
+    "utm_campaign": 300,
+    "utm_content": 2000,
+    "sales_owner": 30,
+    "trigger": 10,
+    "lead_source": 6,
+    "origin": 4,
+}
+
+# 空欄・欠損になる割合
+BLANK_RATE = 0.03
+
+
+def _sigmoid(x: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _zipf_weights(k: int, s: float) -> np.ndarray:
+    w = 1.0 / np.arange(1, k + 1) ** s
+    return w / w.sum()
+
+
+def _labels(rng: np.random.Generator, codes: np.ndarray, values: list) -> np.ndarray:
+    """コード → 値の object 配列（一部を空欄・欠損にする）"""
+    vocab = np.array(values + ["", None], dtype=object)
+    out = codes.copy()
+    blank = rng.random(len(codes)) < BLANK_RATE
+    out[blank] = len(values) + rng.integers(0, 2, int(blank.sum()))
+    return vocab[out]
+
+
+def synthetic_leads(n: int, seed: int = 0, start: str = "2022-01-01", months: int = 36) -> pd.DataFrame:
+    """n 行の合成リード（Excel から読んだ直後の形。preprocess にそのまま渡せる）"""
+    rng = np.random.default_rng(seed)
+    ages, assets = AGE_ORDER[:-1], ASSET_ORDER[:-1]
+    age = rng.choice(len(ages), n, p=[0.05, 0.12, 0.2, 0.25, 0.2, 0.1, 0.08])
+    asset = rng.choice(len(assets), n, p=[0.3, 0.3, 0.2, 0.15, 0.05])
+    codes = {
+        k: rng.choice(c, n, p=_zipf_weights(c, 1.1 if c > 50 else 0.6)) for k, c in CARDINALITY.items()
+    }
+
+    # 転換の効果（年代・資産・流入元・担当者）
+    eff_rng = np.random.default_rng(seed + 1)
+    logit_q = (
+        -0.9
+        + np.linspace(-0.3, 0.4, len(ages))[age]
+        + np.linspace(-0.5, 0.6, len(assets))[asset]
+        + eff_rng.normal(0, 0.3, CARDINALITY["utm_source"])[codes["utm_source"]]
+    )
+    qualified = rng.random(n) < _sigmoid(logit_q)
+    logit_w = (
+        -1.5
+        + np.linspace(-0.4, 0.8, len(assets))[asset]
+        + eff_rng.normal(0, 0.4, CARDINALITY["sales_owner"])[codes["sales_owner"]]
+    )
+    won = (qualified & (rng.random(n) < _sigmoid(logit_w))) | (rng.random(n) < 0.005)
+    # 単価は資産が多いほど高い対数正規（1万円単位）
+    ticket = np.exp(rng.normal(np.log(400_000) + 0.3 * asset, 0.6))
+    revenue = np.where(won, np.round(ticket, -4), 0).astype(np.int64)
+
+    stage_vocab = np.array(["Qualified", "Open", "Lost", "Nurturing", "", None], dtype=object)
+    stage = np.where(qualified, 0, rng.choice([1, 2, 3, 4, 5], n, p=[0.4, 0.3, 0.2, 0.05, 0.05]))
+
+    days = rng.integers(0, months * 30, n)
+    secs = rng.integers(0, 86_400, n)
+    dates = pd.Timestamp(start) + pd.to_timedelta(days, "D") + pd.to_timedelta(secs, "s")
+
+    d = {
+        STD_COLS["id"]: np.arange(1, n + 1),
+        STD_COLS["age_band"]: _labels(rng, age, ages),
+        STD_COLS["revenue"]: revenue,
+        STD_COLS["conv_date"]: dates,
+        STD_COLS["assets_band"]: _labels(rng, asset, assets),
+        STD_COLS["stage"]: stage_vocab[stage],
+    }
+    for k, c in CARDINALITY.items():
+        d[STD_COLS[k]] = _labels(rng, codes[k], [f"{k}_{i:04d}" for i in range(c)])
+
+    # 貢献フラグは流入元によって立ちやすさが変わる（1リードに複数立つこともある）
+    flag_rate = eff_rng.beta(0.6, 6.0, (CARDINALITY["utm_source"], len(CONTRIB_COL_CANDIDATES)))
+    flag_vocab = np.array(["FALSE", "TRUE", None], dtype=object)
+    for j, c in enumerate(CONTRIB_COL_CANDIDATES):
+        on = (rng.random(n) < flag_rate[codes["utm_source"], j]).astype(np.int64)
+        on[rng.random(n) < BLANK_RATE] = 2
+        d[c] = flag_vocab[on]
+    return pd.DataFrame(d)
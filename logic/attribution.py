@@ -1,35 +1,413 @@
 from __future__ import annotations
+import math
 import pandas as pd
-from typing import List
-from logic.metrics import funnel_kpis, group_funnel
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from logic.backend import ParquetSource, map_batches
+from logic.metrics import KPI_COLS, _group_median, _safe_div, group_funnel, kpis_from_counts
+from logic.cube import FunnelCube, cube_cell_groups, cube_group_funnel, cube_supports
+from logic.sketch import sketch_quantile
 
 
-def rank_by_metric(df: pd.DataFrame, group_col: str, metric: str, min_leads: int = 5) -> pd.DataFrame:
-    t = group_funnel(df, group_col)
+def rank_by_metric(
+    df: Union[pd.DataFrame, ParquetSource],
+    group_col: str,
+    metric: str,
+    min_leads: int = 5,
+    cube: Optional[FunnelCube] = None,
+) -> pd.DataFrame:
+    """グループ別KPIのランキング（cubeが軸を持っていればロールアップで集計）"""
+    if cube_supports(cube, group_col):
+        t = cube_group_funnel(cube, group_col)
+    else:
+        t = group_funnel(df, group_col)
     t = t[t["leads"] >= min_leads].copy()
     t = t.sort_values(metric, ascending=False)
     return t
 
 
-def contrib_flag_table(df: pd.DataFrame, contrib_cols: List[str]) -> pd.DataFrame:
-    rows = []
-    for c in contrib_cols:
-        col_name = f"_contrib__{c}"
-        if col_name not in df.columns:
+# crosstab の上位抽出に使える指標
+CROSSTAB_SORT_COLS = ["leads", "qualified", "won", "qualified_rate", "won_rate",
+                      "won_rate_in_qualified", "revenue_sum", "median_ticket", "mean_ticket"]
+
+
+def _combine_codes(frame: pd.DataFrame, dims: List[str]) -> Tuple[np.ndarray, int]:
+    """軸の組合せ → 組合せ番号（軸の値の辞書順）。1軸ずつ畳むのでキーが溢れない"""
+    group = np.zeros(len(frame), dtype=np.int64)
+    n = 1
+    for d in dims:
+        codes, uniques = pd.factorize(frame[d], sort=True, use_na_sentinel=False)
+        group, keys = pd.factorize(group * len(uniques) + codes, sort=True)
+        n = len(keys)
+    return group, n
+
+
+def crosstab(
+    df: pd.DataFrame,
+    dims: Sequence[str],
+    min_leads: int = 1,
+    top_k: Optional[int] = None,
+    sort_by: str = "revenue_sum",
+    cube: Optional[FunnelCube] = None,
+) -> pd.DataFrame:
+    """任意の軸の組合せ別ファネルKPI（group_funnel と同じ列、sort_by の降順）
+
+    行を軸毎のコードから組合せ番号に畳み、bincount で1パスに集計する。
+    リード数が min_leads 未満の組合せは他のカウント・中央値を集計する前に落とし、
+    top_k があれば sort_by の上位 top_k 件を選んでから中央値を計算する。
+    cube が全部の軸を持っていれば行データではなくセルから集計する。
+    """
+    dims = list(dims)
+    if sort_by not in CROSSTAB_SORT_COLS:
+        raise ValueError(f"unknown sort column: {sort_by}")
+    use_cube = cube_supports(cube, dims)
+    frame = cube.cells if use_cube else df
+    if len(frame) == 0 or not dims:
+        return pd.DataFrame(columns=dims + KPI_COLS)
+
+    group, n = _combine_codes(frame, dims)
+    measures = ["leads", "qualified", "won", "won_in_qualified", "revenue_sum", "won_revenue_sum"]
+    if use_cube:
+        weights = {m: frame[m].to_numpy(dtype=float) for m in measures}
+    else:
+        is_q = df["_is_qualified"].to_numpy(dtype=bool)
+        is_w = df["_is_won"].to_numpy(dtype=bool)
+        rev = df["_revenue"].to_numpy(dtype=float)
+        weights = {
+            "leads": None, "qualified": is_q, "won": is_w, "won_in_qualified": is_w & is_q,
+            "revenue_sum": rev, "won_revenue_sum": np.where(is_w, rev, 0.0),
+        }
+        won_row = np.flatnonzero(is_w)
+
+    def _medians(codes: np.ndarray, ngroups: int) -> np.ndarray:
+        """frame の行毎のグループコード（-1 は対象外）→ グループ毎の成約単価中央値"""
+        if use_cube:
+            return sketch_quantile(cube.ticket, cube_cell_groups(cube, codes), ngroups)
+        won_code = codes[won_row]
+        ok = won_code >= 0
+        return _group_median(won_code[ok], rev[won_row][ok], ngroups)
+
+    # 母数で先に絞る（残った組合せの行だけを集計する）
+    leads = np.bincount(group, weights=weights["leads"], minlength=n)
+    kept = np.flatnonzero(leads >= min_leads)
+    remap = np.full(n, -1, dtype=np.int64)
+    remap[kept] = np.arange(len(kept))
+    code = remap[group]
+    rows = code >= 0
+
+    def _sum(m: str) -> np.ndarray:
+        w = weights[m]
+        return np.bincount(code[rows], weights=None if w is None else w[rows], minlength=len(kept))
+
+    out = kpis_from_counts(
+        leads=leads[kept],
+        qualified=_sum("qualified"),
+        won=_sum("won"),
+        won_in_qualified=_sum("won_in_qualified"),
+        revenue_sum=_sum("revenue_sum"),
+        won_revenue_sum=_sum("won_revenue_sum"),
+        median_ticket=np.zeros(len(kept)),
+    )
+
+    # 上位を選んでから、その組合せだけ中央値を計算する（中央値で並べるときは先に全部計算）
+    if sort_by == "median_ticket":
+        out["median_ticket"] = _medians(code, len(kept))
+        order = np.argsort(-out["median_ticket"].to_numpy(), kind="stable")[:top_k]
+        out = out.iloc[order].reset_index(drop=True)
+    else:
+        order = np.argsort(-out[sort_by].to_numpy(), kind="stable")[:top_k]
+        pick = np.full(len(kept) + 1, -1, dtype=np.int64)
+        pick[order] = np.arange(len(order))
+        out = out.iloc[order].reset_index(drop=True)
+        # code の -1（母数不足）は pick の末尾（-1）に落ちる
+        out["median_ticket"] = _medians(pick[code], len(order))
+
+    # 組合せのキーは、その組合せに属するどれか1行の値（元の型のまま）
+    member = np.empty(n, dtype=np.int64)
+    member[group] = np.arange(len(group))
+    rep = member[kept[order]]
+    for i, d in enumerate(dims):
+        out.insert(i, d, frame[d].iloc[rep].to_numpy())
+        if out[d].dtype != frame[d].dtype:
+            out[d] = out[d].astype(frame[d].dtype)
+    return out[dims + KPI_COLS]
+
+
+# Gram行列を積み上げるチャンク行数（float64で N×F を一度に持たないため）
+_CONTRIB_CHUNK_ROWS = 262_144
+
+# _contrib_gram が返すアウトカム（Gram行列のキー）
+_GRAM_KEYS = ("leads", "qualified", "won", "won_in_qualified", "revenue_sum", "won_revenue_sum")
+
+# フラグ組合せ表に載せるKPI（中央値はペア単位では持たない）
+PAIR_KPI_COLS = [
+    "leads",
+    "qualified",
+    "won",
+    "qualified_rate",
+    "won_rate",
+    "won_rate_in_qualified",
+    "revenue_sum",
+    "mean_ticket",
+]
+
+
+def _contrib_matrix(df: pd.DataFrame, contrib_cols: List[str]) -> Tuple[List[str], np.ndarray]:
+    """存在する _contrib__* 列を N×F の bool 行列にまとめる"""
+    flags = [c for c in contrib_cols if f"_contrib__{c}" in df.columns]
+    if not flags:
+        return flags, np.zeros((len(df), 0), dtype=bool)
+    m = np.column_stack([df[f"_contrib__{c}"].to_numpy(dtype=bool) for c in flags])
+    return flags, m
+
+
+def _contrib_gram(df: pd.DataFrame, m: np.ndarray) -> Dict[str, np.ndarray]:
+    """アウトカム毎の F×F 行列 M^T diag(y) M（対角がフラグ単体の集計）"""
+    is_q = df["_is_qualified"].to_numpy(dtype=bool)
+    is_w = df["_is_won"].to_numpy(dtype=bool)
+    rev = df["_revenue"].to_numpy(dtype=float)
+    outcomes = {
+        "leads": None,
+        "qualified": is_q,
+        "won": is_w,
+        "won_in_qualified": is_w & is_q,
+        "revenue_sum": rev,
+        "won_revenue_sum": np.where(is_w, rev, 0.0),
+    }
+    n_flags = m.shape[1]
+    gram = {k: np.zeros((n_flags, n_flags)) for k in outcomes}
+    for start in range(0, len(m), _CONTRIB_CHUNK_ROWS):
+        x = m[start:start + _CONTRIB_CHUNK_ROWS].astype(float)
+        for k, y in outcomes.items():
+            xy = x if y is None else x * y[start:start + _CONTRIB_CHUNK_ROWS, None]
+            gram[k] += xy.T @ x
+    return gram
+
+
+def _flag_medians(df: pd.DataFrame, m: np.ndarray) -> np.ndarray:
+    """フラグ毎の成約単価中央値（成約行を1回ソートし、累積件数から位置を引く）"""
+    is_w = df["_is_won"].to_numpy(dtype=bool)
+    won_rev = df["_revenue"].to_numpy(dtype=float)[is_w]
+    order = np.argsort(won_rev, kind="stable")
+    sv = won_rev[order]
+    cum = np.cumsum(m[is_w][order], axis=0)
+    out = np.zeros(m.shape[1])
+    for j in range(m.shape[1]):
+        k = int(cum[-1, j]) if len(cum) else 0
+        if k == 0:
             continue
-        sub = df[df[col_name] == True]
-        if len(sub):
-            k = funnel_kpis(sub)
-            k["flag"] = c
-            rows.append(k)
-        else:
-            rows.append({
-                "flag": c, "leads": 0, "qualified": 0, "won": 0,
-                "qualified_rate": 0.0, "won_rate": 0.0, "won_rate_in_qualified": 0.0,
-                "revenue_sum": 0.0, "median_ticket": 0.0, "mean_ticket": 0.0
-            })
-    out = pd.DataFrame(rows)
-    if "flag" in out.columns:
-        cols = ["flag"] + [c for c in out.columns if c != "flag"]
-        out = out[cols]
+        lo, hi = np.searchsorted(cum[:, j], [(k - 1) // 2 + 1, k // 2 + 1])
+        out[j] = (sv[lo] + sv[hi]) / 2.0
     return out
+
+
+def _flag_table(flags: List[str], gram: Dict[str, np.ndarray], medians: np.ndarray) -> pd.DataFrame:
+    out = kpis_from_counts(
+        leads=np.diag(gram["leads"]),
+        qualified=np.diag(gram["qualified"]),
+        won=np.diag(gram["won"]),
+        won_in_qualified=np.diag(gram["won_in_qualified"]),
+        revenue_sum=np.diag(gram["revenue_sum"]),
+        won_revenue_sum=np.diag(gram["won_revenue_sum"]),
+        median_ticket=medians,
+    )
+    out.insert(0, "flag", flags)
+    return out
+
+
+def _pair_table(flags: List[str], gram: Dict[str, np.ndarray]) -> pd.DataFrame:
+    ia, ib = np.triu_indices(len(flags), k=1)
+    leads = gram["leads"]
+    single = np.diag(leads)
+    both = leads[ia, ib]
+    union = single[ia] + single[ib] - both
+    out = kpis_from_counts(
+        leads=both,
+        qualified=gram["qualified"][ia, ib],
+        won=gram["won"][ia, ib],
+        won_in_qualified=gram["won_in_qualified"][ia, ib],
+        revenue_sum=gram["revenue_sum"][ia, ib],
+        won_revenue_sum=gram["won_revenue_sum"][ia, ib],
+        median_ticket=np.zeros(len(ia)),
+    )[PAIR_KPI_COLS]
+    out.insert(0, "flag_a", [flags[i] for i in ia])
+    out.insert(1, "flag_b", [flags[i] for i in ib])
+    # 重複率: 片方のフラグが立つリードのうち、もう片方も立っている割合
+    out.insert(3, "overlap_a", _safe_div(both, single[ia]))
+    out.insert(4, "overlap_b", _safe_div(both, single[ib]))
+    out.insert(5, "jaccard", _safe_div(both, union))
+    return out
+
+
+def _stream_contrib_analysis(source: ParquetSource, contrib_cols: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """contrib_flag_analysis の Parquet 版（チャンク毎の M^T diag(y) M を足し合わせ、中央値は成約行だけで計算）"""
+    flags = [c for c in contrib_cols if f"_contrib__{c}" in source.columns]
+
+    def partial(chunk: pd.DataFrame):
+        _, m = _contrib_matrix(chunk, flags)
+        is_w = chunk["_is_won"].to_numpy(dtype=bool)
+        return _contrib_gram(chunk, m), chunk.loc[is_w, ["_is_won", "_revenue"]], m[is_w]
+
+    # 0 の F×F 行列と空の成約行から始めて、チャンク毎の結果を行順に足していく
+    gram = {k: np.zeros((len(flags), len(flags))) for k in _GRAM_KEYS}
+    won_rows = [source.schema[["_is_won", "_revenue"]]]
+    won_flags = [np.zeros((0, len(flags)), dtype=bool)]
+    cols = ["_is_qualified", "_is_won", "_revenue"] + [f"_contrib__{c}" for c in flags]
+    for g, won, m_won in map_batches(source, cols, partial):
+        for k in gram:
+            gram[k] += g[k]
+        won_rows.append(won)
+        won_flags.append(m_won)
+    won = pd.concat(won_rows)
+    m_won = np.vstack(won_flags)
+    return _flag_table(flags, gram, _flag_medians(won, m_won)), _pair_table(flags, gram)
+
+
+def contrib_flag_analysis(
+    df: Union[pd.DataFrame, ParquetSource], contrib_cols: List[str],
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """貢献フラグ別ファネルとフラグ組合せ（共起）表を1パスで計算"""
+    if isinstance(df, ParquetSource):
+        return _stream_contrib_analysis(df, contrib_cols)
+    flags, m = _contrib_matrix(df, contrib_cols)
+    gram = _contrib_gram(df, m)
+    return _flag_table(flags, gram, _flag_medians(df, m)), _pair_table(flags, gram)
+
+
+def contrib_flag_table(df: Union[pd.DataFrame, ParquetSource], contrib_cols: List[str]) -> pd.DataFrame:
+    """各貢献フラグがTRUEの行のファネルKPI"""
+    return contrib_flag_analysis(df, contrib_cols)[0]
+
+
+def contrib_cooccurrence(df: Union[pd.DataFrame, ParquetSource], contrib_cols: List[str]) -> pd.DataFrame:
+    """貢献フラグのペア毎の共起件数・重複率・ファネルKPI"""
+    return contrib_flag_analysis(df, contrib_cols)[1]
+
+
+def cooccurrence_matrix(pairs: pd.DataFrame, value: str = "leads") -> pd.DataFrame:
+    """ペア表を対称な F×F 行列に戻す（ヒートマップ用）"""
+    flags = list(dict.fromkeys(list(pairs["flag_a"]) + list(pairs["flag_b"])))
+    p = pairs.pivot(index="flag_a", columns="flag_b", values=value).reindex(index=flags, columns=flags)
+    return p.combine_first(p.T)
+
+
+# Shapley配分でフラグに乗らない分（フラグなしの基準率ぶん）の行ラベル
+SHAPLEY_BASELINE = "(ベースライン)"
+
+
+def _coalition_masks(m: np.ndarray) -> np.ndarray:
+    """行毎の立っているフラグの組合せをビットマスク（int64）に畳む"""
+    masks = np.zeros(len(m), dtype=np.int64)
+    for j in range(m.shape[1]):
+        masks |= m[:, j].astype(np.int64) << j
+    return masks
+
+
+def _zeta_subsets(a: np.ndarray, n_bits: int) -> np.ndarray:
+    """部分集合和変換: out[U] = Σ_{S⊆U} a[S]（長さ 2^n_bits の配列、inplace）"""
+    for b in range(n_bits):
+        v = a.reshape(-1, 2, 1 << b)
+        v[:, 1, :] += v[:, 0, :]
+    return a
+
+
+def _shapley_by_coalition(v: np.ndarray, n_flags: int, coalitions: np.ndarray) -> np.ndarray:
+    """各観測組合せ T について、部分ゲーム v|T 上の厳密なShapley値 φ_i(T) を返す
+
+    φ_i(T) = Σ_{S⊆T\\{i}} |S|!(|T|-|S|-1)!/|T|! · (v(S∪{i}) - v(S))
+    を、サイズ別に部分集合和変換をかけて全 T についてまとめて計算する。
+    戻り値は (len(coalitions), n_flags)。
+    """
+    size = 1 << n_flags
+    all_masks = np.arange(size, dtype=np.int64)
+    popcount = np.zeros(size, dtype=np.int64)
+    for b in range(n_flags):
+        popcount += (all_masks >> b) & 1
+
+    t_size = popcount[coalitions]
+    max_t = int(t_size.max(initial=0))
+    fact = np.array([math.factorial(k) for k in range(max_t + 1)], dtype=float)
+
+    phi = np.zeros((len(coalitions), n_flags))
+    for i in range(n_flags):
+        bit = 1 << i
+        has_i = (coalitions & bit) != 0
+        if not has_i.any():
+            continue
+        rest = coalitions[has_i] ^ bit
+        t = t_size[has_i]
+        without_i = (all_masks & bit) == 0
+        delta = np.where(without_i, v[all_masks | bit] - v, 0.0)
+        acc = np.zeros(len(rest))
+        for s in range(max_t):
+            layer = np.where(popcount == s, delta, 0.0)
+            if not layer.any():
+                continue
+            g = _zeta_subsets(layer, n_flags)[rest]
+            ok = t > s
+            w = np.zeros(len(rest))
+            w[ok] = fact[s] * fact[t[ok] - s - 1] / fact[t[ok]]
+            acc += w * g
+        phi[has_i, i] = acc
+    return phi
+
+
+def contrib_shapley(df: pd.DataFrame, contrib_cols: List[str]) -> pd.DataFrame:
+    """貢献フラグのShapley配分（成約数・売上）
+
+    行をフラグ組合せ（ビットマスク）に畳み、組合せ S の「リードあたり成果」
+    v(S)（組合せがちょうど S のリードの成約率・売上/リード、未観測は0）を
+    特性関数とする。組合せ T のリードは φ_i(T)×リード数 を各フラグに配分し、
+    残り（フラグなしの基準率 v(∅) ぶん）はベースライン行に載せる。
+    配分の合計は全体の成約数・売上に一致する（重複計上しない）。
+    """
+    flags, m = _contrib_matrix(df, contrib_cols)
+    out_cols = ["flag", "leads", "won", "won_shapley", "won_share",
+                "revenue_sum", "revenue_shapley", "revenue_share"]
+    if not flags or len(df) == 0:
+        return pd.DataFrame(columns=out_cols)
+
+    n_flags = len(flags)
+    masks = _coalition_masks(m)
+    size = 1 << n_flags
+    is_w = df["_is_won"].to_numpy(dtype=bool)
+    rev = df["_revenue"].to_numpy(dtype=float)
+
+    leads_by = np.bincount(masks, minlength=size).astype(float)
+    targets = {
+        "won": np.bincount(masks, weights=is_w, minlength=size),
+        "revenue": np.bincount(masks, weights=rev, minlength=size),
+    }
+    coalitions = np.flatnonzero(leads_by)
+    coalitions = coalitions[coalitions != 0]
+
+    credit = {}
+    for name, total_by in targets.items():
+        v = _safe_div(total_by, leads_by)
+        phi = _shapley_by_coalition(v, n_flags, coalitions)
+        credit[name] = leads_by[coalitions] @ phi
+
+    # 単純集計（フラグ毎に重複計上される値）は組合せ別集計から戻す
+    member = ((coalitions[:, None] >> np.arange(n_flags)) & 1).astype(float)
+    out = pd.DataFrame({
+        "flag": flags,
+        "leads": leads_by[coalitions] @ member,
+        "won": targets["won"][coalitions] @ member,
+        "won_shapley": credit["won"],
+        "revenue_sum": targets["revenue"][coalitions] @ member,
+        "revenue_shapley": credit["revenue"],
+    })
+    won_total = float(is_w.sum())
+    rev_total = float(rev.sum())
+    baseline = pd.DataFrame([{
+        "flag": SHAPLEY_BASELINE,
+        "leads": float(leads_by[0]),
+        "won": float(targets["won"][0]),
+        "won_shapley": won_total - float(credit["won"].sum()),
+        "revenue_sum": float(targets["revenue"][0]),
+        "revenue_shapley": rev_total - float(credit["revenue"].sum()),
+    }])
+    out = pd.concat([out, baseline], ignore_index=True)
+    out["won_share"] = out["won_shapley"] / won_total if won_total else 0.0
+    out["revenue_share"] = out["revenue_shapley"] / rev_total if rev_total else 0.0
+    return out[out_cols]
@@ -0,0 +1,150 @@
+from __future__ import annotations
+import json
+import os
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, TypeVar, Union
+
+from logic.dataset_cache import _to_arrow_table
+
+# KPI関数の集計バックエンド
+BACKENDS = {
+    "pandas": "pandas（メモリ上の DataFrame）",
+    "parquet": "Parquet（ローカルの Parquet をチャンク毎に集計）",
+}
+
+# 1チャンクの行数（これ × 並列数ぶんの行だけがメモリに載る）
+DEFAULT_BATCH_ROWS = 1_000_000
+
+_SCHEMA_KEY = b"marketing_app.schema"
+_PART = "part-{:05d}.parquet"
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class ParquetSource:
+    """preprocess済みデータを置いたローカル Parquet（part ファイルのディレクトリ）
+
+    schema は列毎の pandas の型（0行の DataFrame。カテゴリの水準と順序を含む）で、
+    チャンクはこの型にそろえてから集計するので、結果は pandas の DataFrame と同じになる。
+    """
+    path: str
+    schema: pd.DataFrame
+    batch_rows: int = DEFAULT_BATCH_ROWS
+    workers: int = 0
+
+    @property
+    def columns(self) -> pd.Index:
+        return self.schema.columns
+
+
+def _dtype_spec(s: pd.Series) -> Dict:
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return {"dtype": "category", "categories": s.cat.categories.tolist(), "ordered": bool(s.cat.ordered)}
+    return {"dtype": str(s.dtype)}
+
+
+def _spec_dtype(spec: Dict):
+    if spec["dtype"] == "category":
+        return pd.CategoricalDtype(spec["categories"], ordered=spec["ordered"])
+    return pd.api.types.pandas_dtype(spec["dtype"])
+
+
+def _parts(path: Union[str, Path]) -> List[Path]:
+    return sorted(Path(path).glob("part-*.parquet"))
+
+
+def write_parquet_source(
+    df: pd.DataFrame,
+    path: Union[str, Path],
+    row_group_rows: int = DEFAULT_BATCH_ROWS,
+) -> ParquetSource:
+    """preprocess済みデータを path（ディレクトリ）に part ファイルとして足す
+
+    月次のエクスポートを整備する度に書き足せば、全期間をメモリに載せずに集計できる。
+    """
+    import pyarrow.parquet as pq
+
+    root = Path(path)
+    root.mkdir(parents=True, exist_ok=True)
+    table = _to_arrow_table(df)
+    metadata = dict(table.schema.metadata or {})
+    spec = {c: _dtype_spec(df[c]) for c in df.columns}
+    metadata[_SCHEMA_KEY] = json.dumps(spec, ensure_ascii=False, default=str).encode("utf-8")
+    table = table.replace_schema_metadata(metadata)
+    pq.write_table(table, root / _PART.format(len(_parts(root))), row_group_size=row_group_rows)
+    return open_parquet_source(root)
+
+
+def open_parquet_source(
+    path: Union[str, Path],
+    batch_rows: int = DEFAULT_BATCH_ROWS,
+    workers: int = 0,
+) -> ParquetSource:
+    """write_parquet_source で書いたディレクトリを開く（行データは読まず、フッタの型情報だけ）
+
+    part 毎にカテゴリの水準が違うときは、書いた順に水準を足し合わせる。
+    workers=0 は CPU コア数。
+    """
+    import pyarrow.parquet as pq
+
+    parts = _parts(path)
+    if not parts:
+        raise FileNotFoundError(f"Parquet の part ファイルがありません: {path}")
+    spec: Dict[str, Dict] = {}
+    for p in parts:
+        metadata = pq.read_schema(p).metadata or {}
+        for col, s in json.loads(metadata.get(_SCHEMA_KEY, b"{}")).items():
+            if col not in spec:
+                spec[col] = s
+            elif s["dtype"] == "category" and spec[col]["dtype"] == "category":
+                known = set(spec[col]["categories"])
+                spec[col]["categories"] += [v for v in s["categories"] if v not in known]
+    schema = pd.DataFrame({c: pd.Series([], dtype=_spec_dtype(s)) for c, s in spec.items()})
+    return ParquetSource(path=str(path), schema=schema, batch_rows=batch_rows, workers=workers)
+
+
+def iter_batches(source: ParquetSource, columns: Sequence[str]) -> Iterator[pd.DataFrame]:
+    """columns だけを読み、schema の型にそろえたチャンクを行順に返す"""
+    import pyarrow.dataset as ds
+
+    columns = [c for c in dict.fromkeys(columns) if c in source.columns]
+    dataset = ds.dataset([str(p) for p in _parts(source.path)], format="parquet")
+    for batch in dataset.to_batches(columns=columns, batch_size=source.batch_rows, use_threads=True):
+        chunk = batch.to_pandas()
+        for c in columns:
+            dtype = source.schema[c].dtype
+            if chunk[c].dtype != dtype:
+                chunk[c] = chunk[c].astype(dtype)
+        yield chunk
+
+
+def map_batches(source: ParquetSource, columns: Sequence[str], fn: Callable[[pd.DataFrame], T]) -> Iterator[T]:
+    """チャンク毎に fn をスレッドで並列に実行し、結果を行順に返す（先読みは並列数の2倍まで）"""
+    workers = source.workers or os.cpu_count() or 1
+    if workers == 1:
+        for chunk in iter_batches(source, columns):
+            yield fn(chunk)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for chunk in iter_batches(source, columns):
+            pending.append(pool.submit(fn, chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for f in pending:
+            yield f.result()
+
+
+def source_rows(data: Union[pd.DataFrame, ParquetSource, None]) -> Optional[int]:
+    """行数（Parquet はフッタから読むので行データは読まない）"""
+    if data is None:
+        return None
+    if not isinstance(data, ParquetSource):
+        return len(data)
+    import pyarrow.parquet as pq
+
+    return sum(pq.ParquetFile(p).metadata.num_rows for p in _parts(data.path))
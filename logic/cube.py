@@ -0,0 +1,270 @@
+from __future__ import annotations
+import pandas as pd
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Union
+
+from logic.metrics import (
+    KPI_COLS,
+    _finish_group_table,
+    _group_codes,
+    kpis_from_counts,
+)
+from logic.sketch import (
+    DEFAULT_RELATIVE_ERROR,
+    EXACT_MAX_ITEMS,
+    QuantileSketch,
+    build_quantile_sketch,
+    sketch_quantile,
+    sketch_take,
+    sketch_update,
+)
+
+# キューブの集計軸（_is_qualified は下流ビュー＝Qualified内の切り出し用）
+CUBE_DIMS = [
+    "_month",
+    "_sales_owner",
+    "_age_band",
+    "_asset_band",
+    "_utm_source",
+    "_utm_campaign",
+    "_is_qualified",
+]
+
+# セル毎に保持する加算可能なカウント
+CUBE_MEASURES = ["leads", "qualified", "won", "won_in_qualified", "revenue_sum", "won_revenue_sum"]
+
+
+@dataclass(frozen=True)
+class FunnelCube:
+    """ファネル集計キューブ
+
+    cells: 集計軸 × カウントの表（indexはセルID）
+    ticket: セル毎の成約単価の分位スケッチ（中央値・分位点のロールアップ用）
+    """
+    cells: pd.DataFrame
+    ticket: QuantileSketch
+
+    @property
+    def dims(self) -> List[str]:
+        return [c for c in self.cells.columns if c not in CUBE_MEASURES]
+
+
+def build_funnel_cube(
+    df: pd.DataFrame,
+    dims: Optional[Sequence[str]] = None,
+    relative_error: float = DEFAULT_RELATIVE_ERROR,
+    exact_max: int = EXACT_MAX_ITEMS,
+) -> FunnelCube:
+    """preprocess済みの行データから集計キューブを1回だけ作る
+
+    成約単価はセル毎の分位スケッチに畳む（成約が exact_max 件以下のグループの中央値は厳密、
+    それより大きいグループは相対誤差 relative_error 以内）。
+    """
+    dims = [d for d in (dims or CUBE_DIMS) if d in df.columns]
+    if len(df) == 0 or not dims:
+        cells = pd.DataFrame(columns=dims + CUBE_MEASURES)
+        ticket = build_quantile_sketch(np.zeros(0), np.zeros(0), 0, relative_error, exact_max)
+        return FunnelCube(cells=cells, ticket=ticket)
+
+    codes, keys = _group_codes(df, dims)
+    ncells = len(keys)
+
+    is_q = df["_is_qualified"].to_numpy(dtype=bool)
+    is_w = df["_is_won"].to_numpy(dtype=bool)
+    rev = df["_revenue"].to_numpy(dtype=float)
+    won_cell = codes[is_w]
+    won_rev = rev[is_w]
+
+    cells = keys.to_frame(index=False) if isinstance(keys, pd.MultiIndex) else pd.DataFrame({dims[0]: keys})
+    # グループキーは元の型（カテゴリ順序など）を保つ
+    for d in dims:
+        if isinstance(df[d].dtype, pd.CategoricalDtype):
+            cells[d] = cells[d].astype(df[d].dtype)
+    cells["leads"] = np.bincount(codes, minlength=ncells)
+    cells["qualified"] = np.bincount(codes, weights=is_q, minlength=ncells).astype(np.int64)
+    cells["won"] = np.bincount(won_cell, minlength=ncells)
+    cells["won_in_qualified"] = np.bincount(codes, weights=is_w & is_q, minlength=ncells).astype(np.int64)
+    cells["revenue_sum"] = np.bincount(codes, weights=rev, minlength=ncells)
+    cells["won_revenue_sum"] = np.bincount(won_cell, weights=won_rev, minlength=ncells)
+
+    ticket = build_quantile_sketch(won_cell, won_rev, ncells, relative_error, exact_max)
+    return FunnelCube(cells=cells, ticket=ticket)
+
+
+def cube_upsert(cube: FunnelCube, removed: pd.DataFrame, added: pd.DataFrame) -> FunnelCube:
+    """行の入れ替え（removed を抜いて added を足す）をキューブに反映する
+
+    変わった行だけを集計してセル毎の差分を足し引きし、成約単価のスケッチも
+    その行の値だけを出し入れする（他の行は再走査しない）。新しい組合せは末尾のセルIDになる。
+    """
+    dims = cube.dims
+    if not dims or len(removed) + len(added) == 0:
+        return cube
+    cols = list(dict.fromkeys(dims + ["_is_qualified", "_is_won", "_revenue"]))
+    rows = pd.concat([removed[cols], added[cols]], ignore_index=True)
+    sign = np.r_[np.full(len(removed), -1.0), np.ones(len(added))]
+    codes, keys = _group_codes(rows, dims)
+    delta = keys.to_frame(index=False) if isinstance(keys, pd.MultiIndex) else pd.DataFrame({dims[0]: keys})
+
+    # 差分のキー → 既存のセルID（無いものは末尾に新しいセルIDを振る）
+    ids = delta.merge(cube.cells[dims].reset_index(names="_cell"), on=dims, how="left")["_cell"].to_numpy(dtype=float, copy=True)
+    fresh = np.isnan(ids)
+    n_cells = cube.ticket.n_cells
+    ids[fresh] = n_cells + np.arange(int(fresh.sum()))
+    ids = ids.astype(np.int64)
+
+    is_q = rows["_is_qualified"].to_numpy(dtype=bool)
+    is_w = rows["_is_won"].to_numpy(dtype=bool)
+    rev = rows["_revenue"].to_numpy(dtype=float)
+    n = len(keys)
+    d = pd.DataFrame({
+        "leads": np.bincount(codes, weights=sign, minlength=n),
+        "qualified": np.bincount(codes, weights=sign * is_q, minlength=n),
+        "won": np.bincount(codes, weights=sign * is_w, minlength=n),
+        "won_in_qualified": np.bincount(codes, weights=sign * (is_w & is_q), minlength=n),
+        "revenue_sum": np.bincount(codes, weights=sign * rev, minlength=n),
+        "won_revenue_sum": np.bincount(codes, weights=sign * rev * is_w, minlength=n),
+    }, index=ids)
+
+    cells = cube.cells.copy()
+    old = ids[~fresh]
+    for col in CUBE_MEASURES:
+        cells.loc[old, col] = cells.loc[old, col].to_numpy() + d.loc[old, col].to_numpy().astype(cells[col].dtype)
+    new_cells = delta[fresh].set_index(pd.Index(ids[fresh]))
+    for col in CUBE_MEASURES:
+        new_cells[col] = d.loc[ids[fresh], col].to_numpy().astype(cells[col].dtype)
+    cells = pd.concat([cells, new_cells]) if len(new_cells) else cells
+    # カテゴリ型の軸は元の順序を保ち、新しい値はカテゴリの末尾に足す
+    for c in dims:
+        dtype = cube.cells[c].dtype
+        if isinstance(dtype, pd.CategoricalDtype) and cells[c].dtype != dtype:
+            extra = pd.Index(cells[c].dropna().unique()).difference(dtype.categories)
+            cells[c] = cells[c].astype(pd.CategoricalDtype(dtype.categories.append(extra), ordered=dtype.ordered))
+    cells = cells[cells["leads"] > 0]
+
+    row_cell = ids[codes]
+    n_removed = len(removed)
+    ticket = sketch_update(
+        cube.ticket,
+        row_cell[n_removed:][is_w[n_removed:]], rev[n_removed:][is_w[n_removed:]],
+        row_cell[:n_removed][is_w[:n_removed]], rev[:n_removed][is_w[:n_removed]],
+        n_cells + int(fresh.sum()),
+    )
+    return FunnelCube(cells=cells, ticket=ticket)
+
+
+def cube_supports(cube: Optional[FunnelCube], cols: Union[str, Sequence[str]]) -> bool:
+    """キューブのロールアップで集計できる軸かどうか"""
+    if cube is None:
+        return False
+    cols = [cols] if isinstance(cols, str) else list(cols)
+    return all(c in cube.dims for c in cols)
+
+
+def cube_cell_groups(cube: FunnelCube, codes: np.ndarray) -> np.ndarray:
+    """セルID → グループコードの表（cube.cells の行順のコードから。キューブに無いセルは -1）"""
+    lookup = np.full(cube.ticket.n_cells, -1, dtype=np.int64)
+    lookup[cube.cells.index.to_numpy()] = codes
+    return lookup
+
+
+def cube_filter(cube: FunnelCube, filters: Dict[str, Sequence]) -> FunnelCube:
+    """各軸の選択値でセルを絞り込む（行データは再走査しない）"""
+    cells = cube.cells
+    mask = np.ones(len(cells), dtype=bool)
+    for col, values in filters.items():
+        if values is None:
+            continue
+        values = list(values)
+        keep = cells[col].isin([v for v in values if not pd.isna(v)]).to_numpy()
+        # 欠損（None / NaN）を選んだら欠損のセルも残す（select_rows と同じ扱い）
+        if any(pd.isna(v) for v in values):
+            keep |= cells[col].isna().to_numpy()
+        mask &= keep
+    if mask.all():
+        return cube
+
+    kept = cells[mask]
+    return FunnelCube(cells=kept, ticket=sketch_take(cube.ticket, kept.index.to_numpy()))
+
+
+def cube_kpis(cube: FunnelCube) -> Dict[str, float]:
+    """funnel_kpis と同じ辞書をキューブから計算"""
+    c = cube.cells
+    k = kpis_from_counts(
+        leads=[c["leads"].sum()],
+        qualified=[c["qualified"].sum()],
+        won=[c["won"].sum()],
+        won_in_qualified=[c["won_in_qualified"].sum()],
+        revenue_sum=[c["revenue_sum"].sum()],
+        won_revenue_sum=[c["won_revenue_sum"].sum()],
+        median_ticket=sketch_quantile(cube.ticket, cube_cell_groups(cube, np.zeros(len(c), dtype=np.int64)), 1),
+    )
+    return {col: float(k[col].iloc[0]) for col in KPI_COLS}
+
+
+def cube_group_funnel(
+    cube: FunnelCube,
+    group_col: Union[str, Sequence[str]],
+    observed: bool = False,
+) -> pd.DataFrame:
+    """group_funnel と同じ表をキューブのロールアップで計算"""
+    cols = [group_col] if isinstance(group_col, str) else list(group_col)
+    cells = cube.cells
+    if len(cells) == 0:
+        return pd.DataFrame(columns=cols + KPI_COLS)
+
+    codes, keys = _group_codes(cells, cols)
+    ngroups = len(keys)
+
+    def _sum(col: str) -> np.ndarray:
+        return np.bincount(codes, weights=cells[col].to_numpy(dtype=float), minlength=ngroups)
+
+    out = kpis_from_counts(
+        leads=_sum("leads"),
+        qualified=_sum("qualified"),
+        won=_sum("won"),
+        won_in_qualified=_sum("won_in_qualified"),
+        revenue_sum=_sum("revenue_sum"),
+        won_revenue_sum=_sum("won_revenue_sum"),
+        median_ticket=sketch_quantile(cube.ticket, cube_cell_groups(cube, codes), ngroups),
+    )
+    return _finish_group_table(out, keys, cells, cols, observed)
+
+
+def cube_ticket_quantiles(
+    cube: FunnelCube,
+    group_col: Union[str, Sequence[str]],
+    quantiles: Sequence[float] = (0.25, 0.5, 0.75),
+) -> pd.DataFrame:
+    """グループ別の成約単価の分位点（列 ticket_p25 など。行データは再走査しない）"""
+    cols = [group_col] if isinstance(group_col, str) else list(group_col)
+    names = [f"ticket_p{round(q * 100):g}" for q in quantiles]
+    cells = cube.cells
+    if len(cells) == 0:
+        return pd.DataFrame(columns=cols + names)
+
+    codes, keys = _group_codes(cells, cols)
+    groups = cube_cell_groups(cube, codes)
+    out = keys.to_frame(index=False) if isinstance(keys, pd.MultiIndex) else pd.DataFrame({cols[0]: keys})
+    for name, q in zip(names, quantiles):
+        out[name] = sketch_quantile(cube.ticket, groups, len(keys), q)
+    return out
+
+
+def cube_pivot_segment(cube: FunnelCube, row: str, col: str, metric: str) -> pd.DataFrame:
+    """pivot_segment のキューブ版"""
+    tmp = cube_group_funnel(cube, [row, col], observed=True)
+    if len(tmp) == 0:
+        return pd.DataFrame()
+    return tmp.pivot(index=row, columns=col, values=metric)
+
+
+def cube_pivot_segment_count(cube: FunnelCube, row: str, col: str) -> pd.DataFrame:
+    """pivot_segment_count のキューブ版"""
+    tmp = cube_group_funnel(cube, [row, col], observed=True)
+    if len(tmp) == 0:
+        return pd.DataFrame()
+    tmp["count"] = tmp["leads"].astype(int)
+    return tmp.pivot(index=row, columns=col, values="count").fillna(0).astype(int)
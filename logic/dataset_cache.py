@@ -0,0 +1,133 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import tempfile
+import pandas as pd
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+# 既定のキャッシュ置き場（環境変数で上書き可）
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("MARKETING_APP_CACHE_DIR", Path.home() / ".cache" / "marketing_app" / "datasets")
+)
+# キャッシュ全体の上限サイズ（超えたら最終アクセスが古いものから削除）
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# preprocess の出力が変わったら上げる（古いキャッシュを読まないように）
+CACHE_FORMAT_VERSION = 6
+
+_META_KEY = b"marketing_app.meta"
+_SUFFIX = ".arrow"
+
+
+def dataset_key(data: bytes, sheet: str, colmap: Dict[str, str], compact: bool = False) -> str:
+    """ファイル内容のハッシュ＋シート名＋列マッピング（＋整備オプション）から作るキャッシュキー"""
+    h = hashlib.sha256(data)
+    h.update(b"\0" + sheet.encode("utf-8"))
+    h.update(b"\0" + json.dumps(colmap, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    h.update(f"\0compact={compact}\0v{CACHE_FORMAT_VERSION}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_dir(cache_dir: Optional[Union[str, Path]]) -> Path:
+    return Path(cache_dir) if cache_dir is not None else DEFAULT_CACHE_DIR
+
+
+def _to_arrow_table(df: pd.DataFrame):
+    import pyarrow as pa
+
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    # 型が混在する元データ列（数値と文字列が混ざる列など）は文字列として保存
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype == object:
+            try:
+                pa.array(df[c], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[c] = df[c].map(lambda v: None if pd.isna(v) else str(v))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def load_cached(key: str, cache_dir: Optional[Union[str, Path]] = None) -> Optional[Tuple[pd.DataFrame, Dict]]:
+    """キャッシュ済みの (df, meta) を返す（なければ None）
+
+    Arrow IPC ファイルをメモリマップで開くので、欠損のない数値列はコピーなしで渡る。
+    """
+    import pyarrow as pa
+
+    path = _cache_dir(cache_dir) / f"{key}{_SUFFIX}"
+    if not path.exists():
+        return None
+    try:
+        with pa.memory_map(str(path), "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+    meta = json.loads((table.schema.metadata or {}).get(_META_KEY, b"{}"))
+    df = table.to_pandas(split_blocks=True)
+    # LRU 用に最終アクセス時刻を更新
+    os.utime(path)
+    return df, meta
+
+
+def store_cached(
+    key: str,
+    df: pd.DataFrame,
+    meta: Dict,
+    cache_dir: Optional[Union[str, Path]] = None,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> Path:
+    """(df, meta) を Arrow IPC ファイルとして保存し、上限サイズまで古いものを削除"""
+    import pyarrow as pa
+
+    root = _cache_dir(cache_dir)
+    root.mkdir(parents=True, exist_ok=True)
+    table = _to_arrow_table(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_META_KEY] = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    table = table.replace_schema_metadata(metadata)
+
+    path = root / f"{key}{_SUFFIX}"
+    fd, tmp = tempfile.mkstemp(dir=root, suffix=".tmp")
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    evict(root, max_bytes=max_bytes, keep=path)
+    return path
+
+
+def evict(
+    cache_dir: Optional[Union[str, Path]] = None,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    keep: Optional[Path] = None,
+    suffix: str = _SUFFIX,
+) -> int:
+    """合計サイズが max_bytes 以下になるまで最終アクセスが古いファイルを削除（削除数を返す）"""
+    root = _cache_dir(cache_dir)
+    if not root.exists():
+        return 0
+    entries = sorted(
+        (p.stat().st_mtime, p.stat().st_size, p) for p in root.glob(f"*{suffix}")
+    )
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, p in entries:
+        if total <= max_bytes:
+            break
+        if keep is not None and p == keep:
+            continue
+        p.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    return removed
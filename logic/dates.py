@@ -0,0 +1,219 @@
+from __future__ import annotations
+import datetime as dt
+import pandas as pd
+import numpy as np
+from typing import List, Optional
+
+# 文字列日付の候補フォーマット（サンプルで最も多く読めたものを全体に使う）
+DATE_FORMATS: List[str] = [
+    "ISO8601",
+    "%Y/%m/%d",
+    "%Y/%m/%d %H:%M",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y年%m月%d日",
+    "%Y年%m月%d日 %H:%M",
+    "%Y年%m月%d日 %H:%M:%S",
+    "%Y.%m.%d",
+    "%Y%m%d",
+    "%m/%d/%Y",
+    "%m/%d/%Y %H:%M",
+]
+
+# Excel シリアル値の起点（1900年うるう年バグ込みで 1899-12-30）
+EXCEL_EPOCH = np.datetime64("1899-12-30", "ns")
+# シリアル値として扱う範囲（1900-01-01 〜 9999-12-31）
+_SERIAL_MIN, _SERIAL_MAX = 1, 2958465
+# yyyymmdd の整数として扱う範囲
+_YMD_MIN, _YMD_MAX = 19000101, 99991231
+
+_SAMPLE_SIZE = 500
+
+
+def _to_naive(s: pd.Series) -> pd.Series:
+    """タイムゾーン付きは現地時刻のまま tz を外す（月の境界をずらさない）"""
+    if getattr(s.dt, "tz", None) is not None:
+        return s.dt.tz_localize(None)
+    return s
+
+
+# 文字列末尾のタイムゾーン（Z / +09:00 / +0900）
+_TZ_SUFFIX = r"(Z|[+-]\d{2}:?\d{2})$"
+
+
+def _to_datetime_local(s: pd.Series, tz_keys: Optional[np.ndarray] = None, **kwargs) -> pd.Series:
+    """pd.to_datetime（errors="coerce"）の結果を、tz 付きは現地時刻のまま tz を外して datetime64[ns] にする
+
+    タイムゾーンが混在すると一括では読めない（UTC にそろえると月の境界がずれる）ので、
+    tz が同じ値毎に分けて読む。文字列は末尾のオフセットで分け、datetime 型は tz_keys
+    （要素毎の tzinfo）で分ける（datetime 型の混在は例外にならず片方が NaT になるため）。
+    """
+    def parse(part: pd.Series) -> Optional[pd.Series]:
+        try:
+            parsed = pd.to_datetime(part, errors="coerce", **kwargs)
+        except (ValueError, TypeError):
+            return None
+        if not pd.api.types.is_datetime64_any_dtype(parsed):
+            return None
+        return _to_naive(parsed).astype("datetime64[ns]")
+
+    if tz_keys is None or len(pd.unique(tz_keys)) <= 1:
+        out = parse(s)
+        if out is not None or tz_keys is not None:
+            return out if out is not None else pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns]")
+        tz_keys = s.astype(str).str.extract(_TZ_SUFFIX, expand=False).fillna("").to_numpy()
+
+    out = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns]")
+    for _, part in s.groupby(tz_keys, sort=False):
+        parsed = parse(part)
+        if parsed is not None:
+            out[part.index] = parsed
+    return out
+
+
+def _from_numbers(x: np.ndarray) -> np.ndarray:
+    """数値（Excel シリアル値 / yyyymmdd）を datetime64[ns] にする。範囲外は NaT"""
+    x = np.asarray(x, dtype=float)
+    out = np.full(len(x), np.datetime64("NaT"), dtype="datetime64[ns]")
+
+    serial = (x >= _SERIAL_MIN) & (x <= _SERIAL_MAX)
+    ms = np.round(x[serial] * 86_400_000).astype(np.int64)
+    out[serial] = EXCEL_EPOCH + ms.astype("timedelta64[ms]")
+
+    ymd = (x >= _YMD_MIN) & (x <= _YMD_MAX) & (x == np.floor(x))
+    if ymd.any():
+        parsed = pd.to_datetime(pd.Series(x[ymd].astype(np.int64).astype(str)), format="%Y%m%d", errors="coerce")
+        out[ymd] = parsed.to_numpy(dtype="datetime64[ns]")
+    return out
+
+
+def _parse_with(s: pd.Series, fmt: str) -> pd.Series:
+    return _to_datetime_local(s, format=fmt)
+
+
+def detect_date_format(sample: pd.Series) -> Optional[str]:
+    """サンプルの文字列を最も多く読めるフォーマット（どれも読めなければ None）"""
+    best, best_hits = None, 0
+    for fmt in DATE_FORMATS:
+        hits = int(_parse_with(sample, fmt).notna().sum())
+        if hits > best_hits:
+            best, best_hits = fmt, hits
+            if hits == len(sample):
+                break
+    return best
+
+
+def _parse_strings(s: pd.Series) -> np.ndarray:
+    """文字列（ユニーク値）を日付に。フォーマットはサンプルから1回だけ決める"""
+    s = s.str.strip()
+    out = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns]")
+
+    # 数字だけの文字列は Excel シリアル値 / yyyymmdd
+    numeric = pd.to_numeric(s, errors="coerce")
+    is_num = numeric.notna().to_numpy()
+    if is_num.any():
+        out[is_num] = _from_numbers(numeric[is_num].to_numpy())
+
+    rest = s[~is_num & (s != "")]
+    if len(rest) == 0:
+        return out.to_numpy()
+
+    tried = set()
+    fmt = detect_date_format(rest.iloc[:_SAMPLE_SIZE])
+    while fmt is not None and len(rest):
+        tried.add(fmt)
+        parsed = _parse_with(rest, fmt)
+        ok = parsed.notna()
+        out[rest.index[ok.to_numpy()]] = parsed[ok]
+        rest = rest[~ok]
+        # 残りは別フォーマットが混ざっている分だけなので、その中で再判定
+        candidates = [f for f in DATE_FORMATS if f not in tried]
+        fmt = None
+        if len(rest) and candidates:
+            sample = rest.iloc[:_SAMPLE_SIZE]
+            hits = {f: int(_parse_with(sample, f).notna().sum()) for f in candidates}
+            f, n = max(hits.items(), key=lambda kv: kv[1])
+            fmt = f if n else None
+
+    if len(rest):
+        # どのフォーマットにも合わない残りだけ要素毎の推定にまわす
+        out[rest.index] = _to_datetime_local(rest, format="mixed")
+    return out.to_numpy()
+
+
+_KIND_BY_TYPE = {
+    dt.datetime: "dt",
+    dt.date: "dt",
+    pd.Timestamp: "dt",
+    np.datetime64: "dt",
+    int: "num",
+    float: "num",
+    np.int64: "num",
+    np.float64: "num",
+    str: "str",
+}
+
+
+def _kind_of(v) -> str:
+    if isinstance(v, (dt.date, np.datetime64)):
+        return "dt"
+    if isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool):
+        return "num"
+    if isinstance(v, str):
+        return "str"
+    return ""
+
+
+def parse_dates(s: pd.Series) -> pd.Series:
+    """Excel 由来の日付列を datetime64[ns] にする
+
+    datetime 型はそのまま、数値は Excel シリアル値（または yyyymmdd）、
+    文字列はサンプルから判定したフォーマットで一括変換する。
+    混在列はユニーク値に分解してから型毎に変換し、コード経由で全行に戻す。
+    """
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return _to_naive(s).astype("datetime64[ns]")
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        return pd.Series(_from_numbers(s.to_numpy(dtype=float, na_value=np.nan)), index=s.index)
+
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    u = pd.Series(uniques, dtype=object)
+    parsed = np.full(len(u), np.datetime64("NaT"), dtype="datetime64[ns]")
+
+    # 型の判定は type() の辞書引きで済ませ、見慣れない型だけ isinstance で見る
+    kind = pd.Series([type(v) for v in uniques], dtype=object).map(_KIND_BY_TYPE)
+    unknown = kind.isna()
+    if unknown.any():
+        kind[unknown] = u[unknown].map(_kind_of)
+    kind = kind.to_numpy()
+
+    is_dt = kind == "dt"
+    if is_dt.any():
+        values = u[is_dt]
+        tz_keys = np.array([str(getattr(v, "tzinfo", None)) for v in values], dtype=object)
+        parsed[is_dt] = _to_datetime_local(values, tz_keys=tz_keys).to_numpy(dtype="datetime64[ns]")
+    is_num = kind == "num"
+    if is_num.any():
+        parsed[is_num] = _from_numbers(u[is_num].astype(float).to_numpy())
+    is_str = kind == "str"
+    if is_str.any():
+        parsed[is_str] = _parse_strings(u[is_str].astype(str).reset_index(drop=True))
+
+    # 欠損のコード(-1)は末尾の NaT を引く
+    return pd.Series(np.append(parsed, np.datetime64("NaT", "ns"))[codes], index=s.index)
+
+
+def month_codes(dates: pd.Series) -> pd.Series:
+    """日付 → 月キー（1970-01 起点の通し月番号 = pd.Period(freq="M").ordinal, Int32）"""
+    na = dates.isna().to_numpy()
+    months = dates.to_numpy(dtype="datetime64[ns]").astype("datetime64[M]").astype(np.int64)
+    months[na] = 0
+    return pd.Series(pd.arrays.IntegerArray(months.astype(np.int32), na), index=dates.index)
+
+
+def format_month(v) -> str:
+    """_month の値を表示用の "YYYY-MM" にする"""
+    if v is None or v is pd.NA or (isinstance(v, float) and np.isnan(v)):
+        return "不明"
+    if isinstance(v, (int, np.integer)) or (isinstance(v, (float, np.floating)) and float(v).is_integer()):
+        return str(pd.Period(ordinal=int(v), freq="M"))
+    return str(v)
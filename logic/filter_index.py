@@ -0,0 +1,129 @@
+from __future__ import annotations
+import pandas as pd
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence
+
+# 値毎のビットマップを持つフィルタ対象の軸
+FILTER_DIMS = ["_month", "_sales_owner", "_asset_band", "_age_band"]
+
+# 1バイト毎の立っているビット数
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+@dataclass(frozen=True)
+class FilterIndex:
+    """フィルタ用のビットマップ索引
+
+    bitmaps[列][値] は np.packbits で詰めた行ビットマップ（1bit/行）。
+    欠損値の行は na_bitmaps[列] に分けて持つ（欠損がなければ None）。
+    """
+    n_rows: int
+    bitmaps: Dict[str, Dict[object, np.ndarray]]
+    na_bitmaps: Dict[str, Optional[np.ndarray]]
+
+
+def build_filter_index(df: pd.DataFrame, dims: Optional[Sequence[str]] = None) -> FilterIndex:
+    """preprocess済みデータから値毎のビットマップを作る"""
+    n = len(df)
+    bitmaps: Dict[str, Dict[object, np.ndarray]] = {}
+    na_bitmaps: Dict[str, Optional[np.ndarray]] = {}
+    for col in dims or FILTER_DIMS:
+        if col not in df.columns:
+            continue
+        codes, uniques = pd.factorize(df[col], sort=False)
+        order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        # 欠損(-1)はソート先頭に集まるので読み飛ばす
+        pos = int((codes < 0).sum())
+        bits = np.zeros(n, dtype=bool)
+        col_maps: Dict[object, np.ndarray] = {}
+        for i, value in enumerate(uniques):
+            rows = order[pos:pos + counts[i]]
+            bits[rows] = True
+            col_maps[value] = np.packbits(bits)
+            bits[rows] = False
+            pos += counts[i]
+        bitmaps[col] = col_maps
+        na_bitmaps[col] = np.packbits(codes < 0) if (codes < 0).any() else None
+    return FilterIndex(n_rows=n, bitmaps=bitmaps, na_bitmaps=na_bitmaps)
+
+
+def update_filter_index(index: FilterIndex, df: pd.DataFrame, rows: np.ndarray) -> FilterIndex:
+    """書き換え・追加した行（rows）のビットだけを付け直す
+
+    df は更新後の全行（rows 以外の行は読まない）。追加した行は rows に含め、
+    ビットマップは df の行数まで広げる。
+    """
+    nbytes = (len(df) + 7) // 8
+    rows = np.asarray(rows, dtype=np.int64)
+    byte = rows >> 3
+    # np.packbits と同じく各バイトの上位ビットが先頭の行
+    bit = (np.uint8(0x80) >> (rows & 7).astype(np.uint8)).astype(np.uint8)
+
+    def fresh(bm: Optional[np.ndarray]) -> np.ndarray:
+        out = np.zeros(nbytes, dtype=np.uint8)
+        if bm is not None:
+            out[:len(bm)] = bm
+            np.bitwise_and.at(out, byte, ~bit)
+        return out
+
+    bitmaps: Dict[str, Dict[object, np.ndarray]] = {}
+    na_bitmaps: Dict[str, Optional[np.ndarray]] = {}
+    for col, old_maps in index.bitmaps.items():
+        col_maps = {value: fresh(bm) for value, bm in old_maps.items()}
+        na_bm = index.na_bitmaps[col]
+        na_bm = fresh(na_bm) if na_bm is not None else None
+        codes, uniques = pd.factorize(df[col].iloc[rows], sort=False)
+        for i, value in enumerate(uniques):
+            sel = codes == i
+            bm = col_maps.setdefault(value, fresh(None))
+            np.bitwise_or.at(bm, byte[sel], bit[sel])
+        if (codes < 0).any():
+            na_bm = na_bm if na_bm is not None else fresh(None)
+            np.bitwise_or.at(na_bm, byte[codes < 0], bit[codes < 0])
+        bitmaps[col] = col_maps
+        na_bitmaps[col] = na_bm
+    return FilterIndex(n_rows=len(df), bitmaps=bitmaps, na_bitmaps=na_bitmaps)
+
+
+def select_rows(index: FilterIndex, selections: Dict[str, Sequence]) -> np.ndarray:
+    """列毎に選択値のビットマップをOR、列間をANDした行選択（packed）を返す"""
+    nbytes = (index.n_rows + 7) // 8
+    selected = np.packbits(np.ones(index.n_rows, dtype=bool))
+    for col, values in selections.items():
+        if values is None or col not in index.bitmaps:
+            continue
+        col_maps = index.bitmaps[col]
+        na_bm = index.na_bitmaps[col]
+        want_na = any(pd.isna(v) for v in values)
+        wanted = {v for v in values if not pd.isna(v)}
+        # 全値選択（欠損行も含む）なら絞り込み不要
+        if (na_bm is None or want_na) and wanted.issuperset(col_maps.keys()):
+            continue
+        acc = np.zeros(nbytes, dtype=np.uint8)
+        if want_na and na_bm is not None:
+            np.bitwise_or(acc, na_bm, out=acc)
+        for value in wanted:
+            bm = col_maps.get(value)
+            if bm is not None:
+                np.bitwise_or(acc, bm, out=acc)
+        np.bitwise_and(selected, acc, out=selected)
+    return selected
+
+
+def selection_count(selection: np.ndarray) -> int:
+    """選択行数"""
+    return int(_POPCOUNT[selection].sum(dtype=np.int64))
+
+
+def selection_mask(index: FilterIndex, selection: np.ndarray) -> np.ndarray:
+    """packed の行選択を bool マスクに展開"""
+    return np.unpackbits(selection, count=index.n_rows).astype(bool)
+
+
+def apply_selection(df: pd.DataFrame, index: FilterIndex, selection: np.ndarray) -> pd.DataFrame:
+    """行選択を適用した DataFrame（全行選択ならそのまま返す）"""
+    if selection_count(selection) == index.n_rows:
+        return df
+    return df[selection_mask(index, selection)]
@@ -0,0 +1,187 @@
+from __future__ import annotations
+import hashlib
+import time
+import pandas as pd
+import numpy as np
+from dataclasses import dataclass
+from pandas.api.types import CategoricalDtype, is_numeric_dtype
+from typing import Dict, Optional
+
+from logic.cube import FunnelCube, cube_upsert
+from logic.filter_index import FilterIndex, update_filter_index
+from logic.preprocess import _lead_ids, _memory_bytes, hashed_columns, preprocess, row_hashes
+
+
+@dataclass(frozen=True)
+class LeadIndex:
+    """リードID → 行位置のハッシュ索引（IDが重複する行は最後の行を指す。IDが空欄の行は持たない）"""
+    ids: pd.Index
+    rows: np.ndarray
+
+    def coerce(self, ids: pd.Series) -> pd.Series:
+        """IDを索引と同じ種類（数値 / 文字列）にそろえる（数値にできないIDは欠損）"""
+        if is_numeric_dtype(self.ids.dtype) and not is_numeric_dtype(ids.dtype):
+            return pd.to_numeric(ids, errors="coerce")
+        if not is_numeric_dtype(self.ids.dtype) and is_numeric_dtype(ids.dtype):
+            # 整数値の 12.0 は "12" にする
+            return _lead_ids((ids.astype("Int64") if (ids.dropna() % 1 == 0).all() else ids).astype("str"))
+        return ids
+
+    def lookup(self, ids: pd.Series) -> np.ndarray:
+        """ID毎の行位置（索引に無いIDは -1。ids は coerce 済み）"""
+        i = self.ids.get_indexer(ids)
+        return np.where(i >= 0, self.rows[np.maximum(i, 0)], -1)
+
+
+@dataclass(frozen=True)
+class UpsertResult:
+    """差分取り込みの結果（inserted / updated / unchanged / skipped は新しいエクスポートの行数）"""
+    df: pd.DataFrame
+    meta: Dict
+    cube: Optional[FunnelCube]
+    filter_index: Optional[FilterIndex]
+    lead_index: LeadIndex
+    inserted: int
+    updated: int
+    unchanged: int
+    skipped: int
+    seconds: float
+
+
+def build_lead_index(df: pd.DataFrame) -> LeadIndex:
+    """整備済みデータの _lead_id から索引を作る"""
+    if "_lead_id" not in df.columns:
+        raise ValueError("リードID列（No）をマッピングして整備したデータではありません")
+    ids = df["_lead_id"]
+    keep = ids.notna().to_numpy() & ~ids.duplicated(keep="last").to_numpy()
+    return LeadIndex(ids=pd.Index(ids[keep]), rows=np.flatnonzero(keep))
+
+
+def upsert_key(base_key: str, update_key: str) -> str:
+    """差分取り込み後のデータの識別子（元データのキー＋取り込んだエクスポートのキー）"""
+    return hashlib.sha256(f"{base_key}\0upsert\0{update_key}".encode("utf-8")).hexdigest()
+
+
+def _patch_column(old: pd.Series, pos: np.ndarray, changed: pd.Series, added: pd.Series) -> pd.Series:
+    """pos の行を changed で置き換え、added を末尾に足した列"""
+    dtype = old.dtype
+    if isinstance(dtype, CategoricalDtype):
+        # 既存のコードはそのまま使い、新しい値はカテゴリの末尾に足す
+        values = pd.concat([changed, added], ignore_index=True)
+        extra = pd.Index(values.dropna().unique()).difference(dtype.categories)
+        dtype = CategoricalDtype(dtype.categories.append(extra), ordered=dtype.ordered)
+        new_codes = dtype.categories.get_indexer(values)
+        codes = np.concatenate([old.cat.codes.to_numpy(), new_codes[len(changed):]])
+        codes[pos] = new_codes[:len(changed)]
+        return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), name=old.name)
+    # 置き換える値も一緒に連結して、3つの型をそろえた列にしてから書き込む
+    n = len(old) + len(added)
+    out = pd.concat([old, added, changed], ignore_index=True)
+    if len(pos):
+        out.iloc[pos] = out.iloc[n:].to_numpy()
+    return out.iloc[:n]
+
+
+def _patch_meta(meta: Dict, df: pd.DataFrame, old_rows: pd.DataFrame, new_rows: pd.DataFrame, added: pd.DataFrame, raw_bytes: int) -> Dict:
+    """件数・合計を差分で更新した meta（old_rows を抜いて new_rows を足す）"""
+    out = dict(meta)
+
+    def delta(col: str) -> float:
+        return float(new_rows[col].sum()) - float(old_rows[col].sum())
+
+    multi = round(meta.get("contrib_multi_touch_rate", 0.0) * meta.get("rows", 0))
+    multi += int((new_rows["_contrib_true_count"] >= 2).sum()) - int((old_rows["_contrib_true_count"] >= 2).sum())
+    out["rows"] = int(len(df))
+    out["won_count"] = int(meta["won_count"] + delta("_is_won"))
+    out["qualified_count"] = int(meta["qualified_count"] + delta("_is_qualified"))
+    out["revenue_sum"] = float(meta["revenue_sum"] + delta("_revenue"))
+    out["contrib_multi_touch_rate"] = multi / len(df) if len(df) else 0.0
+    # 期間は列の min / max だけなので全行から取り直す（ベクトル演算1回）
+    dates = df["_conv_date"]
+    out["date_range"] = (
+        f"{dates.min().strftime('%Y-%m-%d')} ~ {dates.max().strftime('%Y-%m-%d')}" if dates.notna().any() else ""
+    )
+    out["memory_raw_bytes"] = meta.get("memory_raw_bytes", 0) + raw_bytes
+    out["memory_bytes"] = meta.get("memory_bytes", 0) + _memory_bytes(added)
+    return out
+
+
+def upsert_leads(
+    df: pd.DataFrame,
+    meta: Dict,
+    df_raw: pd.DataFrame,
+    colmap: Dict[str, str],
+    cube: Optional[FunnelCube] = None,
+    filter_index: Optional[FilterIndex] = None,
+    lead_index: Optional[LeadIndex] = None,
+) -> UpsertResult:
+    """新しいエクスポート df_raw をリードIDで突き合わせ、整備済みデータに差分だけ取り込む
+
+    - 索引に無いIDの行は追加、あるIDは取り込み列の行ハッシュが変わった行だけ置き換える
+    - preprocess にかけるのは追加・変更行だけ。meta の件数・合計、キューブ、
+      フィルタ索引もその行の分だけ足し引きする（変更の無い行は再走査しない）
+    - IDが空欄の行は突き合わせられないので取り込まない（skipped）
+
+    列の書き換え・追加は pandas の列のコピー（memcpy）を伴うが、整備・集計のコストは
+    変わった行数に比例する。
+    """
+    t0 = time.perf_counter()
+    id_col = colmap.get("id")
+    if "_row_hash" not in df.columns or not id_col:
+        raise ValueError("リードID列（No）をマッピングして整備したデータだけ差分取り込みできます")
+    if id_col not in df_raw.columns:
+        raise ValueError(f"新しいエクスポートにID列（{id_col}）がありません")
+    lead_index = lead_index if lead_index is not None else build_lead_index(df)
+
+    ids = lead_index.coerce(_lead_ids(df_raw[id_col]))
+    keep = ids.notna().to_numpy() & ~ids.duplicated(keep="last").to_numpy()
+    skipped = int(ids.isna().sum())
+    raw = df_raw[keep]
+    ids = ids[keep]
+
+    pos = lead_index.lookup(ids)
+    hashes = row_hashes(raw, hashed_columns(raw.columns, colmap))
+    stored = df["_row_hash"].to_numpy()
+    is_new = pos < 0
+    is_changed = ~is_new & (stored[np.maximum(pos, 0)] != hashes)
+    touched = is_new | is_changed
+
+    sub, sub_meta = preprocess(raw[touched], colmap, compact=bool(meta.get("compact", False)))
+    if set(sub.columns) != set(df.columns):
+        raise ValueError("列の構成が元のデータと違うため差分取り込みできません（全件を取り込み直してください）")
+    sub = sub[df.columns].reset_index(drop=True)
+    sub["_lead_id"] = ids[touched].to_numpy()
+    changed_rows = sub[is_changed[touched]]
+    added_rows = sub[is_new[touched]]
+    upd_pos = pos[is_changed]
+
+    old_rows = df.iloc[upd_pos]
+    out = pd.DataFrame({
+        c: _patch_column(df[c], upd_pos, changed_rows[c], added_rows[c]) for c in df.columns
+    })
+    new_pos = np.arange(len(df), len(out))
+    new_meta = _patch_meta(meta, out, old_rows, sub, out.iloc[new_pos], sub_meta.get("memory_raw_bytes", 0))
+
+    if len(added_rows):
+        lead_index = LeadIndex(
+            ids=lead_index.ids.append(pd.Index(ids[is_new])),
+            rows=np.concatenate([lead_index.rows, new_pos]),
+        )
+    rewritten = np.concatenate([upd_pos, new_pos])
+    if cube is not None:
+        cube = cube_upsert(cube, old_rows, out.iloc[rewritten])
+    if filter_index is not None:
+        filter_index = update_filter_index(filter_index, out, rewritten)
+
+    return UpsertResult(
+        df=out,
+        meta=new_meta,
+        cube=cube,
+        filter_index=filter_index,
+        lead_index=lead_index,
+        inserted=int(is_new.sum()),
+        updated=int(is_changed.sum()),
+        unchanged=int((~touched).sum()),
+        skipped=skipped,
+        seconds=time.perf_counter() - t0,
+    )
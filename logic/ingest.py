@@ -0,0 +1,97 @@
+from __future__ import annotations
+import io
+import pandas as pd
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from logic.schema import CONTRIB_COL_CANDIDATES
+
+
+def is_xlsx(data: bytes) -> bool:
+    """xlsx（zip）かどうか。旧形式の .xls は pandas 経由で読む"""
+    return data[:2] == b"PK"
+
+
+def _open_workbook(data: bytes):
+    from openpyxl import load_workbook
+
+    return load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+
+
+def _header_names(raw: Iterable) -> List[str]:
+    """pd.read_excel と同じ規則で列名を作る（空欄は Unnamed: i、重複は .1, .2 …）"""
+    names: List[str] = []
+    seen: Dict[str, int] = {}
+    for i, v in enumerate(raw):
+        name = f"Unnamed: {i}" if v is None or str(v) == "" else str(v)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def sheet_names(data: bytes) -> List[str]:
+    """シート名一覧（ワークブック定義だけを読む）"""
+    if not is_xlsx(data):
+        return list(pd.ExcelFile(io.BytesIO(data)).sheet_names)
+    wb = _open_workbook(data)
+    try:
+        return list(wb.sheetnames)
+    finally:
+        wb.close()
+
+
+def read_preview(data: bytes, sheet: str, nrows: int = 15) -> Tuple[pd.DataFrame, Optional[int]]:
+    """先頭 nrows 行のプレビューとシートの行数（不明なら None）"""
+    if not is_xlsx(data):
+        df = pd.read_excel(io.BytesIO(data), sheet_name=sheet)
+        return df.head(nrows), len(df)
+
+    wb = _open_workbook(data)
+    try:
+        ws = wb[sheet]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame(), 0
+        body = [r for _, r in zip(range(nrows), rows)]
+        n_rows = ws.max_row - 1 if ws.max_row else None
+    finally:
+        wb.close()
+    return pd.DataFrame(body, columns=_header_names(header)).infer_objects(), n_rows
+
+
+def ingest_columns(columns: List[str], colmap: Dict[str, str]) -> List[str]:
+    """取り込む列（マッピング済みの列＋貢献フラグ列）をシートの列順で返す"""
+    needed = set(colmap.values()) | set(CONTRIB_COL_CANDIDATES)
+    return [c for c in columns if c in needed]
+
+
+def read_sheet(data: bytes, sheet: str, usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """シートを読み込む（xlsx は read-only でストリームし、usecols の列だけ保持）"""
+    if not is_xlsx(data):
+        return pd.read_excel(io.BytesIO(data), sheet_name=sheet, usecols=usecols)
+
+    wb = _open_workbook(data)
+    try:
+        rows = wb[sheet].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame(columns=usecols or [])
+        names = _header_names(header)
+        keep = [i for i, c in enumerate(names) if usecols is None or c in usecols]
+        cols: List[list] = [[] for _ in keep]
+        for r in rows:
+            # 全セル空の行は read_excel 同様に読み飛ばす
+            if all(v is None for v in r):
+                continue
+            # 末尾の空セルは省略されることがあるので長さを見て取る
+            for out, i in zip(cols, keep):
+                out.append(r[i] if i < len(r) else None)
+    finally:
+        wb.close()
+
+    df = pd.DataFrame({names[i]: pd.Series(v, dtype=object) for i, v in zip(keep, cols)})
+    return df.infer_objects()
@@ -1,10 +1,32 @@
 from __future__ import annotations
 import pandas as pd
 import numpy as np
-from typing import Dict
+from typing import Dict, List, Sequence, Tuple, Union
 
+from logic.backend import ParquetSource, map_batches
 
-def funnel_kpis(df: pd.DataFrame) -> Dict[str, float]:
+# group_funnel / funnel_kpis が返すKPI列（この順序で出力）
+KPI_COLS = [
+    "leads",
+    "qualified",
+    "won",
+    "qualified_rate",
+    "won_rate",
+    "won_rate_in_qualified",
+    "revenue_sum",
+    "median_ticket",
+    "mean_ticket",
+]
+
+
+# ファネルKPIの集計に使う行の列
+_FUNNEL_INPUTS = ["_is_qualified", "_is_won", "_revenue"]
+
+
+def funnel_kpis(df: Union[pd.DataFrame, ParquetSource]) -> Dict[str, float]:
+    if isinstance(df, ParquetSource):
+        t = _stream_group_funnel(df, [], observed=True)
+        return {col: float(t[col].iloc[0]) if len(t) else 0.0 for col in KPI_COLS}
     n = len(df)
     q = int(df["_is_qualified"].sum())
     w = int(df["_is_won"].sum())
@@ -32,39 +54,206 @@ def funnel_kpis(df: pd.DataFrame) -> Dict[str, float]:
     }
 
 
-def group_funnel(df: pd.DataFrame, group_col: str) -> pd.DataFrame:
-    results = []
-    for name, grp in df.groupby(group_col, dropna=False, observed=False):
-        row = funnel_kpis(grp)
-        row[group_col] = name
-        results.append(row)
-    out = pd.DataFrame(results)
-    if group_col in out.columns:
-        cols = [group_col] + [c for c in out.columns if c != group_col]
-        out = out[cols]
+def _safe_div(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    num = np.asarray(num, dtype=float)
+    den = np.asarray(den, dtype=float)
+    out = np.zeros(np.broadcast(num, den).shape)
+    np.divide(num, den, out=out, where=den > 0)
+    return out
+
+
+def _group_median(codes: np.ndarray, values: np.ndarray, ngroups: int) -> np.ndarray:
+    """グループ毎の中央値を1回のソートでまとめて計算（空グループは0）"""
+    out = np.zeros(ngroups)
+    if len(values) == 0:
+        return out
+    order = np.lexsort((values, codes))
+    sv = values[order]
+    counts = np.bincount(codes, minlength=ngroups)
+    starts = np.cumsum(counts) - counts
+    has = counts > 0
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    out[has] = (sv[lo] + sv[hi]) / 2.0
     return out
 
 
-def pivot_segment(df: pd.DataFrame, row: str, col: str, metric: str) -> pd.DataFrame:
-    results = []
-    for (r, c), grp in df.groupby([row, col], dropna=False, observed=True):
-        kpi = funnel_kpis(grp)
-        kpi[row] = r
-        kpi[col] = c
-        results.append(kpi)
-    tmp = pd.DataFrame(results)
+def kpis_from_counts(
+    leads,
+    qualified,
+    won,
+    won_in_qualified,
+    revenue_sum,
+    won_revenue_sum,
+    median_ticket,
+) -> pd.DataFrame:
+    """集計済みカウントからKPI列（KPI_COLS順）を一括で組み立てる"""
+    leads = np.asarray(leads, dtype=float)
+    qualified = np.asarray(qualified, dtype=float)
+    won = np.asarray(won, dtype=float)
+    return pd.DataFrame({
+        "leads": leads,
+        "qualified": qualified,
+        "won": won,
+        "qualified_rate": _safe_div(qualified, leads),
+        "won_rate": _safe_div(won, leads),
+        "won_rate_in_qualified": _safe_div(won_in_qualified, qualified),
+        "revenue_sum": np.asarray(revenue_sum, dtype=float),
+        "median_ticket": np.asarray(median_ticket, dtype=float),
+        "mean_ticket": _safe_div(won_revenue_sum, won),
+    })
+
+
+def _full_key_index(keys: pd.Index, df: pd.DataFrame, cols: List[str]) -> pd.Index:
+    """observed=False 相当の全カテゴリ組合せ（空グループを含む）インデックス"""
+    levels = []
+    for i, c in enumerate(cols):
+        observed_vals = keys.get_level_values(i) if len(cols) > 1 else keys
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            vals = list(df[c].cat.categories)
+            if observed_vals.isna().any():
+                vals.append(np.nan)
+        else:
+            vals = list(observed_vals.unique())
+        levels.append(vals)
+    if len(cols) == 1:
+        return pd.Index(levels[0], name=cols[0])
+    return pd.MultiIndex.from_product(levels, names=cols)
+
+
+def _group_codes(frame: pd.DataFrame, cols: List[str]) -> Tuple[np.ndarray, pd.Index]:
+    """観測されたグループのコード（行毎）とキーのインデックス"""
+    g = frame.groupby(cols if len(cols) > 1 else cols[0], dropna=False, observed=True, sort=True)
+    return g.ngroup().to_numpy(), g.size().index
+
+
+def _finish_group_table(
+    out: pd.DataFrame,
+    keys: pd.Index,
+    frame: pd.DataFrame,
+    cols: List[str],
+    observed: bool,
+) -> pd.DataFrame:
+    out.index = keys
+    # 空カテゴリはKPIがすべて0になるだけなので、集計後にインデックスを広げて補完
+    if not observed and any(isinstance(frame[c].dtype, pd.CategoricalDtype) for c in cols):
+        out = out.reindex(_full_key_index(keys, frame, cols), fill_value=0.0)
+    out = out.reset_index()
+    # キー列は元の型（カテゴリ・nullable整数など）に戻す
+    for c in cols:
+        if out[c].dtype != frame[c].dtype:
+            out[c] = out[c].astype(frame[c].dtype)
+    return out[cols + KPI_COLS]
+
+
+def _chunk_counts(chunk: pd.DataFrame, cols: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """チャンクのグループ別カウント（チャンク間で足し合わせる）と、中央値用の成約行のキー・売上"""
+    if cols:
+        codes, keys = _group_codes(chunk, cols)
+    else:
+        codes, keys = np.zeros(len(chunk), dtype=np.int64), pd.Index([0])
+    n = len(keys)
+    is_q = chunk["_is_qualified"].to_numpy(dtype=bool)
+    is_w = chunk["_is_won"].to_numpy(dtype=bool)
+    rev = chunk["_revenue"].to_numpy(dtype=float)
+    counts = pd.DataFrame({
+        "leads": np.bincount(codes, minlength=n),
+        "qualified": np.bincount(codes, weights=is_q, minlength=n).astype(np.int64),
+        "won": np.bincount(codes[is_w], minlength=n),
+        "won_in_qualified": np.bincount(codes, weights=is_w & is_q, minlength=n).astype(np.int64),
+        "revenue_sum": np.bincount(codes, weights=rev, minlength=n),
+        "won_revenue_sum": np.bincount(codes[is_w], weights=rev[is_w], minlength=n),
+    }, index=keys)
+    return counts, chunk.loc[is_w, cols + ["_revenue"]]
+
+
+def _stream_group_funnel(source: ParquetSource, cols: List[str], observed: bool) -> pd.DataFrame:
+    """group_funnel の Parquet 版（チャンク毎のカウントを足し合わせ、中央値は成約行だけを集めて計算）
+
+    件数は厳密に一致し、売上の合計も金額が整数（円）なら pandas 版と同じ値になる。
+    メモリに載るのはチャンクとグループ別の集計、成約行の売上だけ。
+    """
+    parts, won_parts = [], []
+    for counts, won in map_batches(source, cols + _FUNNEL_INPUTS, lambda chunk: _chunk_counts(chunk, cols)):
+        parts.append(counts)
+        won_parts.append(won)
+    if not parts or sum(len(p) for p in parts) == 0:
+        return pd.DataFrame(columns=cols + KPI_COLS)
+
+    levels = list(range(len(cols))) if cols else 0
+    total = pd.concat(parts).groupby(level=levels, dropna=False, observed=True, sort=True).sum()
+    keys = total.index
+
+    won = pd.concat(won_parts)
+    if len(won):
+        wcodes, wkeys = _group_codes(won, cols) if cols else (np.zeros(len(won), dtype=np.int64), pd.Index([0]))
+        medians = _group_median(wcodes, won["_revenue"].to_numpy(dtype=float), len(wkeys))
+        median_ticket = pd.Series(medians, index=wkeys).reindex(keys, fill_value=0.0).to_numpy()
+    else:
+        median_ticket = np.zeros(len(keys))
+
+    out = kpis_from_counts(
+        leads=total["leads"],
+        qualified=total["qualified"],
+        won=total["won"],
+        won_in_qualified=total["won_in_qualified"],
+        revenue_sum=total["revenue_sum"],
+        won_revenue_sum=total["won_revenue_sum"],
+        median_ticket=median_ticket,
+    )
+    if not cols:
+        return out
+    return _finish_group_table(out, keys, source.schema, cols, observed)
+
+
+def group_funnel(
+    df: Union[pd.DataFrame, ParquetSource],
+    group_col: Union[str, Sequence[str]],
+    observed: bool = False,
+) -> pd.DataFrame:
+    """グループ別ファネルKPI（groupby 1回＋ソート1回で全グループを集計。Parquet はチャンク毎に集計）"""
+    cols = [group_col] if isinstance(group_col, str) else list(group_col)
+    if isinstance(df, ParquetSource):
+        return _stream_group_funnel(df, cols, observed)
+    if len(df) == 0:
+        return pd.DataFrame(columns=cols + KPI_COLS)
+
+    codes, keys = _group_codes(df, cols)
+    ngroups = len(keys)
+
+    is_q = df["_is_qualified"].to_numpy(dtype=bool)
+    is_w = df["_is_won"].to_numpy(dtype=bool)
+    rev = df["_revenue"].to_numpy(dtype=float)
+
+    won_codes = codes[is_w]
+    won_rev = rev[is_w]
+    out = kpis_from_counts(
+        leads=np.bincount(codes, minlength=ngroups),
+        qualified=np.bincount(codes, weights=is_q, minlength=ngroups),
+        won=np.bincount(won_codes, minlength=ngroups),
+        won_in_qualified=np.bincount(codes, weights=is_w & is_q, minlength=ngroups),
+        revenue_sum=np.bincount(codes, weights=rev, minlength=ngroups),
+        won_revenue_sum=np.bincount(won_codes, weights=won_rev, minlength=ngroups),
+        median_ticket=_group_median(won_codes, won_rev, ngroups),
+    )
+    return _finish_group_table(out, keys, df, cols, observed)
+
+
+def pivot_segment(df: Union[pd.DataFrame, ParquetSource], row: str, col: str, metric: str) -> pd.DataFrame:
+    tmp = group_funnel(df, [row, col], observed=True)
     if len(tmp) == 0:
         return pd.DataFrame()
     p = tmp.pivot(index=row, columns=col, values=metric)
     return p
 
 
-def pivot_segment_count(df: pd.DataFrame, row: str, col: str) -> pd.DataFrame:
+def pivot_segment_count(df: Union[pd.DataFrame, ParquetSource], row: str, col: str) -> pd.DataFrame:
     """リード数のピボット（セグメントのサンプルサイズ確認用）"""
-    results = []
-    for (r, c), grp in df.groupby([row, col], dropna=False, observed=True):
-        results.append({row: r, col: c, "count": len(grp)})
-    tmp = pd.DataFrame(results)
+    if isinstance(df, ParquetSource):
+        tmp = _stream_group_funnel(df, [row, col], observed=True)
+        tmp["count"] = tmp["leads"].astype(int)
+    else:
+        tmp = df.groupby([row, col], dropna=False, observed=True).size().rename("count").reset_index()
     if len(tmp) == 0:
         return pd.DataFrame()
     p = tmp.pivot(index=row, columns=col, values="count").fillna(0).astype(int)
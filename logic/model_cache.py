@@ -0,0 +1,107 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from logic.dataset_cache import evict
+
+# 既定の置き場（環境変数で上書き可）
+DEFAULT_MODEL_CACHE_DIR = Path(
+    os.environ.get("MARKETING_APP_MODEL_CACHE_DIR", Path.home() / ".cache" / "marketing_app" / "models")
+)
+# ディスク上の合計サイズの上限（超えたら最終アクセスが古いものから削除）
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+# メモリに置いておく件数（最近使ったものから）
+MEMORY_ENTRIES = 32
+
+# 学習の中身（ハイパーパラメータの既定値・重要度の定義など）が変わったら上げる
+MODEL_CACHE_VERSION = 3
+
+_SUFFIX = ".pkl"
+
+_memory: "OrderedDict[str, Dict]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def model_key(dataset_id: str, features: List[str], target: str, params: Dict) -> str:
+    """データの識別子＋特徴量（順序込み）＋目的変数＋ハイパーパラメータから作るキー"""
+    payload = {
+        "dataset": dataset_id,
+        "features": list(features),
+        "target": target,
+        "params": params,
+        "v": MODEL_CACHE_VERSION,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _cache_dir(cache_dir: Optional[Union[str, Path]]) -> Path:
+    return Path(cache_dir) if cache_dir is not None else DEFAULT_MODEL_CACHE_DIR
+
+
+def _remember(key: str, result: Dict) -> None:
+    with _lock:
+        _memory[key] = result
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def load_result(key: str, cache_dir: Optional[Union[str, Path]] = None) -> Optional[Dict]:
+    """キャッシュ済みの結果（なければ None）。メモリになければディスクから読んでメモリに載せる"""
+    with _lock:
+        result = _memory.get(key)
+        if result is not None:
+            _memory.move_to_end(key)
+            return result
+
+    path = _cache_dir(cache_dir) / f"{key}{_SUFFIX}"
+    if not path.exists():
+        return None
+    try:
+        with open(path, "rb") as f:
+            result = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        # 壊れたファイルや互換性のない版のモデルは無かったことにする
+        return None
+    # LRU 用に最終アクセス時刻を更新
+    os.utime(path)
+    _remember(key, result)
+    return result
+
+
+def store_result(
+    key: str,
+    result: Dict,
+    cache_dir: Optional[Union[str, Path]] = None,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> Path:
+    """結果をメモリとディスクに保存し、ディスクは上限サイズまで古いものを削除"""
+    _remember(key, result)
+
+    root = _cache_dir(cache_dir)
+    root.mkdir(parents=True, exist_ok=True)
+    path = root / f"{key}{_SUFFIX}"
+    fd, tmp = tempfile.mkstemp(dir=root, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    evict(root, max_bytes=max_bytes, keep=path, suffix=_SUFFIX)
+    return path
+
+
+def clear_memory() -> None:
+    """メモリ上のキャッシュだけを捨てる（ディスクは残す）"""
+    with _lock:
+        _memory.clear()
@@ -1,81 +1,606 @@
 from __future__ import annotations
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
-from typing import Dict, List, Tuple, Optional
-from sklearn.ensemble import GradientBoostingClassifier, GradientBoostingRegressor
-from sklearn.preprocessing import LabelEncoder
-from sklearn.model_selection import cross_val_score
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, Iterator, List, Tuple, Optional
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.ensemble import (
+    GradientBoostingClassifier,
+    GradientBoostingRegressor,
+    HistGradientBoostingClassifier,
+    HistGradientBoostingRegressor,
+)
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import check_cv
+
+from logic.model_cache import load_result, model_key, store_result
 import warnings
 
 warnings.filterwarnings("ignore")
 
+# 学習エンジン（gbm は従来の厳密分割 GBM で、結果の基準として残す）
+MODEL_ENGINES: Dict[str, str] = {
+    "hist": "ヒストグラムGBM（高速・カテゴリ対応）",
+    "gbm": "勾配ブースティング（厳密分割・基準）",
+}
+# Drivers の3モデルと CV スコアの列名
+DRIVER_MODELS: Dict[str, str] = {
+    "qualified": "auc_cv",
+    "won": "auc_cv",
+    "revenue": "r2_cv",
+}
+# スコアリングで付ける列（モデル名 → 列名）
+SCORE_COLUMNS: Dict[str, str] = {
+    "qualified": "_p_qualified",
+    "won": "_p_won",
+}
+# スコアリングで1回に符号化・予測する行数
+SCORE_CHUNK_ROWS = 100_000
+# 分割ゲインを読めないときの置換重要度で使う最大行数
+PERMUTATION_MAX_ROWS = 20_000
+# ヒストグラムGBMでカテゴリとして扱える最大水準数（max_bins 以下）
+_HIST_MAX_CATEGORIES = 255
+
+# 交絡チェックで1つずつ外すチャネル列
+_UTM_FEATURES = ("_utm_source", "_utm_campaign", "_utm_medium", "_utm_content")
+
+# 水準数の多いカテゴリ列の扱い（水準数が max_levels を超える列だけに適用）
+CARDINALITY_STRATEGIES: Dict[str, str] = {
+    "label": "そのまま（ラベル符号化）",
+    "topk": "上位K水準＋その他",
+    "target": "ターゲットエンコーディング（交差適合）",
+    "hash": "ハッシュ（Kバケット）",
+}
+# 既定の K（上位の水準数・ハッシュのバケット数）
+HIGH_CARDINALITY_LEVELS = 30
+# ターゲットエンコーディングの分割数と平滑化の強さ（事前平均を何件ぶんとして混ぜるか）
+TARGET_FOLDS = 5
+TARGET_SMOOTHING = 20.0
+
+
+@dataclass(frozen=True)
+class FeatureMatrix:
+    """Drivers の3モデルで共有するエンコード済み特徴量
+
+    X は全行×行列列の float32 行列（木モデルが内部で使う型）。カテゴリ列は
+    vocab[列] の位置（文字列のソート順 = LabelEncoder と同じ）を値に持つ。
+    各モデルは行番号で X の部分集合を学習に使い、列を再エンコードしない。
+
+    features は元の特徴量、columns / sources / column_target は行列の列毎の
+    名前・元の特徴量・専用のモデル（ターゲットエンコーディング列だけ、他は None）。
+    encoders は特徴量毎の符号化方法で、スコアリング時に同じ符号化をやり直すのに使う。
+    """
+    X: np.ndarray
+    columns: List[str]
+    vocab: Dict[str, List[str]]
+    features: List[str]
+    sources: List[str]
+    column_target: List[Optional[str]]
+    encoders: Dict[str, Dict]
+    cardinality: str = "label"
+    max_levels: int = 0
+
+    @property
+    def hist_categorical(self) -> np.ndarray:
+        """ヒストグラムGBMがカテゴリとして扱える列のマスク"""
+        return np.array([
+            t is None and c in self.vocab and len(self.vocab[c]) <= _HIST_MAX_CATEGORIES
+            for c, t in zip(self.columns, self.column_target)
+        ], dtype=bool)
+
+    def model_columns(self, model: str) -> Optional[np.ndarray]:
+        """そのモデルが使う列番号（全列なら None）。他モデル用のターゲットエンコーディング列を除く"""
+        if all(t is None for t in self.column_target):
+            return None
+        return np.array([i for i, t in enumerate(self.column_target) if t is None or t == model], dtype=np.intp)
+
+    def schema(self) -> "FeatureMatrix":
+        """行を持たない写し（学習結果と一緒に保存してスコアリングの符号化に使う）"""
+        return replace(self, X=self.X[:0])
+
+
+def _is_categorical(s: pd.Series) -> bool:
+    return isinstance(s.dtype, pd.CategoricalDtype) or s.dtype == object or pd.api.types.is_string_dtype(s)
+
+
+def _labels(s: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """(行 → ユニーク値のコード, ユニーク値の文字列ラベル)。文字列化はユニーク値だけ"""
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    return codes, pd.Series(uniques).astype(str).fillna("__missing__").to_numpy(dtype=object)
+
+
+def _encode_labels(s: pd.Series) -> Tuple[np.ndarray, List[str]]:
+    """文字列化したラベルのソート順コードと語彙"""
+    codes, labels = _labels(s)
+    vocab = sorted(set(labels))
+    lookup = np.searchsorted(np.array(vocab, dtype=object), labels)
+    return lookup[codes], vocab
+
+
+def _lookup(labels: np.ndarray, known: List[str], missing: int = -1) -> np.ndarray:
+    """ラベル → ソート済み語彙 known での位置（無ければ missing）"""
+    if not len(known):
+        return np.full(len(labels), missing)
+    arr = np.array(known, dtype=object)
+    pos = np.minimum(np.searchsorted(arr, labels), len(arr) - 1)
+    return np.where(arr[pos] == labels, pos, missing)
+
+
+def _encode_with_vocab(s: pd.Series, vocab: List[str]) -> np.ndarray:
+    """学習時の語彙でコード化する（語彙にない値は -1 = 欠損扱い）"""
+    codes, labels = _labels(s)
+    return _lookup(labels, vocab)[codes]
+
+
+def _encode_topk(s: pd.Series, levels: List[str]) -> np.ndarray:
+    """上位の水準はそのコード、それ以外（学習時に無かった値を含む）は「その他」= len(levels)"""
+    codes, labels = _labels(s)
+    return _lookup(labels, levels, missing=len(levels))[codes]
+
+
+def _encode_hash(s: pd.Series, buckets: int) -> np.ndarray:
+    """ラベル文字列のハッシュを buckets 個のバケットに落とす（固定キーなので実行間で同じ）"""
+    codes, labels = _labels(s)
+    return (pd.util.hash_array(labels) % np.uint64(buckets)).astype(np.int64)[codes]
 
-def _prepare_features(
+
+def _driver_targets(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """ターゲットエンコーディングに使う各モデルの目的変数（そのモデルの対象外の行は NaN）"""
+    qualified = (df["_is_qualified"] == True).to_numpy()
+    won = (df["_is_won"] == True).to_numpy()
+    revenue = np.log1p(pd.to_numeric(df["_revenue"], errors="coerce").to_numpy(dtype=float, na_value=np.nan))
+    return {
+        "qualified": qualified.astype(float),
+        "won": np.where(qualified, won.astype(float), np.nan),
+        "revenue": np.where(won, revenue, np.nan),
+    }
+
+
+def _smoothed_means(codes: np.ndarray, y: np.ndarray, n_levels: int, prior: float) -> np.ndarray:
+    ok = ~np.isnan(y)
+    sums = np.bincount(codes[ok], y[ok], minlength=n_levels)
+    counts = np.bincount(codes[ok], minlength=n_levels)
+    return (sums + prior * TARGET_SMOOTHING) / (counts + TARGET_SMOOTHING)
+
+
+def _target_encode(codes: np.ndarray, y: np.ndarray, n_levels: int) -> Tuple[np.ndarray, np.ndarray, float]:
+    """交差適合のターゲットエンコーディング
+
+    各行は自分を含まない分割（TARGET_FOLDS 分割）の平均で符号化する（自分の目的変数が漏れない）。
+    全行での平均（スコアリング用の表）と事前平均も返す。
+    """
+    ok = ~np.isnan(y)
+    prior = float(y[ok].mean()) if ok.any() else 0.0
+    fold = np.random.RandomState(42).permutation(len(codes)) % TARGET_FOLDS
+    out = np.empty(len(codes))
+    for f in range(TARGET_FOLDS):
+        rows = fold == f
+        other = ~rows & ok
+        p = float(y[other].mean()) if other.any() else prior
+        out[rows] = _smoothed_means(codes[~rows], y[~rows], n_levels, p)[codes[rows]]
+    return out, _smoothed_means(codes, y, n_levels, prior), prior
+
+
+def _cardinality_key(cardinality: str, max_levels: int) -> Tuple[str, int]:
+    """水準数の設定の正規化（ラベル符号化なら K は使わないので 0）"""
+    if cardinality not in CARDINALITY_STRATEGIES:
+        raise ValueError(f"unknown cardinality strategy: {cardinality}")
+    return cardinality, 0 if cardinality == "label" else max(2, int(max_levels))
+
+
+def _matches(fm: Optional[FeatureMatrix], cols: List[str], cardinality: str, max_levels: int, subset: bool = False) -> bool:
+    """渡された FeatureMatrix をそのまま使えるか（同じ特徴量・同じ水準数の設定）"""
+    if fm is None or (fm.cardinality, fm.max_levels) != _cardinality_key(cardinality, max_levels):
+        return False
+    return set(cols) <= set(fm.features) if subset else fm.features == cols
+
+
+def encode_features(
     df: pd.DataFrame,
     feature_cols: List[str],
-    target_col: str,
-) -> Tuple[Optional[pd.DataFrame], Optional[pd.Series], Dict[str, LabelEncoder]]:
-    """特徴量をエンコードして返す"""
-    sub = df[feature_cols + [target_col]].dropna(subset=[target_col]).copy()
-    if len(sub) < 30:
-        return None, None, {}
+    cardinality: str = "label",
+    max_levels: int = HIGH_CARDINALITY_LEVELS,
+    like: Optional[FeatureMatrix] = None,
+) -> FeatureMatrix:
+    """特徴量を1回だけエンコードする（カテゴリ列はコード、数値列は欠損0）
 
-    encoders = {}
-    X_encoded = pd.DataFrame(index=sub.index)
+    水準数が max_levels を超えるカテゴリ列は cardinality（CARDINALITY_STRATEGIES）で扱う。
+    like（学習時の FeatureMatrix か schema()）を渡すと、その符号化で新しいデータを
+    符号化する（スコアリング用。学習時に無かった値は欠損・その他・事前平均になる）。
+    """
+    if like is not None:
+        feature_cols, cardinality, max_levels = like.features, like.cardinality, like.max_levels
+    cardinality, max_levels = _cardinality_key(cardinality, max_levels)
+    cols = [c for c in feature_cols if c in df.columns]
+    targets = None
 
-    for col in feature_cols:
-        if col not in sub.columns:
-            continue
-        s = sub[col]
-        if hasattr(s.dtype, "categories") or s.dtype == object or s.dtype.name == "category":
-            le = LabelEncoder()
-            vals = s.astype(str).fillna("__missing__")
-            X_encoded[col] = le.fit_transform(vals)
-            encoders[col] = le
+    blocks: List[np.ndarray] = []
+    columns: List[str] = []
+    sources: List[str] = []
+    column_target: List[Optional[str]] = []
+    vocab: Dict[str, List[str]] = {}
+    encoders: Dict[str, Dict] = {}
+
+    def add(col: str, values: np.ndarray, target: Optional[str] = None) -> None:
+        blocks.append(np.asarray(values, dtype=np.float32))
+        columns.append(col)
+        sources.append(col)
+        column_target.append(target)
+
+    for col in cols:
+        s = df[col]
+        if like is not None:
+            enc = like.encoders[col]
+        elif not _is_categorical(s):
+            enc = {"kind": "numeric"}
         else:
-            X_encoded[col] = pd.to_numeric(s, errors="coerce").fillna(0)
+            codes, labels = _labels(s)
+            n_levels = len(set(labels))
+            if cardinality == "label" or n_levels <= max_levels:
+                enc = {"kind": "label"}
+            elif cardinality == "topk":
+                counts = pd.Series(np.bincount(codes, minlength=len(labels)), index=labels).groupby(level=0).sum()
+                top = counts.sort_index().sort_values(ascending=False, kind="stable").index[:max_levels - 1]
+                enc = {"kind": "topk", "levels": sorted(top)}
+            elif cardinality == "hash":
+                enc = {"kind": "hash", "buckets": max_levels}
+            else:
+                if targets is None:
+                    targets = _driver_targets(df)
+                enc = {"kind": "target", "labels": sorted(set(labels)), "tables": {}, "priors": {}}
+                level = _lookup(labels, enc["labels"])[codes]
+                for model, y in targets.items():
+                    oof, table, prior = _target_encode(level, y, len(enc["labels"]))
+                    enc["tables"][model], enc["priors"][model] = table, prior
+                    add(col, oof, model)
+                encoders[col] = enc
+                continue
+        encoders[col] = enc
 
-    y = sub[target_col]
-    return X_encoded, y, encoders
+        kind = enc["kind"]
+        if kind == "numeric":
+            add(col, pd.to_numeric(s, errors="coerce").fillna(0).to_numpy(dtype=np.float32, na_value=0))
+        elif kind == "label":
+            if like is None:
+                values, enc["vocab"] = _encode_labels(s)
+            else:
+                values = _encode_with_vocab(s, enc["vocab"])
+            add(col, values)
+            vocab[col] = enc["vocab"]
+        elif kind == "topk":
+            add(col, _encode_topk(s, enc["levels"]))
+            vocab[col] = enc["levels"] + ["__other__"]
+        elif kind == "hash":
+            add(col, _encode_hash(s, enc["buckets"]))
+            vocab[col] = [f"#{i}" for i in range(enc["buckets"])]
+        elif kind == "target":
+            codes, labels = _labels(s)
+            level = _lookup(labels, enc["labels"])[codes]
+            for model, table in enc["tables"].items():
+                # 学習時に無かった値は事前平均
+                values = np.append(table, enc["priors"][model])[level]
+                add(col, values, model)
 
+    X = np.column_stack(blocks) if blocks else np.empty((len(df), 0), dtype=np.float32)
+    return FeatureMatrix(
+        X=np.ascontiguousarray(X, dtype=np.float32),
+        columns=columns,
+        vocab=vocab,
+        features=cols,
+        sources=sources,
+        column_target=column_target,
+        encoders=encoders,
+        cardinality=cardinality,
+        max_levels=max_levels,
+    )
 
-def feature_importance_classification(
-    df: pd.DataFrame,
-    feature_cols: List[str],
-    target_col: str,
-    n_estimators: int = 100,
-) -> Optional[pd.DataFrame]:
-    """分類（Qualified/成約の0/1）の特徴量重要度"""
-    X, y, encoders = _prepare_features(df, feature_cols, target_col)
-    if X is None or y is None:
+
+def _make_model(task: str, engine: str, n_estimators: int, categorical: Optional[np.ndarray] = None):
+    if engine == "gbm":
+        cls = GradientBoostingClassifier if task == "classification" else GradientBoostingRegressor
+        return cls(n_estimators=n_estimators, max_depth=3, learning_rate=0.1, random_state=42)
+    if engine == "hist":
+        cls = HistGradientBoostingClassifier if task == "classification" else HistGradientBoostingRegressor
+        return cls(
+            max_iter=n_estimators,
+            max_depth=3,
+            learning_rate=0.1,
+            categorical_features=categorical if categorical is not None and categorical.any() else None,
+            early_stopping=False,
+            random_state=42,
+        )
+    raise ValueError(f"unknown engine: {engine}")
+
+
+def _split_gain_importance(model, n_features: int) -> np.ndarray:
+    """ヒストグラムGBMの分割ゲインを特徴量毎に合計して正規化（GBM の feature_importances_ 相当）
+
+    HistGradientBoosting は feature_importances_ を持たず、置換重要度は予測を
+    特徴量×反復回数ぶん繰り返して学習より重くなるので、学習済みの木から集計する。
+    木は sklearn の非公開の属性（_predictors / nodes）なので、構造が変わって読めなければ
+    ValueError を出す（呼び出し側で置換重要度に切り替える）。
+    """
+    gain = np.zeros(n_features)
+    try:
+        for trees in model._predictors:
+            for tree in trees:
+                nodes = tree.nodes[~tree.nodes["is_leaf"].astype(bool)]
+                np.add.at(gain, nodes["feature_idx"], nodes["gain"])
+    except (AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+        raise ValueError(f"ヒストグラムGBMの木を読めません: {type(e).__name__}: {e}") from e
+    total = gain.sum()
+    return gain / total if total > 0 else gain
+
+
+def _permutation_importance(model, X: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """置換重要度（負の値は 0 にして正規化。重いので最大 PERMUTATION_MAX_ROWS 行で測る）"""
+    from sklearn.inspection import permutation_importance
+
+    if len(X) > PERMUTATION_MAX_ROWS:
+        rows = np.random.RandomState(42).choice(len(X), PERMUTATION_MAX_ROWS, replace=False)
+        X, y = X[rows], y[rows]
+    # 正例の少ない分類は正解率だとほぼ動かないので、CV と同じ AUC / R2 で測る
+    scoring = "roc_auc" if hasattr(model, "predict_proba") and len(np.unique(y)) == 2 else "r2"
+    result = permutation_importance(model, X, y, scoring=scoring, n_repeats=3, random_state=42)
+    imp = np.clip(result.importances_mean, 0, None)
+    total = imp.sum()
+    return imp / total if total > 0 else imp
+
+
+def _hist_importance(model, X: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """ヒストグラムGBMの重要度（分割ゲイン。sklearn の内部が変わって読めなければ置換重要度）"""
+    try:
+        return _split_gain_importance(model, X.shape[1])
+    except ValueError:
+        return _permutation_importance(model, X, y)
+
+
+# 共有行列のメモリマップ（ワーカープロセス毎に開いたものを使い回す）
+_SHARED: Dict[str, np.ndarray] = {}
+
+
+@contextmanager
+def _share_matrix(X: np.ndarray, n_jobs: Optional[int]):
+    """並列実行では X を一時 .npy に1回だけ書き出し、ジョブにはパスだけを渡す
+
+    ワーカーはメモリマップで開くので、ジョブ毎に X を pickle して送らずに済む。
+    """
+    if n_jobs == 1:
+        yield X
+        return
+    with tempfile.TemporaryDirectory(prefix="drivers_") as d:
+        path = os.path.join(d, "X.npy")
+        np.save(path, X)
+        yield path
+
+
+def _shared_array(X) -> np.ndarray:
+    if not isinstance(X, str):
+        return X
+    arr = _SHARED.get(X)
+    if arr is None:
+        # 前回の実行で開いた行列は手放す
+        _SHARED.clear()
+        arr = _SHARED[X] = np.load(X, mmap_mode="r")
+    return arr
+
+
+def _take(X, rows: Optional[np.ndarray], cols: Optional[np.ndarray]) -> np.ndarray:
+    """共有行列から学習に使う行・列を取り出す"""
+    X = _shared_array(X)
+    if rows is not None:
+        X = X[rows]
+    if cols is not None:
+        X = X[:, cols]
+    return X
+
+
+def _fit_full(model, X, rows: Optional[np.ndarray], cols: Optional[np.ndarray], y: np.ndarray, engine: str) -> Tuple[np.ndarray, float, object]:
+    """対象行で学習し (重要度, 秒, 学習済みモデル) を返す"""
+    t0 = time.perf_counter()
+    Xs = _take(X, rows, cols)
+    model.fit(Xs, y)
+    if engine == "hist":
+        imp = _hist_importance(model, Xs, y)
+    else:
+        imp = model.feature_importances_
+    return imp, time.perf_counter() - t0, model
+
+
+def _fit_fold(
+    model, X, rows: Optional[np.ndarray], cols: Optional[np.ndarray], y: np.ndarray,
+    train: np.ndarray, test: np.ndarray, scoring: str,
+) -> Tuple[float, float]:
+    """CV の1分割を学習・評価して (スコア, 秒) を返す（失敗した分割は NaN）"""
+    t0 = time.perf_counter()
+    try:
+        Xs = _take(X, rows, cols)
+        model.fit(Xs[train], y[train])
+        score = float(get_scorer(scoring)(model, Xs[test], y[test]))
+    except Exception:
+        score = np.nan
+    return score, time.perf_counter() - t0
+
+
+def _model_jobs(
+    model, X, rows: Optional[np.ndarray], cols: Optional[np.ndarray], y: np.ndarray,
+    engine: str, cv: int, scoring: str, classifier: bool,
+) -> list:
+    """全行学習1回＋CV分割ぶんのジョブ（joblib の delayed）。X は共有し、行・列番号だけ渡す"""
+    jobs = [delayed(_fit_full)(clone(model), X, rows, cols, y, engine)]
+    if cv >= 2:
+        splitter = check_cv(cv, y, classifier=classifier)
+        for train, test in splitter.split(np.zeros((len(y), 1)), y):
+            jobs.append(delayed(_fit_fold)(clone(model), X, rows, cols, y, train, test, scoring))
+    return jobs
+
+
+def _importance_table(columns, results: list, score_col: str) -> pd.DataFrame:
+    """ジョブ結果 → 重要度テーブル（CV スコアと所要秒数つき）"""
+    imp, seconds, _ = results[0]
+    scores = [s for s, _ in results[1:]]
+    seconds += sum(sec for _, sec in results[1:])
+    out = pd.DataFrame({
+        "feature": list(columns),
+        "importance": imp,
+    }).sort_values("importance", ascending=False)
+    out[score_col] = float(np.mean(scores)) if scores else None
+    out["fit_seconds"] = seconds
+    return out
+
+
+def _target_rows(target: pd.Series, mask: Optional[np.ndarray] = None) -> Tuple[Optional[np.ndarray], np.ndarray]:
+    """(学習に使う行番号 or 全行なら None, 目的変数)。欠損の目的変数は除く"""
+    ok = target.notna().to_numpy()
+    if mask is not None:
+        ok = ok & mask
+    if ok.all():
+        return None, target.to_numpy()
+    rows = np.flatnonzero(ok)
+    return rows, target.to_numpy()[rows]
+
+
+def _subset(fm: FeatureMatrix, cols: Optional[np.ndarray]) -> Tuple[List[str], np.ndarray]:
+    """(列名, ヒストグラムGBM用カテゴリマスク) を列番号の部分集合で"""
+    if cols is None:
+        return fm.columns, fm.hist_categorical
+    return [fm.columns[i] for i in cols], fm.hist_categorical[cols]
+
+
+def _classification_spec(
+    fm: FeatureMatrix, target: pd.Series, mask, n_estimators: int, engine: str, X=None, cols: Optional[np.ndarray] = None,
+):
+    rows, y = _target_rows(target, mask)
+    if len(y) < 30:
         return None
+    y = y.astype(int)
 
     # 正例が少なすぎる場合はスキップ
     if y.sum() < 5 or (len(y) - y.sum()) < 5:
         return None
 
-    model = GradientBoostingClassifier(
-        n_estimators=n_estimators,
-        max_depth=3,
-        learning_rate=0.1,
-        random_state=42,
-    )
-    model.fit(X, y)
+    columns, categorical = _subset(fm, cols)
+    model = _make_model("classification", engine, n_estimators, categorical)
+    X = fm.X if X is None else X
+    jobs = _model_jobs(model, X, rows, cols, y, engine, min(5, int(y.sum())), "roc_auc", True)
+    return columns, jobs, "auc_cv"
+
+
+def _regression_spec(
+    fm: FeatureMatrix, df: pd.DataFrame, target_col: str, n_estimators: int, engine: str, X=None, cols: Optional[np.ndarray] = None,
+):
+    won = (df["_is_won"] == True).to_numpy()
+    n_won = int(won.sum())
+    if n_won < 20:
+        return None
+
+    rows, y = _target_rows(np.log1p(df[target_col]), won)
+    if len(y) < 30:
+        return None
+
+    columns, categorical = _subset(fm, cols)
+    model = _make_model("regression", engine, n_estimators, categorical)
+    X = fm.X if X is None else X
+    jobs = _model_jobs(model, X, rows, cols, y.astype(float), engine, min(5, n_won // 5), "r2", False)
+    return columns, jobs, "r2_cv"
+
+
+def _model_cols(fm: FeatureMatrix, model: str, cols: Optional[np.ndarray]) -> Optional[np.ndarray]:
+    """cols（None なら全列）のうち、そのモデルが使う列"""
+    own = fm.model_columns(model)
+    if own is None:
+        return cols
+    return own if cols is None else np.intersect1d(cols, own)
+
 
-    # CV score
+def _driver_specs(
+    fm: FeatureMatrix, df: pd.DataFrame, n_estimators: int, engine: str, X=None, cols: Optional[np.ndarray] = None,
+) -> Dict[str, Optional[tuple]]:
+    """Drivers の3モデル（DRIVER_MODELS の順）のジョブ"""
+    qualified = df["_is_qualified"] == True
+    return {
+        "qualified": _classification_spec(fm, qualified, None, n_estimators, engine, X, _model_cols(fm, "qualified", cols)),
+        "won": _classification_spec(
+            fm, df["_is_won"] == True, qualified.to_numpy(), n_estimators, engine, X, _model_cols(fm, "won", cols),
+        ),
+        "revenue": _regression_spec(fm, df, "_revenue", n_estimators, engine, X, _model_cols(fm, "revenue", cols)),
+    }
+
+
+def _tagged(name, i: int, func, args, kwargs):
+    """ジョブの結果に (モデル名, ジョブ番号) をつける（順不同で返ってくるので）"""
+    return name, i, func(*args, **kwargs)
+
+
+def _iter_specs(
+    specs: Dict[object, Optional[tuple]],
+    n_jobs: Optional[int],
+    stop: Optional[threading.Event] = None,
+    on_job_done: Optional[Callable[[], None]] = None,
+) -> Iterator[Tuple[object, Optional[Dict]]]:
+    """全モデルの全ジョブを1つの joblib プールで並列実行し、モデル毎にそのジョブが
+    全部終わった時点で (名前, 結果) を返す
+
+    結果は {"importance": 重要度テーブル, "model": 全行で学習したモデル}（学習できなければ None）。
+    stop がセットされたら残りのジョブを取り消して終わる。
+    """
+    flat, got = [], {}
+    for name, spec in specs.items():
+        if spec is None:
+            yield name, None
+            continue
+        got[name] = [None] * len(spec[1])
+        flat.extend(delayed(_tagged)(name, i, *job) for i, job in enumerate(spec[1]))
+    if not flat:
+        return
+
+    pending = {name: len(v) for name, v in got.items()}
+    gen = Parallel(n_jobs=n_jobs, return_as="generator_unordered")(flat)
     try:
-        cv_scores = cross_val_score(model, X, y, cv=min(5, int(y.sum())), scoring="roc_auc")
-        mean_auc = float(cv_scores.mean())
-    except Exception:
-        mean_auc = None
+        for name, i, r in gen:
+            got[name][i] = r
+            pending[name] -= 1
+            if on_job_done is not None:
+                on_job_done()
+            if stop is not None and stop.is_set():
+                return
+            if pending[name] == 0:
+                spec = specs[name]
+                yield name, {"importance": _importance_table(spec[0], got[name], spec[2]), "model": got[name][0][2]}
+    finally:
+        # 途中で抜けたら未実行のジョブは取り消される
+        gen.close()
 
-    imp = pd.DataFrame({
-        "feature": X.columns,
-        "importance": model.feature_importances_,
-    }).sort_values("importance", ascending=False)
-    imp["auc_cv"] = mean_auc
 
-    return imp
+def _run_specs(specs: Dict[object, Optional[tuple]], n_jobs: Optional[int]) -> Dict[object, Optional[Dict]]:
+    """全モデルの全ジョブを実行してモデル毎の結果を返す（_iter_specs を最後まで回す）"""
+    out = dict(_iter_specs(specs, n_jobs))
+    return {name: out[name] for name in specs}
+
+
+def _importances(results: Dict[object, Optional[Dict]]) -> Dict[object, Optional[pd.DataFrame]]:
+    return {k: None if r is None else r["importance"] for k, r in results.items()}
+
+
+def feature_importance_classification(
+    df: pd.DataFrame,
+    feature_cols: List[str],
+    target_col: str,
+    n_estimators: int = 100,
+    engine: str = "gbm",
+    n_jobs: Optional[int] = None,
+    matrix: Optional[FeatureMatrix] = None,
+) -> Optional[pd.DataFrame]:
+    """分類（Qualified/成約の0/1）の特徴量重要度"""
+    fm = matrix if matrix is not None else encode_features(df, feature_cols)
+    spec = _classification_spec(fm, df[target_col], None, n_estimators, engine)
+    return _importances(_run_specs({"model": spec}, n_jobs))["model"]
 
 
 def feature_importance_regression(
@@ -83,44 +608,423 @@ def feature_importance_regression(
     feature_cols: List[str],
     target_col: str = "_revenue",
     n_estimators: int = 100,
+    engine: str = "gbm",
+    n_jobs: Optional[int] = None,
+    matrix: Optional[FeatureMatrix] = None,
 ) -> Optional[pd.DataFrame]:
     """回帰（成約単価）の特徴量重要度（成約行のみで実行）"""
-    sub = df[df["_is_won"] == True].copy()
-    if len(sub) < 20:
-        return None
+    fm = matrix if matrix is not None else encode_features(df, feature_cols)
+    spec = _regression_spec(fm, df, target_col, n_estimators, engine)
+    return _importances(_run_specs({"model": spec}, n_jobs))["model"]
 
-    sub["_log_revenue"] = np.log1p(sub[target_col])
 
-    X, y, encoders = _prepare_features(sub, feature_cols, "_log_revenue")
-    if X is None or y is None:
-        return None
+def _driver_params(engine: str, n_estimators: int, cardinality: str, max_levels: int) -> Dict:
+    cardinality, max_levels = _cardinality_key(cardinality, max_levels)
+    return {"engine": engine, "n_estimators": int(n_estimators), "cardinality": cardinality, "max_levels": max_levels}
+
+
+def cached_driver_results(
+    dataset_id: str,
+    feature_cols: List[str],
+    n_estimators: int = 100,
+    engine: str = "hist",
+    cache_dir=None,
+    cardinality: str = "label",
+    max_levels: int = HIGH_CARDINALITY_LEVELS,
+) -> Optional[Dict[str, Optional[pd.DataFrame]]]:
+    """3モデルとも結果キャッシュにあればその重要度テーブル（学習はしない。1つでも無ければ None）"""
+    params = _driver_params(engine, n_estimators, cardinality, max_levels)
+    out = {}
+    for target in DRIVER_MODELS:
+        hit = load_result(model_key(dataset_id, feature_cols, target, params), cache_dir)
+        if hit is None:
+            return None
+        out[target] = hit["result"]
+    return _importances(out)
+
+
+def _with_schema(r: Optional[Dict], fm: FeatureMatrix) -> Optional[Dict]:
+    """結果に学習時の符号化を添える（スコアリングで新しいデータを同じコードにするため）"""
+    return None if r is None else {**r, "schema": fm.schema()}
+
+
+def _driver_results(
+    df: pd.DataFrame,
+    feature_cols: List[str],
+    n_estimators: int,
+    engine: str,
+    n_jobs: Optional[int],
+    matrix: Optional[FeatureMatrix],
+    dataset_id: Optional[str],
+    cache_dir,
+    cardinality: str,
+    max_levels: int,
+) -> Dict[str, Optional[Dict]]:
+    """3モデルの結果（{"importance", "model", "schema"}）。キャッシュにないモデルだけ学習する"""
+    cols = [c for c in feature_cols if c in df.columns]
+    params = _driver_params(engine, n_estimators, cardinality, max_levels)
+    keys = {t: model_key(dataset_id, cols, t, params) for t in DRIVER_MODELS} if dataset_id is not None else {}
+
+    results: Dict[str, Optional[Dict]] = {}
+    for target, key in keys.items():
+        hit = load_result(key, cache_dir)
+        if hit is not None:
+            results[target] = hit["result"]
+
+    missing = [t for t in DRIVER_MODELS if t not in results]
+    if missing:
+        fm = matrix if _matches(matrix, cols, cardinality, max_levels) else encode_features(df, cols, cardinality, max_levels)
+        with _share_matrix(fm.X, n_jobs) as X:
+            specs = _driver_specs(fm, df, n_estimators, engine, X)
+            fresh = _run_specs({t: specs[t] for t in missing}, n_jobs)
+        for target, r in fresh.items():
+            results[target] = _with_schema(r, fm)
+            if target in keys:
+                store_result(keys[target], {"result": results[target]}, cache_dir)
+
+    return {t: results[t] for t in DRIVER_MODELS}
+
 
-    model = GradientBoostingRegressor(
-        n_estimators=n_estimators,
-        max_depth=3,
-        learning_rate=0.1,
-        random_state=42,
+def run_driver_models(
+    df: pd.DataFrame,
+    feature_cols: List[str],
+    n_estimators: int = 100,
+    engine: str = "hist",
+    n_jobs: Optional[int] = -1,
+    matrix: Optional[FeatureMatrix] = None,
+    dataset_id: Optional[str] = None,
+    cache_dir=None,
+    return_models: bool = False,
+    cardinality: str = "label",
+    max_levels: int = HIGH_CARDINALITY_LEVELS,
+):
+    """Drivers タブの3モデル（qualified / won / revenue）をまとめて実行
+
+    3モデルの全行学習と CV の各分割を1つのジョブ列にして並列に回す。
+    特徴量は matrix（なければここで1回だけ encode_features）を行番号で共有する。
+    各テーブルの fit_seconds はそのモデルのジョブの所要秒数の合計。
+    dataset_id を渡すとモデル毎の結果キャッシュ（logic.model_cache）を引き、
+    無かったモデルだけを学習して保存する。
+    cardinality / max_levels は水準数の多いカテゴリ列の扱い（encode_features を参照）。
+
+    Returns:
+        モデル名 → 重要度テーブル（学習できなければ None）。
+        return_models=True なら (重要度テーブル, 学習済みモデル) の組。
+    """
+    results = _driver_results(
+        df, feature_cols, n_estimators, engine, n_jobs, matrix, dataset_id, cache_dir, cardinality, max_levels,
     )
-    model.fit(X, y)
+    tables = _importances(results)
+    if return_models:
+        return tables, {t: None if r is None else r["model"] for t, r in results.items()}
+    return tables
+
+
+class DriverJob:
+    """バックグラウンドで学習中の Drivers 3モデル（進捗・途中結果・キャンセル）
+
+    start_driver_job が返す。学習は別スレッドから joblib のワーカープールに流し、
+    モデルが1つ終わるたびに results に重要度テーブルが入る（結果キャッシュにも保存）。
+    """
+
+    def __init__(self, total_jobs: int, results: Dict[str, Optional[pd.DataFrame]]):
+        self.total_jobs = total_jobs
+        self.started_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+        self.error: Optional[BaseException] = None
+        self._done_jobs = 0
+        self._results = dict(results)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def progress(self) -> float:
+        """終わったジョブの割合（0〜1）"""
+        with self._lock:
+            return 1.0 if self.total_jobs == 0 else self._done_jobs / self.total_jobs
+
+    @property
+    def results(self) -> Dict[str, Optional[pd.DataFrame]]:
+        """終わったモデルの重要度テーブル（DRIVER_MODELS の順、未完了のモデルは含まない）"""
+        with self._lock:
+            return {t: self._results[t] for t in DRIVER_MODELS if t in self._results}
+
+    @property
+    def done(self) -> bool:
+        return self._thread is None or not self._thread.is_alive()
 
+    @property
+    def cancelled(self) -> bool:
+        return self._stop.is_set()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def cancel(self) -> None:
+        """残りのジョブを取り消す（実行中のジョブの終了を待ってスレッドが止まる）"""
+        self._stop.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.done
+
+    def _job_done(self) -> None:
+        with self._lock:
+            self._done_jobs += 1
+
+    def _run(self, fm: FeatureMatrix, df: pd.DataFrame, targets: List[str], keys: Dict[str, str], params: Dict, n_jobs, cache_dir) -> None:
+        try:
+            with _share_matrix(fm.X, n_jobs) as X:
+                specs = _driver_specs(fm, df, params["n_estimators"], params["engine"], X)
+                for target, r in _iter_specs({t: specs[t] for t in targets}, n_jobs, self._stop, self._job_done):
+                    r = _with_schema(r, fm)
+                    if target in keys:
+                        store_result(keys[target], {"result": r}, cache_dir)
+                    with self._lock:
+                        self._results[target] = None if r is None else r["importance"]
+        except BaseException as e:  # スレッドの外へは投げられないので保持して UI に出す
+            self.error = e
+        finally:
+            self.finished_at = time.perf_counter()
+
+
+def start_driver_job(
+    df: pd.DataFrame,
+    feature_cols: List[str],
+    n_estimators: int = 100,
+    engine: str = "hist",
+    n_jobs: Optional[int] = -1,
+    matrix: Optional[FeatureMatrix] = None,
+    dataset_id: Optional[str] = None,
+    cache_dir=None,
+    cardinality: str = "label",
+    max_levels: int = HIGH_CARDINALITY_LEVELS,
+) -> DriverJob:
+    """run_driver_models をバックグラウンドで始めて、すぐに DriverJob を返す
+
+    結果キャッシュにあるモデルは最初から results に入り、無いモデルだけを学習する。
+    """
+    cols = [c for c in feature_cols if c in df.columns]
+    params = _driver_params(engine, n_estimators, cardinality, max_levels)
+    keys = {t: model_key(dataset_id, cols, t, params) for t in DRIVER_MODELS} if dataset_id is not None else {}
+
+    cached: Dict[str, Optional[pd.DataFrame]] = {}
+    for target, key in keys.items():
+        hit = load_result(key, cache_dir)
+        if hit is not None:
+            cached[target] = None if hit["result"] is None else hit["result"]["importance"]
+
+    missing = [t for t in DRIVER_MODELS if t not in cached]
+    fm = None
+    total = 0
+    if missing:
+        fm = matrix if _matches(matrix, cols, cardinality, max_levels) else encode_features(df, cols, cardinality, max_levels)
+        specs = _driver_specs(fm, df, n_estimators, engine)
+        total = sum(len(specs[t][1]) for t in missing if specs[t] is not None)
+
+    job = DriverJob(total, cached)
+    if missing:
+        job._thread = threading.Thread(
+            target=job._run, args=(fm, df, missing, keys, params, n_jobs, cache_dir), daemon=True,
+        )
+        job._thread.start()
+    else:
+        job.finished_at = job.started_at
+    return job
+
+
+@dataclass(frozen=True)
+class LeadScorer:
+    """学習済みの qualified / won モデルと学習時の符号化（スコア対象も同じコードで符号化する）
+
+    _p_won は Model B（Qualified 内で成約するか）の確率なので、Qualified になった場合の成約確率。
+    """
+    schema: FeatureMatrix
+    models: Dict[str, object]
+
+
+def driver_scorer(
+    df: pd.DataFrame,
+    feature_cols: List[str],
+    n_estimators: int = 100,
+    engine: str = "hist",
+    n_jobs: Optional[int] = -1,
+    matrix: Optional[FeatureMatrix] = None,
+    dataset_id: Optional[str] = None,
+    cache_dir=None,
+    cardinality: str = "label",
+    max_levels: int = HIGH_CARDINALITY_LEVELS,
+) -> Optional[LeadScorer]:
+    """Drivers の qualified / won モデルからスコアラーを作る（学習済みならキャッシュから。どちらも無ければ None）"""
+    results = _driver_results(
+        df, feature_cols, n_estimators, engine, n_jobs, matrix, dataset_id, cache_dir, cardinality, max_levels,
+    )
+    scored = {t: results[t] for t in SCORE_COLUMNS if results[t] is not None}
+    if not scored:
+        return None
+    return LeadScorer(
+        schema=next(iter(scored.values()))["schema"],
+        models={t: r["model"] for t, r in scored.items()},
+    )
+
+
+def score_leads(
+    df: pd.DataFrame,
+    scorer: LeadScorer,
+    chunk_rows: int = SCORE_CHUNK_ROWS,
+    out_path=None,
+    id_col: Optional[str] = None,
+) -> Tuple[Optional[pd.DataFrame], Dict[str, float]]:
+    """全リードに成約確率などを付ける（chunk_rows 行ずつ符号化して predict_proba）
+
+    df は書き換えない（整備済みデータの列構成を変えると差分取り込みなどが使えなくなる）。
+    out_path なしなら SCORE_COLUMNS の列（float32、index は df と同じ）の DataFrame を返す。
+    out_path（パスまたはファイル）ありなら id_col（なければ行番号 _row）とスコア列を
+    チャンク毎に Parquet へ書き出し、DataFrame は None。どちらも df のコピーは作らない。
+
+    Returns:
+        (スコアの DataFrame, rows / seconds / rows_per_sec / chunks)
+    """
+    n = len(df)
+    targets = [t for t in SCORE_COLUMNS if t in scorer.models]
+    model_cols = {t: scorer.schema.model_columns(t) for t in targets}
+    out = {t: np.empty(n, dtype=np.float32) for t in targets} if out_path is None else None
+    writer = None
+    t0 = time.perf_counter()
+    chunks = 0
     try:
-        cv_scores = cross_val_score(model, X, y, cv=min(5, len(sub) // 5), scoring="r2")
-        mean_r2 = float(cv_scores.mean())
-    except Exception:
-        mean_r2 = None
+        for start in range(0, n, chunk_rows):
+            part = df.iloc[start:start + chunk_rows]
+            X = encode_features(part, scorer.schema.features, like=scorer.schema).X
+            probs = {
+                t: scorer.models[t].predict_proba(X if model_cols[t] is None else X[:, model_cols[t]])[:, 1].astype(np.float32)
+                for t in targets
+            }
+            chunks += 1
+            if out is not None:
+                for t in targets:
+                    out[t][start:start + len(part)] = probs[t]
+                continue
 
-    imp = pd.DataFrame({
-        "feature": X.columns,
-        "importance": model.feature_importances_,
-    }).sort_values("importance", ascending=False)
-    imp["r2_cv"] = mean_r2
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            ids = part[id_col].to_numpy() if id_col is not None else np.arange(start, start + len(part))
+            table = pa.table({id_col or "_row": ids, **{SCORE_COLUMNS[t]: probs[t] for t in targets}})
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    scores = None if out is None else pd.DataFrame({SCORE_COLUMNS[t]: out[t] for t in targets}, index=df.index)
+    seconds = time.perf_counter() - t0
+    return scores, {
+        "rows": n,
+        "seconds": seconds,
+        "rows_per_sec": n / seconds if seconds > 0 else float("inf"),
+        "chunks": chunks,
+    }
+
+
+def ablation_variants(feature_cols: List[str], channels: bool = True) -> Dict[str, List[str]]:
+    """交絡チェック用の特徴量セット（担当者・月の有無、チャネル1つずつの除外）"""
+    base = list(feature_cols)
+
+    def drop(*cols: str) -> List[str]:
+        return [f for f in base if f not in cols]
+
+    variants = {"全特徴量": base}
+    if "_sales_owner" in base:
+        variants["担当者なし"] = drop("_sales_owner")
+    if "_month" in base:
+        variants["月なし"] = drop("_month")
+    if "_sales_owner" in base and "_month" in base:
+        variants["担当者・月なし"] = drop("_sales_owner", "_month")
+    if channels:
+        for c in base:
+            if c in _UTM_FEATURES:
+                variants[f"{c[1:]}なし"] = drop(c)
+            elif c.startswith("_contrib__"):
+                variants[f"貢献:{c[len('_contrib__'):]}なし"] = drop(c)
+    return variants
+
+
+def ablation_grid(
+    df: pd.DataFrame,
+    variants: Dict[str, List[str]],
+    n_estimators: int = 100,
+    engine: str = "hist",
+    n_jobs: Optional[int] = -1,
+    matrix: Optional[FeatureMatrix] = None,
+    cardinality: str = "label",
+    max_levels: int = HIGH_CARDINALITY_LEVELS,
+) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """特徴量セット毎に3モデルを一括で学習し、CV スコアと重要度を横並びにする
+
+    全セットの全ジョブを1つのプロセスプールで回す。特徴量は全セットの和集合を
+    1回だけエンコードし、各ジョブは共有行列の列番号だけを受け取る。
+
+    Returns:
+        scores: 行=特徴量セット、列=n_features / 各モデルの CV スコア / fit_seconds
+        importance: モデル毎の 行=特徴量、列=特徴量セット の重要度
+    """
+    all_cols = list(dict.fromkeys(c for cols in variants.values() for c in cols))
+    if _matches(matrix, all_cols, cardinality, max_levels, subset=True):
+        fm = matrix
+    else:
+        fm = encode_features(df, all_cols, cardinality, max_levels)
+    idx = {
+        name: np.flatnonzero(pd.Index(fm.sources).isin(cols))
+        for name, cols in variants.items()
+    }
+    idx = {name: ix for name, ix in idx.items() if len(ix)}
+
+    with _share_matrix(fm.X, n_jobs) as X:
+        specs = {}
+        for name, ix in idx.items():
+            for model, spec in _driver_specs(fm, df, n_estimators, engine, X, ix).items():
+                specs[(name, model)] = spec
+        importances = _importances(_run_specs(specs, n_jobs))
+
+    rows = []
+    for name, ix in idx.items():
+        row = {"variant": name, "n_features": len({fm.sources[i] for i in ix}), "fit_seconds": 0.0}
+        for model, score_col in DRIVER_MODELS.items():
+            t = importances[(name, model)]
+            row[model] = None if t is None else t[score_col].iloc[0]
+            row["fit_seconds"] += 0.0 if t is None else float(t["fit_seconds"].iloc[0])
+        rows.append(row)
+    scores = pd.DataFrame(rows, columns=["variant", "n_features", *DRIVER_MODELS, "fit_seconds"]).set_index("variant")
+
+    importance: Dict[str, pd.DataFrame] = {}
+    for model in DRIVER_MODELS:
+        wide = pd.DataFrame({
+            name: importances[(name, model)].set_index("feature")["importance"]
+            for name in idx if importances[(name, model)] is not None
+        })
+        if len(wide.columns):
+            wide = wide.reindex([c for c in dict.fromkeys(fm.sources) if c in wide.index])
+            wide = wide.sort_values(wide.columns[0], ascending=False)
+        importance[model] = wide
+    return scores, importance
 
-    return imp
 
+def get_model_features(
+    df: pd.DataFrame, include_owner: bool = True, include_month: bool = True, include_utm_detail: bool = False,
+) -> List[str]:
+    """モデルに投入する特徴量のリストを生成
 
-def get_model_features(df: pd.DataFrame, include_owner: bool = True, include_month: bool = True) -> List[str]:
-    """モデルに投入する特徴量のリストを生成"""
+    include_utm_detail で utm_medium / utm_content も入れる（水準数が多くなりやすいので
+    encode_features の cardinality と組み合わせて使う）。
+    """
     features = ["_age_band", "_asset_band", "_utm_source", "_utm_campaign"]
+    if include_utm_detail:
+        features += ["_utm_medium", "_utm_content"]
 
     if include_owner:
         features.append("_sales_owner")
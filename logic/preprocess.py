@@ -1,31 +1,111 @@
 from __future__ import annotations
 import pandas as pd
 import numpy as np
-from pandas.api.types import CategoricalDtype
+from pandas.api.types import CategoricalDtype, is_bool_dtype, is_numeric_dtype
 from typing import Dict, Tuple, List
 
 from logic.schema import ASSET_ORDER, AGE_ORDER, CONTRIB_COL_CANDIDATES
+from logic.dates import month_codes, parse_dates
+
+_BOOL_MAP = {"TRUE": True, "FALSE": False, "1": True, "0": False, "YES": True, "NO": False}
+
+
+def _normalize_by_unique(s: pd.Series, transform, na_value, dtype=None) -> pd.Series:
+    """ユニーク値にだけ transform をかけ、factorize のコード経由で全行に戻す
+
+    欠損は na_value にする。dtype にカテゴリ型（または "category"）を渡すと
+    文字列を全行分作らずにカテゴリ型で返す。
+    """
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    # 欠損のコード(-1)は末尾に足した na_value を引く
+    mapped = np.append(transform(pd.Series(uniques)).to_numpy(dtype=object), na_value)
+    if dtype is None:
+        return pd.Series(mapped[codes], index=s.index)
+    # CategoricalDtype は "category" と == で等しくなるので isinstance で分ける（帯の順序を捨てない）
+    cat = pd.Categorical(mapped, dtype=dtype if isinstance(dtype, CategoricalDtype) else None)
+    return pd.Series(pd.Categorical.from_codes(cat.codes[codes], dtype=cat.dtype), index=s.index)
 
 
 def _to_bool_series(s: pd.Series) -> pd.Series:
     if s.dtype == bool:
         return s.fillna(False)
-    return (
-        s.astype(str)
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    flags = (
+        pd.Series(uniques)
+        .astype(str)
         .str.strip()
         .str.upper()
-        .map({"TRUE": True, "FALSE": False, "1": True, "0": False, "YES": True, "NO": False})
+        .map(_BOOL_MAP)
         .fillna(False)
-        .astype(bool)
+        .to_numpy(dtype=bool)
     )
+    return pd.Series(np.append(flags, False)[codes], index=s.index)
+
+
+def _clean_text(u: pd.Series) -> pd.Series:
+    return u.astype(str).str.strip().replace({"nan": "", "None": ""})
+
+
+def _clean_band(order: List[str]):
+    def transform(u: pd.Series) -> pd.Series:
+        v = u.astype(str).str.strip()
+        return v.where(v.isin(order), "不明")
+    return transform
+
+
+def _lead_ids(s: pd.Series) -> pd.Series:
+    """リードIDの比較用の値（数値はそのまま、それ以外は前後の空白を除いた文字列。空欄は欠損）"""
+    if is_numeric_dtype(s) and not is_bool_dtype(s):
+        return s
+    ids = s.astype("str").str.strip()
+    return ids.where(ids != "")
+
+
+def hashed_columns(columns, colmap: Dict[str, str]) -> List[str]:
+    """行ハッシュに使う列（IDを除く取り込み列。エクスポートの列順に依らないよう名前順）"""
+    needed = (set(colmap.values()) | set(CONTRIB_COL_CANDIDATES)) - {colmap.get("id")}
+    return sorted(c for c in columns if c in needed)
+
+
+def _column_hash(s: pd.Series) -> np.ndarray:
+    if is_numeric_dtype(s) and not is_bool_dtype(s):
+        # 整数列と欠損を含む浮動小数列で同じ値が同じハッシュになるように揃える
+        return pd.util.hash_array(s.to_numpy(dtype=float))
+    # 文字列化はユニーク値にだけかける（欠損は空欄と同じ扱い）
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    text = np.append(pd.Series(uniques).astype(str).to_numpy(dtype=object), "")
+    return pd.util.hash_array(text, categorize=False)[codes]
+
+
+def row_hashes(df_raw: pd.DataFrame, cols: List[str]) -> np.ndarray:
+    """行毎のハッシュ（cols の値が同じ行は同じ値。差分取り込みで変更行の検出に使う）
+
+    型の揺れ（数値列が文字列で読まれた等）で同じ内容でも値が変わることはあるが、
+    その行は変更扱いで整備し直されるだけで結果は変わらない。
+    """
+    h = np.full(len(df_raw), np.uint64(len(cols)), dtype=np.uint64)
+    for c in cols:
+        h = (h * np.uint64(0x100000001B3)) ^ _column_hash(df_raw[c])
+    return h
+
+
+def _memory_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
 
 
 def preprocess(
     df_raw: pd.DataFrame,
     colmap: Dict[str, str],
+    compact: bool = False,
 ) -> Tuple[pd.DataFrame, Dict]:
+    """生データを整備して派生列（_ 始まり）を付ける
+
+    _month は月キー（logic.dates.month_codes）で持つ。compact=True のときは
+    元の列を持たず、テキスト列をカテゴリ型で保持してメモリを抑える。
+    """
     meta: Dict = {}
-    df = df_raw.copy()
+    # compact では元の列をコピーせず、派生列だけの frame を組み立てる
+    df = pd.DataFrame(index=df_raw.index) if compact else df_raw.copy()
 
     # 必須列チェック
     required_internals = ["revenue", "stage", "conv_date"]
@@ -34,69 +114,71 @@ def preprocess(
 
     # 売上金額 → 数値化
     rev_col = colmap.get("revenue")
-    if rev_col and rev_col in df.columns:
-        df["_revenue"] = pd.to_numeric(df[rev_col], errors="coerce").fillna(0.0)
+    if rev_col and rev_col in df_raw.columns:
+        df["_revenue"] = pd.to_numeric(df_raw[rev_col], errors="coerce").fillna(0.0)
     else:
         df["_revenue"] = 0.0
 
     # コンバージョン日 → month
     date_col = colmap.get("conv_date")
-    if date_col and date_col in df.columns:
-        df["_conv_date"] = pd.to_datetime(df[date_col], errors="coerce")
-        df["_month"] = df["_conv_date"].dt.to_period("M").astype(str)
+    if date_col and date_col in df_raw.columns:
+        df["_conv_date"] = parse_dates(df_raw[date_col])
     else:
-        df["_conv_date"] = pd.NaT
-        df["_month"] = "不明"
+        df["_conv_date"] = pd.Series(pd.NaT, index=df.index, dtype="datetime64[ns]")
+    # 月は整数の月キーで持ち、表示時に format_month で文字列にする
+    df["_month"] = month_codes(df["_conv_date"])
 
     # ステージ
     stage_col = colmap.get("stage")
-    if stage_col and stage_col in df.columns:
-        df["_stage"] = df[stage_col].astype(str).str.strip()
+    text_dtype = "category" if compact else None
+    if stage_col and stage_col in df_raw.columns:
+        df["_stage"] = _normalize_by_unique(
+            df_raw[stage_col], lambda u: u.astype(str).str.strip(), "", dtype=text_dtype
+        )
     else:
-        df["_stage"] = ""
+        df["_stage"] = pd.Series("", index=df.index, dtype=text_dtype)
 
     df["_is_qualified"] = df["_stage"] == "Qualified"
     df["_is_won"] = df["_revenue"] > 0
 
-    # 年代
-    age_col = colmap.get("age_band")
-    if age_col and age_col in df.columns:
-        df["_age_band"] = df[age_col].astype(str).str.strip().replace({"": "不明", "nan": "不明"})
-    else:
-        df["_age_band"] = "不明"
-
-    # 資産レンジ
-    asset_col = colmap.get("assets_band")
-    if asset_col and asset_col in df.columns:
-        df["_asset_band"] = df[asset_col].astype(str).str.strip().replace({"": "不明", "nan": "不明"})
-    else:
-        df["_asset_band"] = "不明"
-
-    df["_age_band"] = df["_age_band"].where(df["_age_band"].isin(AGE_ORDER), "不明")
-    df["_asset_band"] = df["_asset_band"].where(df["_asset_band"].isin(ASSET_ORDER), "不明")
-
-    df["_age_band"] = df["_age_band"].astype(CategoricalDtype(categories=AGE_ORDER, ordered=True))
-    df["_asset_band"] = df["_asset_band"].astype(CategoricalDtype(categories=ASSET_ORDER, ordered=True))
+    # 年代・資産レンジ（順序リストにない値・空欄・欠損は「不明」）
+    for key, out_col, order in [("age_band", "_age_band", AGE_ORDER), ("assets_band", "_asset_band", ASSET_ORDER)]:
+        band_dtype = CategoricalDtype(categories=order, ordered=True)
+        c = colmap.get(key)
+        if c and c in df_raw.columns:
+            df[out_col] = _normalize_by_unique(df_raw[c], _clean_band(order), "不明", dtype=band_dtype)
+        else:
+            df[out_col] = pd.Series("不明", index=df.index, dtype=band_dtype)
 
     # UTM類・その他テキスト列
     for k in ["utm_source", "utm_medium", "utm_campaign", "utm_content",
               "lead_source", "origin", "sales_owner", "trigger"]:
         c = colmap.get(k)
-        if c and c in df.columns:
-            df[f"_{k}"] = df[c].astype(str).str.strip().replace({"nan": "", "None": ""})
+        if c and c in df_raw.columns:
+            df[f"_{k}"] = _normalize_by_unique(df_raw[c], _clean_text, "", dtype=text_dtype)
         else:
-            df[f"_{k}"] = ""
+            df[f"_{k}"] = pd.Series("", index=df.index, dtype=text_dtype)
 
     # 貢献フラグ
-    contrib_cols: List[str] = [c for c in CONTRIB_COL_CANDIDATES if c in df.columns]
+    contrib_cols: List[str] = [c for c in CONTRIB_COL_CANDIDATES if c in df_raw.columns]
     for c in contrib_cols:
-        df[f"_contrib__{c}"] = _to_bool_series(df[c])
+        df[f"_contrib__{c}"] = _to_bool_series(df_raw[c])
 
     if contrib_cols:
         df["_contrib_true_count"] = df[[f"_contrib__{c}" for c in contrib_cols]].sum(axis=1)
     else:
         df["_contrib_true_count"] = 0
 
+    if compact:
+        # フラグ数は最大でも候補数（14）なので1バイトで足りる
+        df["_contrib_true_count"] = df["_contrib_true_count"].astype(np.uint8)
+
+    # 差分取り込み（logic.incremental）用のリードIDと行ハッシュ
+    id_col = colmap.get("id")
+    if id_col and id_col in df_raw.columns:
+        df["_lead_id"] = _lead_ids(df_raw[id_col])
+        df["_row_hash"] = row_hashes(df_raw, hashed_columns(df_raw.columns, colmap))
+
     meta["contrib_cols"] = contrib_cols
     meta["contrib_multi_touch_rate"] = float((df["_contrib_true_count"] >= 2).mean()) if len(df) else 0.0
     meta["rows"] = int(len(df))
@@ -109,4 +191,8 @@ def preprocess(
         if len(valid_dates):
             meta["date_range"] = f"{valid_dates.min().strftime('%Y-%m-%d')} ~ {valid_dates.max().strftime('%Y-%m-%d')}"
 
+    meta["compact"] = compact
+    meta["memory_raw_bytes"] = _memory_bytes(df_raw)
+    meta["memory_bytes"] = _memory_bytes(df)
+
     return df, meta
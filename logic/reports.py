@@ -0,0 +1,127 @@
+from __future__ import annotations
+import pandas as pd
+from typing import Dict, List, Optional
+
+from logic.attribution import contrib_flag_analysis, contrib_shapley, crosstab, rank_by_metric
+from logic.cube import (
+    FunnelCube,
+    build_funnel_cube,
+    cube_filter,
+    cube_group_funnel,
+    cube_kpis,
+    cube_pivot_segment,
+    cube_pivot_segment_count,
+)
+from logic.dates import format_month
+from logic.modeling import get_model_features, run_driver_models
+from logic.subgroups import discover_subgroups
+
+# タブ毎のレポート（batch.py の --stages で選ぶ単位）
+REPORT_STAGES = ["funnel", "segment", "channel", "drivers"]
+
+# Segment タブの表示指標
+SEGMENT_METRICS = ["qualified_rate", "won_rate", "won_rate_in_qualified", "median_ticket", "revenue_sum"]
+
+# Channel タブのグルーピング（表示名 → 列）
+CHANNEL_GROUPS = {
+    "utm_source": "_utm_source",
+    "utm_campaign": "_utm_campaign",
+    "utm_medium": "_utm_medium",
+    "utm_content": "_utm_content",
+}
+
+# Channel タブのステージ（名前 → (Qualified 内に絞るか, 並べる指標)）
+CHANNEL_VIEWS = {
+    "upstream": (False, "qualified_rate"),
+    "downstream": (True, "won_rate_in_qualified"),
+}
+
+
+def funnel_report(cube: FunnelCube) -> Dict[str, pd.DataFrame]:
+    """Funnel タブ: 全体KPI・月次・担当者別"""
+    monthly = cube_group_funnel(cube, "_month").sort_values("_month")
+    monthly["_month"] = monthly["_month"].map(format_month)
+    by_owner = cube_group_funnel(cube, "_sales_owner")
+    by_owner = by_owner[(by_owner["_sales_owner"] != "") & (by_owner["leads"] > 0)]
+    return {
+        "kpis": pd.DataFrame([cube_kpis(cube)]),
+        "monthly": monthly,
+        "by_owner": by_owner.sort_values("won_rate_in_qualified", ascending=False),
+    }
+
+
+def segment_report(
+    df: pd.DataFrame,
+    cube: FunnelCube,
+    contrib_cols: List[str],
+    subgroup_time_budget: float = 60.0,
+) -> Dict[str, pd.DataFrame]:
+    """Segment タブ: 年代×資産のピボット（指標毎）・年代別/資産別ファネル・勝ち筋セグメント"""
+    out = {f"pivot_{m}": cube_pivot_segment(cube, "_age_band", "_asset_band", m) for m in SEGMENT_METRICS}
+    out["pivot_count"] = cube_pivot_segment_count(cube, "_age_band", "_asset_band")
+    out["by_age"] = cube_group_funnel(cube, "_age_band").sort_values("_age_band")
+    out["by_asset"] = cube_group_funnel(cube, "_asset_band").sort_values("_asset_band")
+    out["winning_segments"], _ = discover_subgroups(df, contrib_cols=contrib_cols, time_budget=subgroup_time_budget)
+    return out
+
+
+def channel_report(
+    df: pd.DataFrame,
+    cube: FunnelCube,
+    contrib_cols: List[str],
+    min_leads: int = 5,
+    cross_dims: Optional[List[str]] = None,
+    top_k: int = 30,
+) -> Dict[str, pd.DataFrame]:
+    """Channel タブ: 上流/下流それぞれの UTM 別ランキング・UTM のクロス集計・貢献フラグ（Shapley 配分を含む）"""
+    cross_dims = cross_dims or ["_utm_source", "_utm_campaign"]
+    out: Dict[str, pd.DataFrame] = {}
+    for view, (downstream, metric) in CHANNEL_VIEWS.items():
+        base_df, base_cube = df, cube
+        if downstream:
+            base_df = df[df["_is_qualified"] == True]
+            base_cube = cube_filter(cube, {"_is_qualified": [True]})
+        for name, col in CHANNEL_GROUPS.items():
+            out[f"{view}_{name}"] = rank_by_metric(base_df, col, metric, min_leads=min_leads, cube=base_cube)
+        out[f"{view}_cross"] = crosstab(
+            base_df, cross_dims, min_leads=min_leads, top_k=top_k, sort_by="revenue_sum", cube=base_cube,
+        )
+        if contrib_cols:
+            flags, pairs = contrib_flag_analysis(base_df, contrib_cols)
+            out[f"{view}_contrib_flags"] = flags.sort_values(metric, ascending=False)
+            out[f"{view}_contrib_pairs"] = pairs
+            out[f"{view}_contrib_shapley"] = contrib_shapley(base_df, contrib_cols)
+    return out
+
+
+def driver_report(
+    df: pd.DataFrame,
+    n_estimators: int = 100,
+    engine: str = "hist",
+    n_jobs: Optional[int] = -1,
+) -> Dict[str, pd.DataFrame]:
+    """Drivers タブ: 3モデルの特徴量重要度（担当者・月を含む特徴量セット。学習できなかったモデルは出さない）"""
+    features = get_model_features(df, include_owner=True, include_month=True)
+    results = run_driver_models(df, features, n_estimators=n_estimators, engine=engine, n_jobs=n_jobs)
+    return {f"importance_{model}": imp for model, imp in results.items() if imp is not None}
+
+
+def run_report(
+    stage: str,
+    df: pd.DataFrame,
+    meta: Dict,
+    cube: Optional[FunnelCube] = None,
+    **options,
+) -> Dict[str, pd.DataFrame]:
+    """REPORT_STAGES の1つを実行して 表名 → 表 を返す（options はそのレポート関数の引数）"""
+    if stage not in REPORT_STAGES:
+        raise ValueError(f"unknown stage: {stage}")
+    if stage == "drivers":
+        return driver_report(df, **options)
+    cube = cube if cube is not None else build_funnel_cube(df)
+    if stage == "funnel":
+        return funnel_report(cube)
+    contrib_cols = list(meta.get("contrib_cols", []))
+    if stage == "segment":
+        return segment_report(df, cube, contrib_cols, **options)
+    return channel_report(df, cube, contrib_cols, **options)
@@ -0,0 +1,245 @@
+from __future__ import annotations
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from typing import Tuple
+
+# 分位スケッチの既定の相対誤差（推定値は真の分位点の ±0.5% 以内）
+DEFAULT_RELATIVE_ERROR = 0.005
+# この件数以下のセル・グループは生の値を持ち、分位点を厳密に計算する
+EXACT_MAX_ITEMS = 1024
+
+# 0 以下の値のバケット（正の値のバケットより小さい側に並ぶ。代表値は 0）
+_ZERO_BUCKET = np.iinfo(np.int32).min
+
+
+@dataclass(frozen=True)
+class QuantileSketch:
+    """セル毎の値の分位スケッチ（対数バケットの件数。セルをまとめるときは件数を足すだけ）
+
+    バケット i は (γ^(i-1), γ^i]（γ = (1+α)/(1-α)、α = relative_error）で、
+    代表値 2γ^i/(γ+1) は区間内のどの値とも相対誤差 α 以内。
+    値が exact_max 件以下のセルはバケットにせず生の値（exact_cell / exact_value）で持つ。
+
+    cell / bucket / count: バケットにしたセルの (セルID, バケット, 件数)
+    n_cells: セルIDの上限（0〜n_cells-1）
+    """
+    relative_error: float
+    exact_max: int
+    n_cells: int
+    cell: np.ndarray
+    bucket: np.ndarray
+    count: np.ndarray
+    exact_cell: np.ndarray
+    exact_value: np.ndarray
+
+    @property
+    def gamma(self) -> float:
+        return (1 + self.relative_error) / (1 - self.relative_error)
+
+
+def _buckets(values: np.ndarray, gamma: float) -> np.ndarray:
+    out = np.full(len(values), _ZERO_BUCKET, dtype=np.int32)
+    pos = values > 0
+    out[pos] = np.ceil(np.log(values[pos]) / np.log(gamma)).astype(np.int32)
+    return out
+
+
+def _bucket_values(buckets: np.ndarray, gamma: float) -> np.ndarray:
+    out = 2.0 * np.power(gamma, buckets.astype(float)) / (gamma + 1.0)
+    return np.where(buckets == _ZERO_BUCKET, 0.0, out)
+
+
+def _collapse(cell: np.ndarray, bucket: np.ndarray, count: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """同じ (セル, バケット) の件数をまとめる（セル・バケット順）"""
+    if len(cell) == 0:
+        return cell.astype(np.int64), bucket.astype(np.int32), count.astype(np.int64)
+    order = np.lexsort((bucket, cell))
+    cell, bucket, count = cell[order], bucket[order], count[order]
+    first = np.r_[True, (cell[1:] != cell[:-1]) | (bucket[1:] != bucket[:-1])]
+    starts = np.flatnonzero(first)
+    return cell[starts].astype(np.int64), bucket[starts].astype(np.int32), np.add.reduceat(count, starts).astype(np.int64)
+
+
+def _assemble(
+    relative_error: float,
+    exact_max: int,
+    n_cells: int,
+    cell: np.ndarray,
+    bucket: np.ndarray,
+    count: np.ndarray,
+    exact_cell: np.ndarray,
+    exact_value: np.ndarray,
+) -> QuantileSketch:
+    """件数が exact_max を超えたセルの生の値をバケットに移して組み立てる"""
+    gamma = (1 + relative_error) / (1 - relative_error)
+    totals = np.bincount(cell, weights=count, minlength=n_cells) + np.bincount(exact_cell, minlength=n_cells)
+    # バケットを持つセルに後から足された生の値もバケットに移す（セルはどちらか一方で持つ）
+    bucketed = np.bincount(cell, minlength=n_cells) > 0
+    spill = (totals[exact_cell] > exact_max) | bucketed[exact_cell]
+    if spill.any():
+        cell = np.concatenate([cell, exact_cell[spill]])
+        bucket = np.concatenate([bucket, _buckets(exact_value[spill], gamma)])
+        count = np.concatenate([count, np.ones(int(spill.sum()), dtype=np.int64)])
+        exact_cell, exact_value = exact_cell[~spill], exact_value[~spill]
+    cell, bucket, count = _collapse(cell, bucket, count)
+    # 削除で件数が 0 になったバケットは落とす
+    live = count != 0
+    cell, bucket, count = cell[live], bucket[live], count[live]
+    order = np.argsort(exact_cell, kind="stable")
+    return QuantileSketch(
+        relative_error=relative_error,
+        exact_max=exact_max,
+        n_cells=n_cells,
+        cell=cell,
+        bucket=bucket,
+        count=count,
+        exact_cell=exact_cell[order].astype(np.int64),
+        exact_value=exact_value[order].astype(float),
+    )
+
+
+def build_quantile_sketch(
+    cell: np.ndarray,
+    values: np.ndarray,
+    n_cells: int,
+    relative_error: float = DEFAULT_RELATIVE_ERROR,
+    exact_max: int = EXACT_MAX_ITEMS,
+) -> QuantileSketch:
+    """値毎のセルIDと値からスケッチを作る"""
+    if not 0 < relative_error < 1:
+        raise ValueError(f"relative_error must be in (0, 1): {relative_error}")
+    empty = np.zeros(0, dtype=np.int64)
+    return _assemble(
+        relative_error, exact_max, n_cells,
+        empty, np.zeros(0, dtype=np.int32), empty,
+        np.asarray(cell, dtype=np.int64), np.asarray(values, dtype=float),
+    )
+
+
+def merge_sketches(a: QuantileSketch, b: QuantileSketch) -> QuantileSketch:
+    """同じセルID空間の2つのスケッチを合算する（同じセルの件数は足し合わせる）"""
+    if (a.relative_error, a.exact_max) != (b.relative_error, b.exact_max):
+        raise ValueError("sketches with different error settings cannot be merged")
+    return _assemble(
+        a.relative_error, a.exact_max, max(a.n_cells, b.n_cells),
+        np.concatenate([a.cell, b.cell]), np.concatenate([a.bucket, b.bucket]), np.concatenate([a.count, b.count]),
+        np.concatenate([a.exact_cell, b.exact_cell]), np.concatenate([a.exact_value, b.exact_value]),
+    )
+
+
+def sketch_update(
+    sketch: QuantileSketch,
+    add_cell: np.ndarray,
+    add_values: np.ndarray,
+    remove_cell: np.ndarray,
+    remove_values: np.ndarray,
+    n_cells: int = 0,
+) -> QuantileSketch:
+    """値の追加と削除を反映する（削除する値はそのセルに入っているものに限る）
+
+    バケットのセルは件数を引き、生の値のセルは同じ値を1件ずつ取り除く。
+    セルIDの上限は n_cells まで広げられる。
+    """
+    n_cells = max(n_cells, sketch.n_cells)
+    add_cell = np.asarray(add_cell, dtype=np.int64)
+    remove_cell = np.asarray(remove_cell, dtype=np.int64)
+    remove_values = np.asarray(remove_values, dtype=float)
+    bucketed = np.zeros(n_cells, dtype=bool)
+    bucketed[sketch.cell] = True
+    rb = bucketed[remove_cell]
+
+    # 生の値: (セル, 値, 同じ値の何件目か) が一致するものを取り除く
+    exact_cell, exact_value = sketch.exact_cell, sketch.exact_value
+    touched = np.isin(exact_cell, remove_cell[~rb])
+    if touched.any():
+        held = pd.DataFrame({"cell": exact_cell[touched], "value": exact_value[touched]})
+        gone = pd.DataFrame({"cell": remove_cell[~rb], "value": remove_values[~rb]})
+        held["k"] = held.groupby(["cell", "value"]).cumcount()
+        gone["k"] = gone.groupby(["cell", "value"]).cumcount()
+        drop = pd.MultiIndex.from_frame(held).isin(pd.MultiIndex.from_frame(gone))
+        keep = np.ones(len(exact_cell), dtype=bool)
+        keep[np.flatnonzero(touched)[drop]] = False
+        exact_cell, exact_value = exact_cell[keep], exact_value[keep]
+
+    return _assemble(
+        sketch.relative_error, sketch.exact_max, n_cells,
+        np.concatenate([sketch.cell, remove_cell[rb]]),
+        np.concatenate([sketch.bucket, _buckets(remove_values[rb], sketch.gamma)]),
+        np.concatenate([sketch.count, np.full(int(rb.sum()), -1, dtype=np.int64)]),
+        np.concatenate([exact_cell, add_cell]),
+        np.concatenate([exact_value, np.asarray(add_values, dtype=float)]),
+    )
+
+
+def sketch_take(sketch: QuantileSketch, cell_ids: np.ndarray) -> QuantileSketch:
+    """指定したセルだけのスケッチ（セルIDはそのまま）"""
+    keep = np.zeros(sketch.n_cells, dtype=bool)
+    keep[cell_ids] = True
+    kb, ke = keep[sketch.cell], keep[sketch.exact_cell]
+    return QuantileSketch(
+        relative_error=sketch.relative_error,
+        exact_max=sketch.exact_max,
+        n_cells=sketch.n_cells,
+        cell=sketch.cell[kb],
+        bucket=sketch.bucket[kb],
+        count=sketch.count[kb],
+        exact_cell=sketch.exact_cell[ke],
+        exact_value=sketch.exact_value[ke],
+    )
+
+
+def _interpolate(lo_val: np.ndarray, hi_val: np.ndarray, pos: np.ndarray) -> np.ndarray:
+    return lo_val + (pos - np.floor(pos)) * (hi_val - lo_val)
+
+
+def sketch_quantile(sketch: QuantileSketch, cell_group: np.ndarray, ngroups: int, q: float = 0.5) -> np.ndarray:
+    """セルをグループにまとめたときのグループ毎の q 分位点（空グループは0）
+
+    cell_group はセルID → グループコード（-1 は対象外）。値が exact_max 件以下で生の値だけの
+    グループは生の値から厳密に（np.quantile の linear と同じ）、それ以外はバケット件数を
+    合算して相対誤差 relative_error 以内で求める。
+    """
+    out = np.zeros(ngroups)
+    gamma = sketch.gamma
+    gb = cell_group[sketch.cell]
+    ge = cell_group[sketch.exact_cell]
+    n = (np.bincount(gb[gb >= 0], weights=sketch.count[gb >= 0], minlength=ngroups)
+         + np.bincount(ge[ge >= 0], minlength=ngroups)).astype(np.int64)
+    # 生の値だけで持っているグループ（削除でバケットのセルが小さくなった場合を除き、件数 exact_max 以下）
+    has_bucket = np.bincount(gb[gb >= 0], minlength=ngroups) > 0
+    exact = (n > 0) & (n <= sketch.exact_max) & ~has_bucket
+    approx = (n > 0) & ~exact
+    # 末尾に False を足して、グループ -1（対象外）を引いたときに False になるようにする
+    exact_of = np.append(exact, False)
+    approx_of = np.append(approx, False)
+
+    # 小さいグループ: 含まれるセルはすべて生の値を持っている
+    use = exact_of[ge]
+    if use.any():
+        g, v = ge[use], sketch.exact_value[use]
+        order = np.lexsort((v, g))
+        sv = v[order]
+        m = np.where(exact, n, 0)
+        starts = (np.cumsum(m) - m)[exact]
+        pos = q * (n[exact] - 1)
+        lo = starts + np.floor(pos).astype(np.int64)
+        hi = starts + np.ceil(pos).astype(np.int64)
+        out[exact] = _interpolate(sv[lo], sv[hi], pos)
+
+    if approx.any():
+        # 大きいグループ: バケット件数と（バケットにしていないセルの）生の値を同じバケットで合算
+        sel_b = approx_of[gb]
+        sel_e = approx_of[ge]
+        g = np.concatenate([gb[sel_b], ge[sel_e]])
+        b = np.concatenate([sketch.bucket[sel_b], _buckets(sketch.exact_value[sel_e], gamma)])
+        c = np.concatenate([sketch.count[sel_b], np.ones(int(sel_e.sum()), dtype=np.int64)])
+        g, b, c = _collapse(g, b, c)
+        cum = np.cumsum(c)
+        starts = np.searchsorted(g, np.flatnonzero(approx))
+        base = np.where(starts > 0, cum[np.maximum(starts - 1, 0)], 0)
+        pos = q * (n[approx] - 1)
+        lo = np.searchsorted(cum, base + np.floor(pos) + 1)
+        hi = np.searchsorted(cum, base + np.ceil(pos) + 1)
+        out[approx] = _interpolate(_bucket_values(b[lo], gamma), _bucket_values(b[hi], gamma), pos)
+    return out
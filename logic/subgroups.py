@@ -0,0 +1,167 @@
+from __future__ import annotations
+import heapq
+import time
+import pandas as pd
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from logic.attribution import _combine_codes
+
+# 勝ち筋セグメントの探索に使う軸（列 → 表示名）。貢献フラグは別に「フラグが立っている」条件だけを使う
+SUBGROUP_DIMS: Dict[str, str] = {
+    "_age_band": "年代",
+    "_asset_band": "資産",
+    "_utm_source": "utm_source",
+    "_utm_campaign": "utm_campaign",
+    "_sales_owner": "担当者",
+    "_trigger": "きっかけ",
+}
+
+SUBGROUP_COLS = ["segment", "depth", "leads", "qualified", "won", "won_rate_in_qualified", "lift", "revenue_sum"]
+
+
+def _dim_codes(df: pd.DataFrame, dims: List[str], flags: List[str]) -> Tuple[List[np.ndarray], List[List[str]]]:
+    """軸毎の (行 → 値コード, 値の表示ラベル)。貢献フラグは 1 = フラグあり"""
+    codes, labels = [], []
+    for d in dims:
+        c, uniques = pd.factorize(df[d], use_na_sentinel=False)
+        codes.append(c)
+        labels.append(["(空欄)" if pd.isna(u) or u == "" else str(u) for u in uniques])
+    for f in flags:
+        codes.append(df[f].to_numpy(dtype=bool).astype(np.int64))
+        labels.append(["", "あり"])
+    return codes, labels
+
+
+def discover_subgroups(
+    df: pd.DataFrame,
+    dims: Optional[Sequence[str]] = None,
+    contrib_cols: Optional[Sequence[str]] = None,
+    max_depth: int = 3,
+    min_qualified: int = 10,
+    min_won: int = 2,
+    top_k: int = 20,
+    time_budget: float = 5.0,
+) -> Tuple[pd.DataFrame, Dict[str, float]]:
+    """成約率(Qualified内)が全体より高いセグメント（軸の値の組合せ、最大 max_depth 条件）を探す
+
+    Qualified 行だけを全軸の値の組合せ（セル）に畳み、セル単位で集計する。
+    候補は「上界が大きい順」に広げ（best-first）、次の2つで枝刈りする。
+    - 支持度: Qualified が min_qualified 未満・成約が min_won 未満の候補は、
+      条件を足しても増えないので子を作らない（apriori）
+    - 楽観的上界: 条件を足した子の成約率は min(1, 成約 / min_qualified) を超えないので、
+      そのリフトが上位 top_k 件目に届かない候補は広げない
+    time_budget 秒を超えたらその時点の上位を返す（stats["complete"] = 0）。
+
+    Returns:
+        (SUBGROUP_COLS の表（lift の降順）, 探索の統計)
+    """
+    t0 = time.perf_counter()
+    dims = [d for d in (dims if dims is not None else SUBGROUP_DIMS) if d in df.columns]
+    flags = [f"_contrib__{c}" for c in (contrib_cols or []) if f"_contrib__{c}" in df.columns]
+    names = [SUBGROUP_DIMS.get(d, d) for d in dims] + [f"貢献:{f[len('_contrib__'):]}" for f in flags]
+    stats = {"candidates": 0, "expanded": 0, "pruned": 0, "complete": 1, "seconds": 0.0}
+
+    is_q = df["_is_qualified"].to_numpy(dtype=bool)
+    is_w = df["_is_won"].to_numpy(dtype=bool)
+    n_q = int(is_q.sum())
+    base_rate = is_w[is_q].sum() / n_q if n_q else 0.0
+    if not (dims or flags) or base_rate == 0:
+        stats["seconds"] = time.perf_counter() - t0
+        return pd.DataFrame(columns=SUBGROUP_COLS), stats
+
+    codes, labels = _dim_codes(df, dims, flags)
+    n_dims = len(codes)
+    flag_dim = np.array([i >= len(dims) for i in range(n_dims)])
+
+    # Qualified 行を全軸の組合せのセルに畳む（セル毎の Qualified 数・成約数）
+    q_rows = np.flatnonzero(is_q)
+    q_codes = pd.DataFrame({i: c[q_rows] for i, c in enumerate(codes)})
+    cell, n_cells = _combine_codes(q_codes, list(range(n_dims)))
+    member = np.empty(n_cells, dtype=np.int64)
+    member[cell] = np.arange(len(cell))
+    cell_codes = [q_codes[i].to_numpy()[member] for i in range(n_dims)]
+    cell_q = np.bincount(cell, minlength=n_cells).astype(float)
+    cell_w = np.bincount(cell, weights=is_w[q_rows], minlength=n_cells)
+
+    top: List[Tuple[float, float, int, tuple]] = []  # (lift, won, 通し番号, 条件) の最小ヒープ
+    seq = 0
+
+    def threshold() -> float:
+        return top[0][0] if len(top) >= top_k else 0.0
+
+    # 探索キュー: (-上界, 通し番号, 条件, 最後に使った軸, セル)
+    queue = [(-np.inf, 0, (), -1, np.arange(n_cells))]
+    while queue:
+        neg_bound, _, conds, last, cells = heapq.heappop(queue)
+        if -neg_bound <= threshold():
+            # 残りの候補の上界はすべてこれ以下
+            stats["pruned"] += len(queue) + 1
+            break
+        if time.perf_counter() - t0 > time_budget:
+            stats["complete"] = 0
+            break
+        stats["expanded"] += 1
+
+        wq, ww = cell_q[cells], cell_w[cells]
+        for d in range(last + 1, n_dims):
+            c = cell_codes[d][cells]
+            n_vals = len(labels[d])
+            q_by = np.bincount(c, weights=wq, minlength=n_vals)
+            w_by = np.bincount(c, weights=ww, minlength=n_vals)
+            ok = (q_by >= min_qualified) & (w_by >= min_won)
+            if flag_dim[d]:
+                ok[0] = False
+            stats["pruned"] += int((~ok & (q_by > 0)).sum())
+            vals = np.flatnonzero(ok)
+            if not len(vals):
+                continue
+            stats["candidates"] += len(vals)
+            lift = w_by[vals] / q_by[vals] / base_rate
+            for i in np.argsort(-lift, kind="stable"):
+                if lift[i] <= threshold():
+                    break
+                seq += 1
+                item = (lift[i], w_by[vals[i]], seq, conds + ((d, int(vals[i])),))
+                if len(top) < top_k:
+                    heapq.heappush(top, item)
+                else:
+                    heapq.heapreplace(top, item)
+
+            if len(conds) + 1 >= max_depth or d + 1 >= n_dims:
+                continue
+            bounds = np.minimum(1.0, w_by[vals] / max(min_qualified, 1)) / base_rate
+            keep = bounds > threshold()
+            stats["pruned"] += int((~keep).sum())
+            if not keep.any():
+                continue
+            # 値毎の子のセルは、値でソートしたセル列の連続区間
+            order = np.argsort(c, kind="stable")
+            ends = np.cumsum(np.bincount(c, minlength=n_vals))
+            for v, b in zip(vals[keep], bounds[keep]):
+                seq += 1
+                start = ends[v - 1] if v else 0
+                heapq.heappush(queue, (-b, seq, conds + ((d, int(v)),), d, cells[order[start:ends[v]]]))
+
+    rows = []
+    revenue = df["_revenue"].to_numpy(dtype=float)
+    for lift, _, _, conds in sorted(top, key=lambda t: (-t[0], -t[1])):
+        mask = np.ones(len(df), dtype=bool)
+        for d, v in conds:
+            mask &= codes[d] == v
+        qualified = int((mask & is_q).sum())
+        won = int((mask & is_w & is_q).sum())
+        rows.append({
+            "segment": " & ".join(
+                names[d] if flag_dim[d] else f"{names[d]}={labels[d][v]}" for d, v in conds
+            ),
+            "depth": len(conds),
+            "leads": int(mask.sum()),
+            "qualified": qualified,
+            "won": won,
+            "won_rate_in_qualified": won / qualified if qualified else 0.0,
+            "lift": lift,
+            "revenue_sum": float(revenue[mask].sum()),
+        })
+    stats["seconds"] = time.perf_counter() - t0
+    return pd.DataFrame(rows, columns=SUBGROUP_COLS), stats
@@ -0,0 +1,53 @@
+import hashlib
+import streamlit as st
+import pandas as pd
+from logic.cube import FunnelCube, build_funnel_cube
+from logic.filter_index import FilterIndex, build_filter_index
+
+# 描画されない（非表示タブの）ウィジェットも値を保持するキーの接頭辞
+PERSISTED_WIDGET_PREFIXES = ("map_", "data_", "funnel_", "segment_", "channel_", "model_")
+
+
+def keep_widget_state():
+    """非表示タブのウィジェット値を session_state に残す
+
+    Streamlit はその回に描画されなかったウィジェットの値を破棄するので、
+    表示タブだけを描画する構成では毎回書き戻して保持する。
+    """
+    for k in list(st.session_state.keys()):
+        if isinstance(k, str) and k.startswith(PERSISTED_WIDGET_PREFIXES):
+            st.session_state[k] = st.session_state[k]
+
+
+def dataset_id() -> str:
+    """整備済みデータの識別子（タブ毎のキャッシュキーに使う）"""
+    did = st.session_state.get("dataset_id")
+    if did is None:
+        df = st.session_state.df
+        h = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        did = h.hexdigest()
+        st.session_state.dataset_id = did
+    return did
+
+
+def get_cube() -> FunnelCube:
+    cube = st.session_state.get("cube")
+    if cube is None:
+        cube = build_funnel_cube(st.session_state.df)
+        st.session_state.cube = cube
+    return cube
+
+
+def get_filter_index() -> FilterIndex:
+    index = st.session_state.get("filter_index")
+    if index is None:
+        index = build_filter_index(st.session_state.df)
+        st.session_state.filter_index = index
+    return index
+
+
+def filters_key(filters) -> tuple:
+    """フィルタ辞書をキャッシュキーにできる形（ハッシュ可能・順序非依存）にする"""
+    if not filters:
+        return ()
+    return tuple(sorted((k, tuple(sorted(v, key=str))) for k, v in filters.items() if v is not None))
@@ -1,8 +1,51 @@
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
-import pandas as pd
-from logic.attribution import rank_by_metric, contrib_flag_table
+from logic.attribution import (
+    crosstab,
+    rank_by_metric,
+    contrib_flag_analysis,
+    contrib_shapley,
+    cooccurrence_matrix,
+)
+from logic.cube import cube_filter
+from logic.filter_index import apply_selection
+from ui.state import dataset_id, filters_key, get_cube, get_filter_index
+
+
+def _base_frames(df, cube, index, filters, selection, downstream: bool):
+    """フィルタ・ステージ適用後の (行データ, キューブ)。キャッシュが外れたときだけ呼ぶ"""
+    if filters:
+        df = apply_selection(df, index, selection)
+        cube = cube_filter(cube, {k: list(v) for k, v in filters})
+    if downstream:
+        df = df[df["_is_qualified"] == True]
+        cube = cube_filter(cube, {"_is_qualified": [True]})
+    return df, cube
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _channel_rank(dataset_id: str, filters: tuple, downstream: bool, utm_key: str, metric: str, min_leads: int, _df, _cube, _index, _selection):
+    base_df, base_cube = _base_frames(_df, _cube, _index, filters, _selection, downstream)
+    return rank_by_metric(base_df, utm_key, metric, min_leads=min_leads, cube=base_cube)
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _channel_cross(
+    dataset_id: str, filters: tuple, downstream: bool, dims: tuple, min_leads: int, sort_by: str, top_k: int,
+    _df, _cube, _index, _selection,
+):
+    base_df, base_cube = _base_frames(_df, _cube, _index, filters, _selection, downstream)
+    return crosstab(base_df, list(dims), min_leads=min_leads, top_k=top_k, sort_by=sort_by, cube=base_cube)
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _channel_contrib(dataset_id: str, filters: tuple, downstream: bool, contrib_cols: tuple, _df, _cube, _index, _selection):
+    """貢献フラグ別・組合せ別の集計と Shapley 配分（最小母数や表示指標に依らない部分）"""
+    base_df, _ = _base_frames(_df, _cube, _index, filters, _selection, downstream)
+    tf, pairs = contrib_flag_analysis(base_df, list(contrib_cols))
+    sh = contrib_shapley(base_df, list(contrib_cols))
+    return tf, pairs, sh
 
 
 def render_channel_tab():
@@ -12,23 +55,32 @@ def render_channel_tab():
         st.info("Dataタブで整備を完了してください。")
         return
 
+    cube = get_cube()
+
+    selection = st.session_state.get("row_selection")
+    filters = ()
+    if selection is not None and st.checkbox("Funnelタブのフィルタ（月・担当者・資産）を適用", value=False, key="channel_use_filters"):
+        filters = filters_key(st.session_state.filters)
+    index = get_filter_index() if filters else None
+    did = dataset_id()
+
     # 上流/下流切替
     view = st.radio(
         "分析ステージ",
         ["上流：全リード → Qualified", "下流：Qualified → 成約"],
         horizontal=True,
+        key="channel_view",
     )
 
-    if view.startswith("上流"):
-        base_df = df.copy()
+    downstream = not view.startswith("上流")
+    if not downstream:
         metric = "qualified_rate"
         metric_label = "Qualified率"
     else:
-        base_df = df[df["_is_qualified"] == True].copy()
         metric = "won_rate_in_qualified"
         metric_label = "成約率(Qualified内)"
 
-    min_leads = st.slider("最小母数（少ないグループを除外）", 3, 100, 10, 1)
+    min_leads = st.slider("最小母数（少ないグループを除外）", 3, 100, 10, 1, key="channel_min_leads")
 
     # --- UTM別ランキング ---
     st.markdown("### 🏷️ UTM別ランキング")
@@ -43,10 +95,10 @@ def render_channel_tab():
 
     tc1, tc2 = st.columns([1, 3])
     with tc1:
-        utm_label = st.selectbox("グルーピング", list(utm_options.keys()), index=0)
+        utm_label = st.selectbox("グルーピング", list(utm_options.keys()), index=0, key="channel_group")
     utm_key = utm_options[utm_label]
 
-    t = rank_by_metric(base_df, utm_key, metric, min_leads=min_leads)
+    t = _channel_rank(did, filters, downstream, utm_key, metric, min_leads, df, cube, index, selection)
 
     if len(t) > 0:
         # グラフ
@@ -79,23 +131,27 @@ def render_channel_tab():
     else:
         st.info(f"母数{min_leads}以上のグループがありません。フィルタを緩めてください。")
 
-    # --- utm_source × utm_campaign のクロス集計 ---
-    st.markdown("### 🔀 Source × Campaign クロス")
-    cross = base_df.groupby(["_utm_source", "_utm_campaign"]).apply(
-        lambda g: pd.Series({
-            "leads": len(g),
-            "qualified": int(g["_is_qualified"].sum()),
-            "won": int(g["_is_won"].sum()),
-            "qualified_rate": g["_is_qualified"].mean(),
-            "won_rate": g["_is_won"].mean(),
-            "revenue": g["_revenue"].sum(),
-        })
-    ).reset_index()
-    cross = cross[cross["leads"] >= min_leads].sort_values("revenue", ascending=False)
-
-    if len(cross):
-        with st.expander("Source × Campaign 詳細", expanded=True):
-            st.dataframe(cross.head(30), use_container_width=True)
+    # --- UTM軸の組合せのクロス集計 ---
+    st.markdown("### 🔀 クロス集計（軸の組合せ）")
+    xc1, xc2 = st.columns([3, 1])
+    with xc1:
+        cross_labels = st.multiselect(
+            "軸", list(utm_options.keys()), default=["utm_source", "utm_campaign"], key="channel_cross_dims",
+        )
+    cross_sort = {"売上合計": "revenue_sum", "リード数": "leads", "成約数": "won", "ステージの率": metric}
+    with xc2:
+        sort_label = st.selectbox("並び順", list(cross_sort.keys()), key="channel_cross_sort")
+    dims = tuple(utm_options[k] for k in cross_labels)
+
+    if dims:
+        cross = _channel_cross(did, filters, downstream, dims, min_leads, cross_sort[sort_label], 30, df, cube, index, selection)
+        if len(cross):
+            with st.expander(f"{' × '.join(cross_labels)} 上位{len(cross)}件", expanded=True):
+                display_cols = list(dims) + ["leads", "qualified", "won", "qualified_rate",
+                                             "won_rate", "won_rate_in_qualified", "revenue_sum", "median_ticket"]
+                st.dataframe(cross[display_cols], use_container_width=True)
+        else:
+            st.info(f"母数{min_leads}以上の組合せがありません。")
 
     # --- 貢献フラグ ---
     st.markdown("### 🏴 貢献フラグ別ファネル")
@@ -106,7 +162,7 @@ def render_channel_tab():
         st.info("貢献フラグ列が見つかりませんでした。")
         return
 
-    tf = contrib_flag_table(base_df, contrib_cols)
+    tf, pairs, sh = _channel_contrib(did, filters, downstream, tuple(contrib_cols), df, cube, index, selection)
     tf = tf[tf["leads"] >= 1].sort_values(metric, ascending=False)
 
     if len(tf):
@@ -129,3 +185,65 @@ def render_channel_tab():
             st.dataframe(tf, use_container_width=True)
     else:
         st.info("条件を満たす貢献フラグがありません。")
+
+    # --- 貢献フラグの重複 ---
+    st.markdown("### 🔗 貢献フラグの重複（マルチタッチ）")
+    st.caption("2つのフラグが同時にTRUEのリード。Jaccard = 両方 / どちらか")
+
+    pairs = pairs[pairs["leads"] >= min_leads]
+    if len(pairs):
+        overlap = cooccurrence_matrix(pairs, "jaccard")
+        fig_overlap = px.imshow(
+            overlap.astype(float),
+            aspect="auto",
+            color_continuous_scale="Purples",
+            text_auto=".0%",
+        )
+        fig_overlap.update_layout(
+            height=450,
+            xaxis_title="",
+            yaxis_title="",
+            margin=dict(l=0, r=0, t=30, b=0),
+        )
+        st.plotly_chart(fig_overlap, use_container_width=True)
+
+        with st.expander("フラグ組合せ詳細データ"):
+            st.dataframe(pairs.sort_values(metric, ascending=False), use_container_width=True)
+    else:
+        st.info(f"母数{min_leads}以上のフラグ組合せがありません。")
+
+    # --- Shapley配分 ---
+    st.markdown("### ⚖️ 貢献フラグのShapley配分")
+    st.caption(
+        "複数フラグが立つリードの成果を、フラグ組合せ別のリードあたり成果から"
+        "Shapley値で按分（重複計上なし。フラグなしの基準率ぶんはベースライン）"
+    )
+
+    shapley_targets = {"成約数": "won", "売上": "revenue"}
+    sv_label = st.radio("配分対象", list(shapley_targets.keys()), horizontal=True, key="channel_shapley_target")
+    sv = shapley_targets[sv_label]
+    naive_col = "won" if sv == "won" else "revenue_sum"
+
+    if len(sh):
+        sh = sh.sort_values(f"{sv}_shapley", ascending=False)
+        fig_sh = go.Figure()
+        fig_sh.add_trace(go.Bar(
+            x=sh["flag"], y=sh[naive_col],
+            name="単純集計（重複あり）", marker_color="#d9d9d9",
+        ))
+        fig_sh.add_trace(go.Bar(
+            x=sh["flag"], y=sh[f"{sv}_shapley"],
+            name="Shapley配分", marker_color="#9467bd",
+        ))
+        fig_sh.update_layout(
+            barmode="group", height=380,
+            legend=dict(orientation="h", y=-0.35),
+            margin=dict(l=0, r=0, t=30, b=0),
+        )
+        fig_sh.update_xaxes(tickangle=45)
+        st.plotly_chart(fig_sh, use_container_width=True)
+
+        with st.expander("Shapley配分詳細データ"):
+            st.dataframe(sh, use_container_width=True)
+    else:
+        st.info("Shapley配分を計算できるデータがありません。")
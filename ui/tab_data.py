@@ -1,29 +1,52 @@
 import streamlit as st
-import pandas as pd
 from logic.schema import ColumnMap, STD_COLS
 from logic.preprocess import preprocess
+from logic.ingest import ingest_columns, read_preview, read_sheet, sheet_names
+from logic.dataset_cache import dataset_key, load_cached, store_cached
+from logic.cube import build_funnel_cube
+from logic.filter_index import build_filter_index
+from logic.incremental import upsert_key, upsert_leads
+from ui.state import get_cube, get_filter_index
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_sheet_names(file_id: str, _data: bytes):
+    return sheet_names(_data)
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_preview(file_id: str, sheet: str, _data: bytes):
+    return read_preview(_data, sheet)
 
 
 def render_data_tab():
     st.subheader("📥 Data（Excel取り込み・整備）")
+    _render_import()
+    # 他のタブから戻るとアップロードは消えるが、整備済みデータのサマリと差分取り込みは出し続ける
+    if st.session_state.get("df") is not None:
+        _render_summary()
 
+
+def _render_import():
+    """アップロード・プレビュー・列マッピング・整備"""
     uploaded = st.file_uploader("Excelファイル（.xlsx）をアップロード", type=["xlsx", "xls"])
     if not uploaded:
         st.info("Excelをアップロードしてください。")
         return
 
-    xls = pd.ExcelFile(uploaded)
-    sheet = st.selectbox("読み込むシート", options=xls.sheet_names, index=0)
-    df_raw = pd.read_excel(uploaded, sheet_name=sheet)
-    st.session_state.df_raw = df_raw
+    # ワークブックは file_id 単位でキャッシュし、リランの度にパースしない
+    data = uploaded.getvalue()
+    sheet = st.selectbox("読み込むシート", options=_cached_sheet_names(uploaded.file_id, data), index=0)
+    preview, n_rows = _cached_preview(uploaded.file_id, sheet, data)
 
-    st.caption(f"プレビュー（{len(df_raw):,}行 × {len(df_raw.columns)}列）")
-    st.dataframe(df_raw.head(15), use_container_width=True, height=300)
+    n_rows_label = f"{n_rows:,}" if n_rows is not None else "?"
+    st.caption(f"プレビュー（{n_rows_label}行 × {len(preview.columns)}列）")
+    st.dataframe(preview, use_container_width=True, height=300)
 
     # 列マッピング
     st.markdown("#### 列マッピング")
     st.caption("Excel列名が標準名と一致していれば自動マッピングされます。ズレている場合は手動で修正してください。")
-    cols = list(df_raw.columns)
+    cols = list(preview.columns)
     default_map = ColumnMap.default_from_df_columns(cols).mapping
 
     colmap = {}
@@ -45,29 +68,128 @@ def render_data_tab():
         if selected != "(なし)":
             colmap[internal] = selected
 
+    compact = st.checkbox(
+        "省メモリモード（元の列を持たず、テキスト列をカテゴリ型・月を月コードで保持）",
+        value=False,
+        key="data_compact",
+    )
+
     if st.button("🔄 整備して分析タブへ反映", type="primary", use_container_width=True):
-        df, meta = preprocess(df_raw, colmap)
+        # 同じファイル・シート・列マッピングなら整備済みデータをディスクから読む
+        key = dataset_key(data, sheet, colmap, compact=compact)
+        cached = load_cached(key)
+        if cached is not None:
+            df, meta = cached
+            st.session_state.df_raw = None
+        else:
+            # 使う列（マッピング済み＋貢献フラグ）だけを読み込む
+            with st.spinner("読み込み中..."):
+                df_raw = read_sheet(data, sheet, usecols=ingest_columns(cols, colmap))
+            st.session_state.df_raw = df_raw
+            df, meta = preprocess(df_raw, colmap, compact=compact)
+            store_cached(key, df, meta)
         st.session_state.df = df
         st.session_state.meta = meta
         st.session_state.colmap = colmap
+        st.session_state.dataset_id = key
+        st.session_state.cube = build_funnel_cube(df)
+        st.session_state.filter_index = build_filter_index(df)
+        st.session_state.lead_index = None
+        st.session_state.filters = {}
+        st.session_state.row_selection = None
         st.success("✅ 整備完了！上部のタブで分析できます。")
 
-    if st.session_state.get("df") is not None:
-        meta = st.session_state.meta
-        st.markdown("---")
-        st.markdown("#### 整備結果サマリ")
 
-        m1, m2, m3, m4, m5 = st.columns(5)
-        m1.metric("総リード数", f"{meta.get('rows', 0):,}")
-        m2.metric("Qualified数", f"{meta.get('qualified_count', 0):,}")
-        m3.metric("成約数", f"{meta.get('won_count', 0):,}")
-        m4.metric("売上合計", f"¥{meta.get('revenue_sum', 0):,.0f}")
-        m5.metric("期間", meta.get("date_range", "N/A"))
+def _render_summary():
+    """整備結果サマリ（件数・メモリ使用量・マルチタッチ率）と差分取り込み"""
+    meta = st.session_state.meta
+    st.markdown("---")
+    st.markdown("#### 整備結果サマリ")
+
+    m1, m2, m3, m4, m5 = st.columns(5)
+    m1.metric("総リード数", f"{meta.get('rows', 0):,}")
+    m2.metric("Qualified数", f"{meta.get('qualified_count', 0):,}")
+    m3.metric("成約数", f"{meta.get('won_count', 0):,}")
+    m4.metric("売上合計", f"¥{meta.get('revenue_sum', 0):,.0f}")
+    m5.metric("期間", meta.get("date_range", "N/A"))
 
-        if meta.get("missing_required"):
-            st.warning(f"⚠️ 未マッピング必須列: {meta['missing_required']}")
+    if meta.get("missing_required"):
+        st.warning(f"⚠️ 未マッピング必須列: {meta['missing_required']}")
 
+    if "memory_bytes" in meta:
         st.caption(
-            f"マルチタッチ率（貢献フラグ2つ以上TRUE）: "
-            f"{meta.get('contrib_multi_touch_rate', 0)*100:.1f}%"
+            f"メモリ使用量: 元データ {meta['memory_raw_bytes'] / 1024 ** 2:,.1f} MB → "
+            f"整備後 {meta['memory_bytes'] / 1024 ** 2:,.1f} MB"
+            + ("（省メモリモード）" if meta.get("compact") else "")
         )
+
+    st.caption(
+        f"マルチタッチ率（貢献フラグ2つ以上TRUE）: "
+        f"{meta.get('contrib_multi_touch_rate', 0)*100:.1f}%"
+    )
+
+    if "_row_hash" in st.session_state.df.columns:
+        _render_upsert()
+
+
+def _render_upsert():
+    """新しいエクスポートをリードIDで突き合わせ、追加・変更された行だけを取り込む"""
+    st.markdown("---")
+    st.markdown("#### ➕ 差分取り込み（新しいエクスポートの追加）")
+    st.caption(
+        "整備済みデータにリードID（No）で突き合わせ、新しいリードは追加、内容が変わったリードは置き換えます。"
+        "整備し直すのは追加・変更された行だけです（列マッピングは整備時と同じものを使います）。"
+    )
+    message = st.session_state.pop("upsert_message", None)
+    if message:
+        st.success(message)
+    update = st.file_uploader("新しいエクスポート（.xlsx）", type=["xlsx", "xls"], key="upsert_file")
+    if not update:
+        return
+    data = update.getvalue()
+    sheets = _cached_sheet_names(update.file_id, data)
+    sheet = st.selectbox("読み込むシート", options=sheets, index=0, key="upsert_sheet")
+
+    if st.button("➕ 差分を取り込む", use_container_width=True):
+        colmap = st.session_state.colmap
+        meta = st.session_state.meta
+        key = upsert_key(st.session_state.dataset_id, dataset_key(data, sheet, colmap, compact=meta.get("compact", False)))
+        cached = load_cached(key)
+        if cached is not None:
+            df, meta = cached
+            st.session_state.cube = build_funnel_cube(df)
+            st.session_state.filter_index = build_filter_index(df)
+            st.session_state.lead_index = None
+            message = "✅ 同じ差分を取り込んだ結果をキャッシュから読み込みました。"
+        else:
+            preview, _ = _cached_preview(update.file_id, sheet, data)
+            with st.spinner("読み込み中..."):
+                df_raw = read_sheet(data, sheet, usecols=ingest_columns(list(preview.columns), colmap))
+            try:
+                result = upsert_leads(
+                    st.session_state.df, meta, df_raw, colmap,
+                    cube=get_cube(), filter_index=get_filter_index(),
+                    lead_index=st.session_state.get("lead_index"),
+                )
+            except ValueError as e:
+                st.error(str(e))
+                return
+            df, meta = result.df, result.meta
+            store_cached(key, df, meta)
+            st.session_state.cube = result.cube
+            st.session_state.filter_index = result.filter_index
+            st.session_state.lead_index = result.lead_index
+            message = (
+                f"✅ 追加 {result.inserted:,}件・更新 {result.updated:,}件・変更なし {result.unchanged:,}件"
+                + (f"・ID空欄で除外 {result.skipped:,}件" if result.skipped else "")
+                + f"（{result.seconds:.2f}秒）"
+            )
+        st.session_state.df = df
+        st.session_state.meta = meta
+        st.session_state.df_raw = None
+        st.session_state.dataset_id = key
+        st.session_state.filters = {}
+        st.session_state.row_selection = None
+        # サマリを取り込み後の値で描き直す
+        st.session_state.upsert_message = message
+        st.rerun()
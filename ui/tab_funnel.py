@@ -2,13 +2,31 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from logic.metrics import funnel_kpis, group_funnel
+from logic.cube import cube_filter, cube_group_funnel, cube_kpis
+from logic.filter_index import select_rows
+from logic.dates import format_month
+from ui.state import dataset_id, filters_key, get_cube, get_filter_index
 
 
 def _format_pct(v):
     return f"{v*100:.1f}%"
 
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def _funnel_views(dataset_id: str, filters: tuple, _cube):
+    """フィルタ後のKPI・月次・担当者別（データとフィルタが同じなら再計算しない）"""
+    fcube = cube_filter(_cube, {k: list(v) for k, v in filters})
+    if int(fcube.cells["leads"].sum()) == 0:
+        return None, None, None
+
+    k = cube_kpis(fcube)
+    monthly = cube_group_funnel(fcube, "_month").sort_values("_month")
+    monthly["_month"] = monthly["_month"].map(format_month)
+    by_owner = cube_group_funnel(fcube, "_sales_owner")
+    by_owner = by_owner[(by_owner["_sales_owner"] != "") & (by_owner["leads"] > 0)].sort_values("won_rate_in_qualified", ascending=False)
+    return k, monthly, by_owner
+
+
 def render_funnel_tab():
     st.subheader("🔄 Funnel（資料請求 → Qualified → 成約）")
     df = st.session_state.get("df")
@@ -16,32 +34,40 @@ def render_funnel_tab():
         st.info("Dataタブで整備を完了してください。")
         return
 
+    cube = get_cube()
+    cells = cube.cells
+
     # --- フィルタ ---
     with st.expander("🔍 フィルタ", expanded=False):
         fc1, fc2, fc3 = st.columns(3)
         with fc1:
-            months = sorted(df["_month"].dropna().unique())
-            sel_months = st.multiselect("月", months, default=months, key="funnel_months")
+            months = sorted(cells["_month"].dropna().unique())
+            # 日付を読めなかったリード（月が欠損）も「不明」として選べるようにする
+            if cells["_month"].isna().any():
+                months.append(None)
+            sel_months = st.multiselect("月", months, default=months, format_func=format_month, key="funnel_months")
         with fc2:
-            owners = sorted(df["_sales_owner"].unique())
+            owners = sorted(cells["_sales_owner"].unique())
             sel_owners = st.multiselect("営業担当者", owners, default=owners, key="funnel_owners")
         with fc3:
-            assets = sorted(df["_asset_band"].dropna().unique())
+            assets = sorted(cells["_asset_band"].dropna().unique())
             sel_assets = st.multiselect("純金融資産", [str(a) for a in assets], default=[str(a) for a in assets], key="funnel_assets")
 
-    mask = (
-        df["_month"].isin(sel_months)
-        & df["_sales_owner"].isin(sel_owners)
-        & df["_asset_band"].astype(str).isin(sel_assets)
-    )
-    fdf = df[mask]
+    filters = {
+        "_month": sel_months,
+        "_sales_owner": sel_owners,
+        "_asset_band": sel_assets,
+    }
+    # 行レベルの選択は他タブでも使えるようビットマップで保持
+    st.session_state.filters = filters
+    st.session_state.row_selection = select_rows(get_filter_index(), filters)
 
-    if len(fdf) == 0:
+    k, monthly, by_owner = _funnel_views(dataset_id(), filters_key(filters), cube)
+    if k is None:
         st.warning("フィルタ条件に該当するデータがありません。")
         return
 
     # --- 全体KPI ---
-    k = funnel_kpis(fdf)
     c1, c2, c3, c4, c5, c6 = st.columns(6)
     c1.metric("Leads", f"{int(k['leads']):,}")
     c2.metric("Qualified", f"{int(k['qualified']):,}", _format_pct(k['qualified_rate']))
@@ -62,7 +88,6 @@ def render_funnel_tab():
 
     # --- 月次推移 ---
     st.markdown("### 📅 月次推移")
-    monthly = group_funnel(fdf, "_month").sort_values("_month")
 
     fig_monthly = go.Figure()
     fig_monthly.add_trace(go.Bar(
@@ -91,8 +116,6 @@ def render_funnel_tab():
 
     # --- 営業担当者別 ---
     st.markdown("### 👤 営業担当者別")
-    by_owner = group_funnel(fdf, "_sales_owner")
-    by_owner = by_owner[by_owner["_sales_owner"] != ""].sort_values("won_rate_in_qualified", ascending=False)
 
     fig_owner = go.Figure()
     fig_owner.add_trace(go.Bar(x=by_owner["_sales_owner"], y=by_owner["qualified_rate"], name="Qualified率", marker_color="#2ca02c"))
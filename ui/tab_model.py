@@ -2,10 +2,28 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 from logic.modeling import (
-    feature_importance_classification,
-    feature_importance_regression,
+    CARDINALITY_STRATEGIES,
+    HIGH_CARDINALITY_LEVELS,
+    MODEL_ENGINES,
+    DRIVER_MODELS,
+    FeatureMatrix,
+    ablation_grid,
+    ablation_variants,
+    SCORE_COLUMNS,
+    cached_driver_results,
+    driver_scorer,
+    encode_features,
     get_model_features,
+    score_leads,
+    start_driver_job,
 )
+from ui.state import dataset_id
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _feature_matrix(dataset_id: str, features: tuple, cardinality: str, max_levels: int, _df) -> FeatureMatrix:
+    """データ・特徴量・水準数の扱いの組合せ毎に1回だけエンコード（読み取り専用なのでコピーせず共有）"""
+    return encode_features(_df, list(features), cardinality, max_levels)
 
 
 def render_model_tab():
@@ -22,69 +40,76 @@ def render_model_tab():
 
     # 設定
     with st.expander("⚙️ モデル設定", expanded=True):
-        sc1, sc2, sc3 = st.columns(3)
+        sc1, sc2, sc3, sc4 = st.columns(4)
         with sc1:
-            include_owner = st.checkbox("営業担当者を含める", value=True)
+            include_owner = st.checkbox("営業担当者を含める", value=True, key="model_include_owner")
         with sc2:
-            include_month = st.checkbox("月を含める", value=True)
+            include_month = st.checkbox("月を含める", value=True, key="model_include_month")
         with sc3:
-            n_est = st.slider("推定器数（多い=精度↑ 速度↓）", 50, 300, 100, 50)
+            n_est = st.slider("推定器数（多い=精度↑ 速度↓）", 50, 300, 100, 50, key="model_n_estimators")
+        with sc4:
+            engine = st.selectbox(
+                "エンジン", list(MODEL_ENGINES.keys()),
+                format_func=MODEL_ENGINES.get, key="model_engine",
+            )
+        hc1, hc2, hc3 = st.columns(3)
+        with hc1:
+            include_utm_detail = st.checkbox("utm_medium / utm_content を含める", value=False, key="model_include_utm_detail")
+        with hc2:
+            cardinality = st.selectbox(
+                "水準数の多いカテゴリ列", list(CARDINALITY_STRATEGIES.keys()),
+                format_func=CARDINALITY_STRATEGIES.get, key="model_cardinality",
+            )
+        with hc3:
+            max_levels = st.slider(
+                "K（これより水準が多い列に適用）", 10, 200, HIGH_CARDINALITY_LEVELS, 10,
+                key="model_max_levels", disabled=cardinality == "label",
+            )
 
-    features = get_model_features(df, include_owner=include_owner, include_month=include_month)
+    features = get_model_features(
+        df, include_owner=include_owner, include_month=include_month, include_utm_detail=include_utm_detail,
+    )
+    card = {"cardinality": cardinality, "max_levels": max_levels}
 
     st.caption(f"投入特徴量: {len(features)}個")
     with st.expander("特徴量一覧"):
         st.write(features)
 
-    if st.button("🚀 モデル実行", type="primary", use_container_width=True):
+    # 同じデータ・特徴量・設定で学習済みなら、ボタンを押さなくても前回の結果を出す
+    did = dataset_id()
+    config = (did, tuple(features), n_est, engine, cardinality, max_levels)
+    results = cached_driver_results(did, features, n_estimators=n_est, engine=engine, **card)
 
-        # --- Model A: Qualified ---
-        st.markdown("---")
-        st.markdown("### Model A: Qualified予測（面談に進むかどうか）")
-        df["_target_qualified"] = df["_is_qualified"].astype(int)
-        imp_q = feature_importance_classification(df, features, "_target_qualified", n_estimators=n_est)
-
-        if imp_q is not None:
-            auc = imp_q["auc_cv"].iloc[0]
-            if auc is not None:
-                st.metric("CV AUC", f"{auc:.3f}")
-            _plot_importance(imp_q, "Qualified予測の特徴量重要度")
-        else:
-            st.warning("Qualifiedのサンプルが少なすぎてモデル構築できませんでした。")
+    # 学習はバックグラウンドで回し、このタブは進捗と終わったモデルから表示する
+    job = st.session_state.get("driver_job")
+    job_config = st.session_state.get("driver_job_config")
+    if job is not None and not job.done and job_config != config:
+        st.caption("別の設定での学習がバックグラウンドで実行中です（このまま新しい設定で実行すると取り消します）")
 
-        # --- Model B: Won (within Qualified) ---
-        st.markdown("---")
-        st.markdown("### Model B: 成約予測（Qualified内で成約するか）")
-        q_df = df[df["_is_qualified"] == True].copy()
-        q_df["_target_won"] = q_df["_is_won"].astype(int)
-        imp_w = feature_importance_classification(q_df, features, "_target_won", n_estimators=n_est)
-
-        if imp_w is not None:
-            auc_w = imp_w["auc_cv"].iloc[0]
-            if auc_w is not None:
-                st.metric("CV AUC", f"{auc_w:.3f}")
-            _plot_importance(imp_w, "成約予測の特徴量重要度（Qualified内）")
-        else:
-            st.warning("成約サンプルが少なすぎてモデル構築できませんでした。")
+    if st.button("🚀 モデル実行", type="primary", use_container_width=True) and results is None:
+        if job is None or job_config != config or job.done:
+            if job is not None and not job.done:
+                job.cancel()
+            matrix = _feature_matrix(did, tuple(features), cardinality, max_levels, df)
+            job = start_driver_job(
+                df, features, n_estimators=n_est, engine=engine, matrix=matrix, dataset_id=did, **card,
+            )
+            st.session_state.driver_job = job
+            st.session_state.driver_job_config = job_config = config
 
-        # --- Model C: Revenue Regression ---
-        st.markdown("---")
-        st.markdown("### Model C: 成約単価予測（成約行のみ）")
-        imp_r = feature_importance_regression(df, features, n_estimators=n_est)
-
-        if imp_r is not None:
-            r2 = imp_r["r2_cv"].iloc[0]
-            if r2 is not None:
-                st.metric("CV R²", f"{r2:.3f}")
-            _plot_importance(imp_r, "成約単価の特徴量重要度")
+    if results is not None:
+        st.caption(f"エンジン: {MODEL_ENGINES[engine]} / 同じ条件の学習結果（キャッシュ）を表示しています")
+        _render_results(results)
+        _render_scoring(df, features, n_est, engine, did, card, config)
+    elif job is not None and job_config == config:
+        if job.done:
+            if job.error is not None:
+                st.error(f"学習中にエラーが発生しました: {job.error}")
+            elif job.cancelled:
+                st.warning("学習を取り消しました。終わっていたモデルだけを表示しています。")
+            _render_results(job.results)
         else:
-            st.warning("成約行が少なすぎてモデル構築できませんでした。")
-
-        # --- 交絡チェック ---
-        st.markdown("---")
-        st.markdown("### 🔍 交絡チェック：担当者/月を外した場合の比較")
-        st.caption("担当者や月を外すと重要度がどう変わるか確認できます（設定で切り替え）")
-
+            _job_panel(job, engine)
     else:
         st.info("上の「モデル実行」ボタンを押すと、GBM（勾配ブースティング）による特徴量重要度分析を行います。")
 
@@ -98,6 +123,122 @@ def render_model_tab():
         営業担当者や月を含める/外すことで、広告チャネルの**純粋な効果**と**交絡**を区別できます。
         """)
 
+    # --- 交絡チェック ---
+    st.markdown("---")
+    st.markdown("### 🔍 交絡チェック：特徴量セットを変えた比較")
+    st.caption("担当者・月の有無やチャネルを1つずつ外したパターンを一括で学習し、CVスコアと重要度を並べて比較します")
+    with_channels = st.checkbox(
+        "チャネル（utm・貢献フラグ）を1つずつ外したパターンも含める", value=True, key="model_ablation_channels",
+    )
+
+    if st.button("🧮 交絡チェックを一括実行", use_container_width=True):
+        all_features = get_model_features(
+            df, include_owner=True, include_month=True, include_utm_detail=include_utm_detail,
+        )
+        variants = ablation_variants(all_features, channels=with_channels)
+        matrix = _feature_matrix(did, tuple(all_features), cardinality, max_levels, df)
+        with st.spinner(f"{len(variants)}パターン×3モデルを学習中..."):
+            scores, importance = ablation_grid(
+                df, variants, n_estimators=n_est, engine=engine, matrix=matrix, **card,
+            )
+
+        st.markdown("#### CVスコア（qualified / won: AUC、revenue: R²）")
+        st.dataframe(
+            scores.style.format({m: "{:.3f}" for m in DRIVER_MODELS} | {"fit_seconds": "{:.1f}"}, na_rep="-"),
+            use_container_width=True,
+        )
+
+        st.markdown("#### 特徴量重要度（列=特徴量セット）")
+        for tab, model in zip(st.tabs(["Model A: Qualified", "Model B: 成約", "Model C: 単価"]), DRIVER_MODELS):
+            with tab:
+                if len(importance[model].columns):
+                    st.dataframe(importance[model].style.format("{:.3f}", na_rep="-"), use_container_width=True)
+                else:
+                    st.warning("サンプルが少なすぎてモデル構築できませんでした。")
+
+
+# モデル毎の見出し・CVスコアの列と表示名・グラフタイトル・学習できなかったときの文言
+_MODEL_SECTIONS = {
+    "qualified": (
+        "### Model A: Qualified予測（面談に進むかどうか）", "auc_cv", "CV AUC",
+        "Qualified予測の特徴量重要度", "Qualifiedのサンプルが少なすぎてモデル構築できませんでした。",
+    ),
+    "won": (
+        "### Model B: 成約予測（Qualified内で成約するか）", "auc_cv", "CV AUC",
+        "成約予測の特徴量重要度（Qualified内）", "成約サンプルが少なすぎてモデル構築できませんでした。",
+    ),
+    "revenue": (
+        "### Model C: 成約単価予測（成約行のみ）", "r2_cv", "CV R²",
+        "成約単価の特徴量重要度", "成約行が少なすぎてモデル構築できませんでした。",
+    ),
+}
+
+
+@st.fragment(run_every=1.0)
+def _job_panel(job, engine: str):
+    """学習中の進捗と途中結果（このフラグメントだけを1秒毎に再実行し、他のタブは止めない）"""
+    if job.done:
+        # 終わったらアプリ全体を再実行して、キャッシュ済みの結果として表示
+        st.rerun()
+    st.progress(job.progress, text=f"{MODEL_ENGINES[engine]}で学習中... {job.progress:.0%}（{job.elapsed:.0f}秒）")
+    if st.button("⏹ 学習を取り消す"):
+        job.cancel()
+        st.rerun()
+    _render_results(job.results, pending=True)
+
+
+def _render_results(results: dict, pending: bool = False):
+    for model, (heading, score_col, score_label, title, empty_msg) in _MODEL_SECTIONS.items():
+        st.markdown("---")
+        st.markdown(heading)
+        if model not in results:
+            if pending:
+                st.info("学習中...")
+            continue
+
+        imp = results[model]
+        if imp is not None:
+            score = imp[score_col].iloc[0]
+            if score is not None:
+                st.metric(score_label, f"{score:.3f}")
+            _fit_caption(imp)
+            _plot_importance(imp, title)
+        else:
+            st.warning(empty_msg)
+
+
+def _render_scoring(df: pd.DataFrame, features: list, n_est: int, engine: str, did: str, card: dict, config: tuple):
+    """学習済みの Model A / B で全リードをスコアリング（スコアは df に足さず session_state に別に持つ）"""
+    st.markdown("---")
+    st.markdown("### 📈 リードスコアリング")
+    st.caption("Model A / B で全リードに Qualified確率（_p_qualified）と Qualified時の成約確率（_p_won）を付けます")
+
+    if st.button("📈 全リードをスコアリング", use_container_width=True):
+        scorer = driver_scorer(df, features, n_estimators=n_est, engine=engine, dataset_id=did, **card)
+        if scorer is None:
+            st.warning("スコアリングに使えるモデルがありません。")
+            return
+        scores, report = score_leads(df, scorer)
+        st.session_state.lead_scores = (config, scores)
+        st.caption(
+            f"{report['rows']:,}行を{report['seconds']:.2f}秒でスコアリング"
+            f"（{report['rows_per_sec']:,.0f}行/秒・{report['chunks']}チャンク）"
+        )
+
+    # 同じデータ・特徴量・設定でスコアリングした結果だけを出す
+    saved = st.session_state.get("lead_scores")
+    if saved is not None and saved[0] == config and len(saved[1].columns):
+        scores = saved[1]
+        sort_col = [c for c in SCORE_COLUMNS.values() if c in scores.columns][-1]
+        show = [c for c in ["_sales_owner", "_age_band", "_asset_band", "_utm_source", "_utm_campaign", "_is_qualified", "_is_won"] if c in df.columns]
+        top = scores.nlargest(50, sort_col)
+        st.markdown(f"#### {sort_col} 上位リード")
+        st.dataframe(top.join(df.loc[top.index, show]), use_container_width=True)
+
+
+def _fit_caption(imp_df: pd.DataFrame):
+    st.caption(f"学習時間（全行＋CV分割の合計）: {imp_df['fit_seconds'].iloc[0]:.1f}秒")
+
 
 def _plot_importance(imp_df: pd.DataFrame, title: str):
     top = imp_df.head(15).copy()
@@ -1,8 +1,42 @@
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
-import pandas as pd
-from logic.metrics import pivot_segment, pivot_segment_count, group_funnel
+from logic.cube import (
+    cube_filter,
+    cube_group_funnel,
+    cube_pivot_segment,
+    cube_pivot_segment_count,
+)
+from logic.filter_index import apply_selection
+from logic.subgroups import discover_subgroups
+from ui.state import dataset_id, filters_key, get_cube, get_filter_index
+
+# 勝ち筋セグメント探索の打ち切り秒数
+_SUBGROUP_TIME_BUDGET = 5.0
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _segment_views(dataset_id: str, filters: tuple, metric: str, _cube):
+    """ヒートマップ・年代別/資産別ファネル（データ・フィルタ・指標が同じなら再計算しない）"""
+    cube = cube_filter(_cube, {k: list(v) for k, v in filters}) if filters else _cube
+    p = cube_pivot_segment(cube, "_age_band", "_asset_band", metric)
+    cnt = cube_pivot_segment_count(cube, "_age_band", "_asset_band")
+    age_funnel = cube_group_funnel(cube, "_age_band").sort_values("_age_band")
+    asset_funnel = cube_group_funnel(cube, "_asset_band").sort_values("_asset_band")
+    return p, cnt, age_funnel, asset_funnel
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _winning_segments(
+    dataset_id: str, filters: tuple, contrib_cols: tuple, max_depth: int, min_qualified: int, min_won: int,
+    _df, _index, _selection,
+):
+    """勝ち筋セグメントの探索（行データから。フィルタはビットマップ索引で適用）"""
+    df = apply_selection(_df, _index, _selection) if filters else _df
+    return discover_subgroups(
+        df, contrib_cols=list(contrib_cols), max_depth=max_depth,
+        min_qualified=min_qualified, min_won=min_won, time_budget=_SUBGROUP_TIME_BUDGET,
+    )
 
 
 def render_segment_tab():
@@ -12,6 +46,10 @@ def render_segment_tab():
         st.info("Dataタブで整備を完了してください。")
         return
 
+    filters = ()
+    if st.session_state.get("filters") and st.checkbox("Funnelタブのフィルタ（月・担当者・資産）を適用", value=False, key="segment_use_filters"):
+        filters = filters_key(st.session_state.filters)
+
     # 指標選択
     metric_options = {
         "Qualified率": "qualified_rate",
@@ -21,15 +59,17 @@ def render_segment_tab():
         "売上合計": "revenue_sum",
     }
 
-    sel_label = st.selectbox("表示指標", list(metric_options.keys()), index=0)
+    sel_label = st.selectbox("表示指標", list(metric_options.keys()), index=0, key="segment_metric")
     metric = metric_options[sel_label]
 
+    did = dataset_id()
+    p, cnt, age_funnel, asset_funnel = _segment_views(did, filters, metric, get_cube())
+
     col1, col2 = st.columns(2)
 
     # ヒートマップ
     with col1:
         st.markdown(f"#### {sel_label}（ヒートマップ）")
-        p = pivot_segment(df, "_age_band", "_asset_band", metric)
         if len(p) > 0:
             is_pct = metric in ("qualified_rate", "won_rate", "won_rate_in_qualified")
             fmt = ".1%" if is_pct else ",.0f"
@@ -53,7 +93,6 @@ def render_segment_tab():
     # サンプルサイズ
     with col2:
         st.markdown("#### リード数（サンプルサイズ）")
-        cnt = pivot_segment_count(df, "_age_band", "_asset_band")
         if len(cnt) > 0:
             fig_cnt = px.imshow(
                 cnt.astype(float),
@@ -75,15 +114,11 @@ def render_segment_tab():
 
     with tc1:
         st.markdown("#### 年代別ファネル")
-        age_funnel = group_funnel(df, "_age_band")
-        age_funnel = age_funnel.sort_values("_age_band")
         disp_cols = ["_age_band", "leads", "qualified", "won", "qualified_rate", "won_rate_in_qualified", "revenue_sum", "median_ticket"]
         st.dataframe(age_funnel[[c for c in disp_cols if c in age_funnel.columns]], use_container_width=True)
 
     with tc2:
         st.markdown("#### 純金融資産別ファネル")
-        asset_funnel = group_funnel(df, "_asset_band")
-        asset_funnel = asset_funnel.sort_values("_asset_band")
         asset_disp = [c for c in disp_cols if c in asset_funnel.columns]
         asset_disp = ["_asset_band" if c == "_age_band" else c for c in asset_disp]
         st.dataframe(asset_funnel[[c for c in asset_disp if c in asset_funnel.columns]], use_container_width=True)
@@ -91,26 +126,37 @@ def render_segment_tab():
     # 勝ち筋セグメント自動検出
     st.markdown("---")
     st.markdown("#### 🏆 勝ち筋セグメント候補")
-    st.caption("成約実績があり、成約率(Qualified内)が高いセグメント")
-
-    results = []
-    for (age, asset), grp in df.groupby(["_age_band", "_asset_band"], observed=True):
-        n = len(grp)
-        q = int(grp["_is_qualified"].sum())
-        w = int(grp["_is_won"].sum())
-        rev = float(grp["_revenue"].sum())
-        if q >= 3 and w >= 1:
-            results.append({
-                "年代": str(age),
-                "資産": str(asset),
-                "リード数": n,
-                "Qualified": q,
-                "成約": w,
-                "成約率(Q内)": w / q if q else 0,
-                "売上合計": rev,
-            })
-    if results:
-        winners = pd.DataFrame(results).sort_values("成約率(Q内)", ascending=False).head(10)
+    st.caption(
+        "年代・資産・utm・担当者・きっかけ・貢献フラグの組合せから、"
+        "成約率(Qualified内)が全体より高いセグメントを探索（リフト = 成約率 / 全体の成約率）"
+    )
+
+    wc1, wc2, wc3 = st.columns(3)
+    with wc1:
+        max_depth = st.slider("条件数（最大）", 1, 3, 3, 1, key="segment_depth")
+    with wc2:
+        min_qualified = st.slider("最小Qualified数", 3, 100, 10, 1, key="segment_min_qualified")
+    with wc3:
+        min_won = st.slider("最小成約数", 1, 20, 2, 1, key="segment_min_won")
+
+    contrib_cols = tuple((st.session_state.get("meta") or {}).get("contrib_cols", []))
+    winners, stats = _winning_segments(
+        did, filters, contrib_cols, max_depth, min_qualified, min_won,
+        df, get_filter_index(), st.session_state.get("row_selection"),
+    )
+    if len(winners):
+        winners = winners.rename(columns={
+            "segment": "セグメント",
+            "depth": "条件数",
+            "leads": "リード数",
+            "qualified": "Qualified",
+            "won": "成約",
+            "won_rate_in_qualified": "成約率(Q内)",
+            "lift": "リフト",
+            "revenue_sum": "売上合計",
+        })
         st.dataframe(winners, use_container_width=True)
+        note = "" if stats["complete"] else "・時間内に探索しきれなかったため途中までの上位"
+        st.caption(f"候補{stats['candidates']:,}件を評価（{stats['seconds']:.1f}秒{note}）")
     else:
         st.info("条件を満たすセグメントが見つかりませんでした。")